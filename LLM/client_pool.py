@@ -0,0 +1,342 @@
+import contextvars
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+import httpx
+from openai import APIConnectionError, APIStatusError, DefaultHttpxClient, OpenAI
+
+from config import Config
+from tracing import tracer
+
+
+def _retryable(error: BaseException) -> bool:
+    """Whether another endpoint may succeed where this one failed (not e.g. a malformed request)"""
+    if isinstance(error, APIStatusError):
+        return error.status_code >= 500 or error.status_code in (408, 409, 429)
+    # Also covers APITimeoutError; any other error (a bug, a bad answer) would fail again elsewhere
+    return isinstance(error, APIConnectionError)
+
+
+class Endpoint:
+    """One upstream endpoint: its client, latency statistics and circuit breaker"""
+
+    def __init__(self, url: str, model: str, weight: float, client: OpenAI) -> None:
+        self.url = url
+        # Empty for the global MODEL_NAME
+        self.model = model
+        self.weight = weight
+        self.client = client
+        self.lock = threading.Lock()
+        # Exponentially weighted mean of the response latency (seconds), None before the first response
+        self.ewma: float | None = None
+        # Latest response latencies, for the hedging quantile
+        self.samples: deque = deque(maxlen=200)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def observe(self, latency: float, alpha: float) -> None:
+        with self.lock:
+            self.ewma = latency if self.ewma == None else alpha * latency + (1 - alpha) * self.ewma
+            self.samples.append(latency)
+
+    def quantile(self, q: float, min_samples: int) -> float | None:
+        """Latency quantile of the latest responses, None with fewer than min_samples"""
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+
+    def available(self, now: float) -> bool:
+        """False while the circuit breaker is open"""
+        return self.open_until <= now
+
+    def succeeded(self) -> None:
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def failed(self, threshold: int, cooldown: float) -> bool:
+        """Count a failure; returns True if the circuit breaker opened"""
+        with self.lock:
+            self.consecutive_failures += 1
+            # After the cooldown one trial request is let through; failing again reopens at once
+            if self.consecutive_failures >= threshold:
+                self.open_until = time.monotonic() + cooldown
+                return True
+            return False
+
+
+class _Attempt:
+    """One request to one endpoint, part of a race"""
+
+    def __init__(self, race: "_Race", endpoint: Endpoint) -> None:
+        self.race = race
+        self.endpoint = endpoint
+        self.start = time.monotonic()
+        self.cancelled = False
+        self.finished = False
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+    def is_set(self) -> bool:
+        """Cancel state of the attempt: it lost the race, or the caller gave up"""
+        return self.cancelled or (self.race.cancel_event != None and self.race.cancel_event.is_set())
+
+
+class _Race:
+    """Attempts of one request; the first to produce output (a segment) or finish wins"""
+
+    def __init__(self, on_segment: Callable[[str], None] | None, cancel_event) -> None:
+        self.on_segment = on_segment
+        self.cancel_event = cancel_event
+        self.condition = threading.Condition()
+        self.attempts: List[_Attempt] = []
+        self.winner: _Attempt | None = None
+        # In-flight slots taken for hedged attempts, held until every attempt has ended
+        self.slots = 0
+        # Set once request() has returned or raised
+        self.done = False
+
+    def claim(self, attempt: _Attempt) -> bool:
+        """Make attempt the winner if there is none yet, cancelling the others"""
+        with self.condition:
+            if self.winner == None and not attempt.cancelled:
+                self.winner = attempt
+                for other in self.attempts:
+                    if other is not attempt:
+                        other.cancelled = True
+            return self.winner is attempt
+
+
+class ClientPool:
+    """
+    OpenAI-compatible clients of one or more endpoints, with hedging and failover.
+
+    LLM_ENDPOINTS lists the endpoints (url|model|weight|key, separated by commas);
+    without it the pool has the single endpoint OPENAI_ENDPOINT. Each endpoint has its
+    own client with persistent pooled connections (LLM_POOL_CONNECTIONS).
+
+    A request goes to an endpoint picked at random by weight, scaled down for
+    endpoints whose latency (EWMA, LLM_LATENCY_ALPHA) is higher than the fastest one.
+    If it has not responded after that endpoint's p95 latency (once it has
+    LLM_HEDGE_MIN_SAMPLES responses), a hedged duplicate is sent to another endpoint.
+    The hedge needs a free slot of inflight_limit (LLM_MAX_INFLIGHT), which it keeps
+    until both attempts have ended; without a free slot the request is not hedged.
+    The first attempt to respond - the first streamed segment, or the whole answer -
+    wins and the other is cancelled: a streamed loser is closed at once, a non-streamed
+    one is discarded when it returns, at the latest after LLM_REQUEST_TIMEOUT. A failed
+    attempt is retried on another endpoint if it could not connect, timed out or got a
+    5xx, 408, 409 or 429 response. After LLM_BREAKER_FAILURES failures in a row an
+    endpoint's circuit breaker opens for LLM_BREAKER_COOLDOWN seconds and it is
+    skipped, unless every endpoint is open.
+    """
+
+    def __init__(self, config: Config, cancelled_error: type = Exception,
+                 inflight_limit: threading.Semaphore | None = None, specs: tuple | None = None) -> None:
+        self.config = config
+        self.cancelled_error = cancelled_error
+        # Slots hedged attempts are counted against; None to hedge without limit
+        self.inflight_limit = inflight_limit
+        # (url, model, weight, key) of each endpoint, e.g. a dedicated summarization endpoint
+        specs = specs or config.llm_endpoints or ((config.openai_endpoint, "", 1.0, ""),)
+        limits = httpx.Limits(max_connections=config.llm_pool_connections,
+                              max_keepalive_connections=config.llm_pool_connections)
+        self.endpoints: List[Endpoint] = []
+        for url, model, weight, key in specs:
+            # Bounds how long an attempt, and a discarded loser's thread, can wait for the endpoint
+            client_options = {"api_key": key or config.openai_key, "base_url": url,
+                              "timeout": config.llm_request_timeout,
+                              "http_client": DefaultHttpxClient(limits=limits)}
+            if len(specs) > 1:
+                # Another endpoint is tried instead of retrying the same one
+                client_options["max_retries"] = 0
+            self.endpoints.append(Endpoint(url, model, weight, OpenAI(**client_options)))
+        self._random = random.Random()
+        # Attempts run here so that the caller can hedge while waiting; with inflight_limit at most
+        # LLM_MAX_INFLIGHT of them run at once
+        self._executor = ThreadPoolExecutor(max_workers=3 * config.llm_max_inflight,
+                                            thread_name_prefix="llm-attempt") if len(self.endpoints) > 1 else None
+
+    def _choose(self, exclude: List[Endpoint]) -> Endpoint | None:
+        """Weighted random endpoint among the available ones not in exclude"""
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        if not candidates:
+            return None
+        available = [endpoint for endpoint in candidates if endpoint.available(now)]
+        if not available:
+            # Every circuit is open: rather try the one that reopens first than fail without trying
+            return min(candidates, key=lambda endpoint: endpoint.open_until)
+        known = [endpoint.ewma for endpoint in available if endpoint.ewma != None]
+        fastest = min(known) if known else None
+        weights = [endpoint.weight * (fastest / endpoint.ewma if endpoint.ewma and fastest else 1.0)
+                   for endpoint in available]
+        return self._random.choices(available, weights)[0]
+
+    def request(self, call: Callable[[Endpoint, Callable[[str], None], Any], Any],
+                on_segment: Callable[[str], None] | None = None, cancel_event=None) -> Any:
+        """
+        Perform call on the pool's endpoints
+
+        Args:
+            call: call(endpoint, on_segment, cancel) sends the request through endpoint.client; it must hand
+                  streamed segments to on_segment and stop with cancelled_error once cancel.is_set()
+            on_segment: Receives the segments of the winning attempt
+            cancel_event: When set, every attempt is abandoned
+
+        Returns:
+            The result of the winning attempt
+        """
+        race = _Race(on_segment, cancel_event)
+        try:
+            return self._race(race, call)
+        finally:
+            race.done = True
+            self._release_slots(race)
+
+    def _race(self, race: _Race, call: Callable) -> Any:
+        cancel_event = race.cancel_event
+        tried = [self._choose([])]
+        self._start(race, tried[0], call)
+        settings = self.config.snapshot()
+        hedge_at = None
+        if settings.llm_hedge and len(self.endpoints) > 1:
+            delay = tried[0].quantile(0.95, settings.llm_hedge_min_samples)
+            hedge_at = time.monotonic() + delay if delay != None else None
+        last_error = None
+        while True:
+            with race.condition:
+                while not any(attempt.finished for attempt in race.attempts):
+                    timeout = 0.1 if hedge_at == None else max(0.0, min(0.1, hedge_at - time.monotonic()))
+                    if hedge_at != None and timeout == 0:
+                        break
+                    race.condition.wait(timeout)
+                finished = [attempt for attempt in race.attempts if attempt.finished]
+                for attempt in finished:
+                    race.attempts.remove(attempt)
+                running = list(race.attempts)
+            for attempt in finished:
+                if attempt.error == None and not attempt.cancelled:
+                    race.claim(attempt)
+                if race.winner is attempt:
+                    if attempt.error != None:
+                        # Part of the answer has already been delivered, it cannot be resent elsewhere
+                        raise attempt.error
+                    return attempt.result
+                if attempt.cancelled or attempt.is_set():
+                    continue
+                if not _retryable(attempt.error):
+                    self._cancel(race)
+                    raise attempt.error
+                last_error = attempt.error
+            if cancel_event != None and cancel_event.is_set() and not running:
+                raise self.cancelled_error()
+            if not running:
+                # Failover: every attempt failed, try an endpoint that was not tried yet
+                endpoint = self._choose(tried)
+                if endpoint == None:
+                    raise last_error
+                tried.append(endpoint)
+                tracer.count("llm_failovers", endpoint=endpoint.url)
+                self._start(race, endpoint, call)
+            elif hedge_at != None and time.monotonic() >= hedge_at:
+                hedge_at = None
+                endpoint = self._choose(tried)
+                if endpoint != None and race.winner == None and self._take_slot(race):
+                    tried.append(endpoint)
+                    tracer.count("llm_hedged", endpoint=endpoint.url)
+                    self._start(race, endpoint, call)
+
+    def _take_slot(self, race: _Race) -> bool:
+        """Take a free in-flight slot for a hedged attempt; False (no hedge) if there is none"""
+        if self.inflight_limit == None:
+            return True
+        if not self.inflight_limit.acquire(blocking=False):
+            tracer.count("llm_hedge_skipped")
+            return False
+        with race.condition:
+            race.slots += 1
+        return True
+
+    def _release_slots(self, race: _Race) -> None:
+        """Give back the race's hedge slots once the request is over and none of its attempts still runs"""
+        with race.condition:
+            if not race.done or any(not attempt.finished for attempt in race.attempts):
+                return
+            slots, race.slots = race.slots, 0
+        for _ in range(slots):
+            self.inflight_limit.release()
+
+    def _start(self, race: _Race, endpoint: Endpoint, call: Callable) -> None:
+        attempt = _Attempt(race, endpoint)
+        with race.condition:
+            race.attempts.append(attempt)
+        if self._executor == None:
+            # A single endpoint cannot be hedged; the attempt runs on the caller's thread
+            self._run(attempt, call)
+        else:
+            # The attempt belongs to the caller's turn (tracing)
+            self._executor.submit(contextvars.copy_context().run, self._run, attempt, call)
+
+    def _run(self, attempt: _Attempt, call: Callable) -> None:
+        race = attempt.race
+
+        def forward(segment: str) -> None:
+            if not race.claim(attempt):
+                raise self.cancelled_error()
+            if race.on_segment != None:
+                race.on_segment(segment)
+
+        endpoint = attempt.endpoint
+        settings = self.config.snapshot()
+        first_output = [None]
+
+        def timed_forward(segment: str) -> None:
+            if first_output[0] == None:
+                first_output[0] = time.monotonic()
+            forward(segment)
+
+        try:
+            result = call(endpoint, timed_forward, attempt)
+            attempt.result = result
+            endpoint.succeeded()
+        except BaseException as e:
+            attempt.error = e
+            if not attempt.is_set() and not isinstance(e, self.cancelled_error) and _retryable(e):
+                if endpoint.failed(settings.llm_breaker_failures, settings.llm_breaker_cooldown):
+                    print(f"LLM endpoint {endpoint.url} failed {endpoint.consecutive_failures} times in a row, "
+                          f"skipped for {settings.llm_breaker_cooldown:g} s: {e}")
+                    tracer.count("llm_breaker_open", endpoint=endpoint.url)
+        # Time until the endpoint responded; for a cancelled loser, how long it had been waiting
+        latency = (first_output[0] or time.monotonic()) - attempt.start
+        if attempt.error == None or attempt.cancelled:
+            endpoint.observe(latency, settings.llm_latency_alpha)
+            tracer.record("llm_endpoint", latency, endpoint=endpoint.url)
+        with race.condition:
+            attempt.finished = True
+            race.condition.notify_all()
+        self._release_slots(race)
+
+    def _cancel(self, race: _Race) -> None:
+        with race.condition:
+            for attempt in race.attempts:
+                attempt.cancelled = True
+
+    def stats(self) -> List[Dict]:
+        now = time.monotonic()
+        return [{"url": endpoint.url, "model": endpoint.model, "weight": endpoint.weight,
+                 "ewma": endpoint.ewma, "p95": endpoint.quantile(0.95, 1),
+                 "circuit": "closed" if endpoint.available(now) else "open",
+                 "consecutive_failures": endpoint.consecutive_failures}
+                for endpoint in self.endpoints]
+
+    def close(self) -> None:
+        if self._executor != None:
+            self._executor.shutdown(wait=False)
+        for endpoint in self.endpoints:
+            endpoint.client.close()
@@ -0,0 +1,148 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+from config import Config
+
+
+class FixedDebouncePolicy:
+    """Every user waits MAX_WAIT_DURATION seconds after their last message"""
+
+    def __init__(self, max_wait: float) -> None:
+        self.max_wait = max_wait
+
+    def observe(self, user_id: str, now: float) -> None:
+        """Record that a message of the user arrived at now (monotonic seconds)"""
+
+    def wait_duration(self, user_id: str) -> float:
+        """Seconds to wait after the user's last message before flushing"""
+        return self.max_wait
+
+
+class _GapStats:
+    """Compact per-user statistics of the gaps between messages of one burst"""
+    __slots__ = ("last_time", "mean", "variance", "gaps", "follow_rate", "samples")
+
+    def __init__(self) -> None:
+        self.last_time: float | None = None
+        # Weighted mean and variance of the gaps inside a burst
+        self.mean = 0.0
+        self.variance = 0.0
+        self.gaps = 0
+        # Weighted fraction of messages followed by another one of the same burst
+        self.follow_rate = 0.0
+        self.samples = 0
+
+
+class AdaptiveDebouncePolicy:
+    """
+    Learns each user's typing cadence and waits just long enough for them to finish.
+
+    A gap of at most max_wait between two messages is part of a burst; a longer gap
+    means the previous burst had ended. Both are tracked with exponential weights
+    (DEBOUNCE_GAP_ALPHA): the mean and variance of the gaps inside bursts, and the
+    rate at which a message is followed by another one of the same burst. The wait
+    after a message is mean + DEBOUNCE_GAP_DEVIATIONS * standard deviation; while
+    the follow rate is below DEBOUNCE_FOLLOW_RATE it is scaled down towards
+    DEBOUNCE_MIN_WAIT, so users who send single messages are answered quickly and
+    multi-part senders get time to finish. The
+    result is clamped to [DEBOUNCE_MIN_WAIT, max_wait]; users with fewer than
+    DEBOUNCE_MIN_SAMPLES observed gaps wait max_wait. Statistics of at most
+    DEBOUNCE_POLICY_MAX_USERS users are kept, dropping the least recently active.
+    """
+
+    def __init__(self, max_wait: float, min_wait: float = 0.5, alpha: float = 0.1, deviations: float = 3.0,
+                 follow_rate: float = 0.2, min_samples: int = 3, max_users: int = 10000) -> None:
+        self.max_wait = max_wait
+        self.min_wait = min(min_wait, max_wait)
+        self.alpha = alpha
+        self.deviations = deviations
+        self.follow_rate = follow_rate
+        self.min_samples = min_samples
+        self.max_users = max(1, max_users)
+        self._lock = threading.Lock()
+        self._stats: "OrderedDict[str, _GapStats]" = OrderedDict()
+
+    def observe(self, user_id: str, now: float) -> None:
+        with self._lock:
+            stats = self._stats.get(user_id)
+            if stats == None:
+                stats = self._stats[user_id] = _GapStats()
+                if len(self._stats) > self.max_users:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(user_id)
+            if stats.last_time != None:
+                self._learn(stats, now - stats.last_time)
+            stats.last_time = now
+
+    def _learn(self, stats: _GapStats, gap: float) -> None:
+        followed = gap <= self.max_wait
+        if stats.samples == 0:
+            stats.follow_rate = 1.0 if followed else 0.0
+        else:
+            stats.follow_rate += self.alpha * ((1.0 if followed else 0.0) - stats.follow_rate)
+        stats.samples += 1
+        if not followed:
+            return
+        if stats.gaps == 0:
+            stats.mean = gap
+        else:
+            # Incremental exponentially weighted mean and variance
+            diff = gap - stats.mean
+            increment = self.alpha * diff
+            stats.mean += increment
+            stats.variance = (1 - self.alpha) * (stats.variance + diff * increment)
+        stats.gaps += 1
+
+    def wait_duration(self, user_id: str) -> float:
+        with self._lock:
+            stats = self._stats.get(user_id)
+            if stats == None or stats.samples < self.min_samples:
+                return self.max_wait
+            gap_wait = stats.mean + self.deviations * math.sqrt(stats.variance) if stats.gaps else self.max_wait
+            scale = min(1.0, stats.follow_rate / self.follow_rate) if self.follow_rate > 0 else 1.0
+            wait = self.min_wait + scale * (min(gap_wait, self.max_wait) - self.min_wait)
+        return min(self.max_wait, max(self.min_wait, wait))
+
+    def snapshot(self, user_id: str) -> Dict[str, float] | None:
+        """Learned gap statistics of a user, for inspection"""
+        with self._lock:
+            stats = self._stats.get(user_id)
+            if stats == None:
+                return None
+            return {"mean": stats.mean, "deviation": math.sqrt(stats.variance),
+                    "follow_rate": stats.follow_rate, "samples": stats.samples}
+
+
+def create_debounce_policy(config: Config):
+    """
+    Build the debounce policy selected by DEBOUNCE_POLICY
+
+    DEBOUNCE_POLICY:
+        fixed     - wait MAX_WAIT_DURATION for everyone (default)
+        adaptive  - AdaptiveDebouncePolicy, bounded by DEBOUNCE_MIN_WAIT and MAX_WAIT_DURATION
+    """
+    if config.debounce_policy == "fixed":
+        return FixedDebouncePolicy(config.max_wait_duration)
+    if config.debounce_policy == "adaptive":
+        policy = AdaptiveDebouncePolicy(config.max_wait_duration)
+        configure_debounce_policy(policy, config)
+        return policy
+    raise ValueError(f"Unknown DEBOUNCE_POLICY '{config.debounce_policy}'")
+
+
+def configure_debounce_policy(policy, config: Config) -> None:
+    """Apply the current debounce settings to a policy, keeping the statistics it has learned"""
+    if isinstance(policy, AdaptiveDebouncePolicy):
+        with policy._lock:
+            policy.max_wait = config.max_wait_duration
+            policy.min_wait = min(config.debounce_min_wait, config.max_wait_duration)
+            policy.alpha = config.debounce_gap_alpha
+            policy.deviations = config.debounce_gap_deviations
+            policy.follow_rate = config.debounce_follow_rate
+            policy.min_samples = config.debounce_min_samples
+            policy.max_users = config.debounce_policy_max_users
+    elif isinstance(policy, FixedDebouncePolicy):
+        policy.max_wait = config.max_wait_duration
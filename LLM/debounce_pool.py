@@ -1,86 +1,232 @@
-from multiprocessing import set_forkserver_preload
+import heapq
 import threading
 import time
+from concurrent.futures import Future
 from queue import Queue
-from typing import Dict, Callable
+from typing import Dict, Callable, List, Set, Tuple
 
 from config import Config
 from locker import Locker
+from LLM.speculation import SpeculationManager
+from LLM.debounce_policy import create_debounce_policy, configure_debounce_policy
+from tracing import tracer
+
+# Kinds of scheduled events
+FLUSH = 0
+SPECULATE = 1
 
 
 class DebouncePool:
-    def __init__(self, config: Config, callback: Callable[[str,Dict],None]) -> None:
+    def __init__(self, config: Config, callback: Callable[[str,Dict],None],
+                 speculation: SpeculationManager | None = None, policy=None) -> None:
         self.config = config
         self.locker = Locker() # The scope is local and cannot be extended to ContextManager.
         self.callback = callback
+        # Decides how long to wait after each user's last message (DEBOUNCE_POLICY)
+        self.policy = policy if policy != None else create_debounce_policy(self.config)
+        if policy == None:
+            # Debounce timing tuned in .env applies to the next messages, keeping what was learned
+            self.config.on_change(lambda settings, changed: configure_debounce_policy(self.policy, settings))
+        # Optional speculative requests, started after a shorter silence than the flush wait
+        self.speculation = speculation
+        # Queued (message, media future or None) of every user
         self._user_queues: Dict[str, Queue] = {}
-        self._user_timers: Dict[str, float] = {}
-        self._worker_threads: Dict[str, threading.Thread] = {}
-        self._worker_threads_lock = threading.Lock()
-        self._stop_events: Dict[str, threading.Event] = {}
+        # Time until which the flush of a user may wait for their pending media
+        self._media_deadlines: Dict[str, float] = {}
+        # Users whose flush is being held back for media
+        self._held: Set[str] = set()
+        # Arrival time of the latest buffered message of every user
+        self._last_arrival: Dict[str, float] = {}
+        # Current deadline of every scheduled event, guarded by _scheduler_condition
+        self._deadlines: Dict[Tuple[int, str], float] = {}
+        # Min-heap of (deadline, kind, user_id). Rescheduling pushes a new entry and leaves the
+        # old one behind; stale entries are skipped lazily when they reach the top.
+        self._deadline_heap: List[Tuple[float, int, str]] = []
+        self._scheduler_condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._scheduler_thread = threading.Thread(target=self._run_scheduler, daemon=True)
+        self._scheduler_thread.start()
+
+    def submit_message(self, user_id: str, message: Dict, media: Future | None = None) -> None:
+        """
+        Buffer a message of a user
 
-    def submit_message(self, user_id: str, message: Dict) -> None:
+        Args:
+            user_id: User ID
+            message: The message; for media, a placeholder used if the media cannot be processed in time
+            media: Future resolving to the text of a media message that is still being processed.
+                   The user's flush waits for it, at most MEDIA_TIMEOUT seconds.
+        """
         with self.locker.acquire_user_lock(user_id):
             if user_id not in self._user_queues:
                 self._user_queues[user_id] = Queue()
-                self._user_timers[user_id] = time.time()
-                self._start_worker(user_id)
-            
-            self._user_queues[user_id].put(message)
-            self._user_timers[user_id] = time.time()
+
+            self._user_queues[user_id].put((message, media))
+            now = time.monotonic()
+            self._last_arrival[user_id] = now
+            if media != None:
+                # Longest time the flush is held back for media that is still being processed
+                self._media_deadlines.setdefault(user_id, now + self.config.media_timeout)
+            self.policy.observe(user_id, now)
+            wait_duration = self.policy.wait_duration(user_id)
+            self._schedule(FLUSH, user_id, now + wait_duration)
+            if self.speculation != None:
+                # A speculative reply to the previous messages is now outdated
+                self.speculation.cancel(user_id)
+                if self.speculation.idle_threshold < wait_duration:
+                    self._schedule(SPECULATE, user_id, now + self.speculation.idle_threshold)
 
             # Trigger immediately when the message count reaches the threshold
             enable_request = self._user_queues[user_id].qsize() >= self.config.debounce_threshold
 
+        if media != None:
+            media.add_done_callback(lambda _: self._media_resolved(user_id))
         if enable_request == True:
-            # Sending requests must be executed outside the lock here, otherwise it will deadlock 
+            # Sending requests must be executed outside the lock here, otherwise it will deadlock
             self._trigger(user_id)
 
-    def _start_worker(self, user_id: str) -> None:
-        with self._worker_threads_lock:
-            if user_id in self._worker_threads:
+    def drain(self) -> None:
+        """Flush every buffered user now, without waiting for their debounce window or pending media"""
+        for user_id in list(self._user_queues):
+            self._trigger(user_id, force=True)
+
+    def stop(self) -> None:
+        """Stop the scheduler thread. Messages still buffered are not flushed; call drain() first."""
+        self._stop_event.set()
+        with self._scheduler_condition:
+            self._scheduler_condition.notify()
+        self._scheduler_thread.join()
+
+    def _schedule(self, kind: int, user_id: str, deadline: float) -> None:
+        """(Re)schedule an event of a user in O(log n)"""
+        with self._scheduler_condition:
+            self._deadlines[(kind, user_id)] = deadline
+            heapq.heappush(self._deadline_heap, (deadline, kind, user_id))
+            # Only wake the scheduler if this deadline became the earliest one
+            if self._deadline_heap[0] == (deadline, kind, user_id):
+                self._scheduler_condition.notify()
+
+    def _is_current(self, entry: Tuple[float, int, str]) -> bool:
+        deadline, kind, user_id = entry
+        return self._deadlines.get((kind, user_id)) == deadline
+
+    def _pop_due_events(self) -> List[Tuple[int, str]]:
+        """Block until at least one deadline is due and return the due (kind, user_id) events.
+        Must be called while holding _scheduler_condition."""
+        while not self._stop_event.is_set():
+            # Drop entries that were superseded by a later submit or an early trigger
+            while self._deadline_heap and not self._is_current(self._deadline_heap[0]):
+                heapq.heappop(self._deadline_heap)
+
+            if not self._deadline_heap:
+                self._scheduler_condition.wait()
+                continue
+
+            remaining = self._deadline_heap[0][0] - time.monotonic()
+            if remaining > 0:
+                self._scheduler_condition.wait(remaining)
+                continue
+
+            due_events = []
+            now = time.monotonic()
+            while self._deadline_heap and self._deadline_heap[0][0] <= now:
+                entry = heapq.heappop(self._deadline_heap)
+                if self._is_current(entry):
+                    _, kind, user_id = entry
+                    del self._deadlines[(kind, user_id)]
+                    due_events.append((kind, user_id))
+            if due_events:
+                return due_events
+        return []
+
+    def _run_scheduler(self) -> None:
+        while not self._stop_event.is_set():
+            with self._scheduler_condition:
+                due_events = self._pop_due_events()
+            for kind, user_id in due_events:
+                # Both only hand work over to other threads, so they are cheap to run here
+                if kind == FLUSH:
+                    self._trigger(user_id)
+                else:
+                    self._speculate(user_id)
+
+    @staticmethod
+    def _has_pending_media(entries: List[Tuple[Dict, Future | None]]) -> bool:
+        return any(media != None and not media.done() for _, media in entries)
+
+    @staticmethod
+    def _resolve_content(user_id: str, message: Dict, media: Future | None) -> str:
+        """The text of a buffered message: the media result if it is ready, otherwise the placeholder"""
+        if media == None or not media.done():
+            return message['content']
+        try:
+            return media.result()
+        except Exception as e:
+            print(f"Failed to process media of {user_id}: {e}")
+            return message['content']
+
+    def _media_resolved(self, user_id: str) -> None:
+        """A media future of the user finished: release a held flush once nothing is pending"""
+        with self.locker.acquire_user_lock(user_id):
+            if user_id not in self._held or self._has_pending_media(list(self._user_queues[user_id].queue)):
                 return
+            self._held.discard(user_id)
+            self._schedule(FLUSH, user_id, time.monotonic())
+
+    def _submit_late_media(self, user_id: str, media: Future) -> None:
+        """Media that resolved after its placeholder was flushed is sent as a new message"""
+        try:
+            content = media.result()
+        except Exception as e:
+            print(f"Failed to process media of {user_id}: {e}")
+            return
+        self.submit_message(user_id, {"role": "user", "content": content})
 
-        stop_event = threading.Event()
-        self._stop_events[user_id] = stop_event
-
-        def worker():
-            while not stop_event.is_set():
-                # Acquire the lock and check for expiration after each wake-up
-                with self.locker.acquire_user_lock(user_id):
-                    # After waking up, if the user_queue no longer has a user_id, it means it has already been triggered.
-                    if user_id not in self._user_queues:
-                        break
-                    elapsed = time.time() - self._user_timers[user_id]
-                remaining = max(0, int(self.config.max_wait_duration) - elapsed)
-                    
-                if remaining > 0:
-                    time.sleep(1)
-                    continue
-
-                self._trigger(user_id)
-                break
-
-        thread = threading.Thread(target=worker, daemon=True)
-        self._worker_threads[user_id] = thread
-        thread.start()
-
-    def _trigger(self, user_id: str):
+    def _speculate(self, user_id: str) -> None:
+        """Start a speculative reply to the messages buffered so far, without draining them"""
         with self.locker.acquire_user_lock(user_id):
             if user_id not in self._user_queues:
                 return
+            entries = list(self._user_queues[user_id].queue)
+            # Never speculate on placeholders of media that is still being processed
+            if self._has_pending_media(entries):
+                return
+            content = ''.join(self._resolve_content(user_id, message, media) for message, media in entries)
+            self.speculation.start(user_id, {"role": "user", "content": content})
+
+    def _trigger(self, user_id: str, force: bool = False):
+        with self.locker.acquire_user_lock(user_id):
+            if user_id not in self._user_queues:
+                return
+
+            # Hold the flush while media of the user is being processed, up to MEDIA_TIMEOUT
+            if not force and self._has_pending_media(list(self._user_queues[user_id].queue)):
+                hold_until = self._media_deadlines[user_id]
+                if time.monotonic() < hold_until:
+                    self._held.add(user_id)
+                    self._schedule(FLUSH, user_id, hold_until)
+                    return
 
-            messages = []
+            entries = []
             while not self._user_queues[user_id].empty():
-                messages.append(self._user_queues[user_id].get())
+                entries.append(self._user_queues[user_id].get())
 
             # Clean up resources
             del self._user_queues[user_id]
-            del self._user_timers[user_id]
-            del self._worker_threads[user_id]
-            del self._stop_events[user_id]
+            last_arrival = self._last_arrival.pop(user_id)
+            self._media_deadlines.pop(user_id, None)
+            self._held.discard(user_id)
+            with self._scheduler_condition:
+                self._deadlines.pop((FLUSH, user_id), None)
+                self._deadlines.pop((SPECULATE, user_id), None)
 
+        tracer.flushed(user_id, time.monotonic() - last_arrival)
         # Concatenate content, execute outside locks to improve performance
-        content = ''.join(msg['content'] for msg in messages)
-        self.callback(user_id, {"role": "user", "content": content})
-        
\ No newline at end of file
+        content = ''.join(self._resolve_content(user_id, message, media) for message, media in entries)
+        message = {"role": "user", "content": content}
+        for _, media in entries:
+            if media != None and not media.done():
+                media.add_done_callback(lambda future: self._submit_late_media(user_id, future))
+        if self.speculation != None:
+            self.speculation.seal(user_id, message)
+        self.callback(user_id, message)
@@ -0,0 +1,192 @@
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List
+
+from config import Config
+from tracing import tracer
+
+
+class RequestDispatcher:
+    """
+    Dispatch stage between DebouncePool and Responsor, with admission control.
+
+    Debounced turns are executed on a bounded pool of worker threads. Turns of the
+    same user are processed strictly in submission order and never concurrently,
+    while turns of different users run in parallel.
+
+    Users with waiting turns are served by deficit round robin: every round a user
+    earns DISPATCH_QUANTUM characters times their priority (1 unless set with
+    set_priorities), and a turn starts once the user has earned its length. A chatty
+    user therefore gets no more than their share, and a priority of 2 gets twice the
+    share of 1. At most DISPATCH_MAX_QUEUED turns wait at once (0 for no limit).
+    Beyond that the load is shed: a new turn of a user who already has one waiting
+    is merged into it, and a turn of any other user is rejected through on_shed,
+    which typically sends a "busy" reply. In both cases on_dropped(user_id) is called
+    first, e.g. to drop a speculative reply made for the turn alone.
+    """
+
+    def __init__(self, config: Config, handler: Callable[[str, Dict], None],
+                 on_shed: Callable[[str, Dict], None] | None = None,
+                 on_dropped: Callable[[str], None] | None = None) -> None:
+        self.config = config
+        self.handler = handler
+        self.on_shed = on_shed
+        self.on_dropped = on_dropped
+        self.worker_count = self.config.dispatch_workers
+        # Pending turns of every user that is queued or being processed; the first
+        # turn of a user in _busy is the one being processed
+        self._pending: Dict[str, Deque[Dict]] = {}
+        self._busy: set = set()
+        # Users with a waiting turn and no turn in progress, in round robin order.
+        # A user is in _active at most once, so no two workers can ever process the same user.
+        self._active: Deque[str] = deque()
+        self._deficit: Dict[str, float] = {}
+        self._priorities: Dict[str, float] = {}
+        # Turns waiting, not counting those in progress
+        self._queued = 0
+        self._stopping = False
+        self._shed = 0
+        self._merged = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._work = threading.Condition(self._lock)
+        self._workers: List[threading.Thread] = []
+        for index in range(self.worker_count):
+            thread = threading.Thread(target=self._worker, name=f"dispatch-worker-{index}", daemon=True)
+            self._workers.append(thread)
+            thread.start()
+
+    def set_priorities(self, priorities: Dict[str, float]) -> None:
+        """Replace the per-user priorities (share weights); users not listed have priority 1"""
+        with self._lock:
+            self._priorities = dict(priorities)
+
+    def submit(self, user_id: str, message: Dict) -> None:
+        """Queue a debounced turn; it runs after every earlier turn of the same user"""
+        shed = False
+        with self._lock:
+            turns = self._pending.get(user_id)
+            max_queued = self.config.dispatch_max_queued
+            if max_queued > 0 and self._queued >= max_queued:
+                waiting = turns != None and len(turns) > (1 if user_id in self._busy else 0)
+                if waiting:
+                    # Overloaded: answer both in one request instead of queueing another turn
+                    turns[-1] = {"role": "user", "content": f"{turns[-1]['content']}\n{message['content']}"}
+                    self._merged += 1
+                else:
+                    shed = True
+                    self._shed += 1
+            else:
+                if turns == None:
+                    turns = self._pending[user_id] = deque()
+                turns.append(message)
+                self._queued += 1
+                if user_id not in self._busy and len(turns) == 1:
+                    self._active.append(user_id)
+                    self._work.notify()
+                self._report_depth()
+                return
+        if self.on_dropped != None:
+            self.on_dropped(user_id)
+        if shed:
+            tracer.count("dispatch_shed")
+            # No turn is traced for the flushed messages
+            tracer.discard_flush(user_id)
+            print(f"Dispatcher overloaded, turn of {user_id} rejected")
+            if self.on_shed != None:
+                self.on_shed(user_id, message)
+        else:
+            tracer.count("dispatch_merged")
+            tracer.discard_flush(user_id)
+
+    def _report_depth(self) -> None:
+        tracer.gauge("dispatch_queue_depth", self._queued)
+        tracer.gauge("dispatch_waiting_users", len(self._active))
+
+    def pending_count(self) -> int:
+        """Number of turns queued or in progress"""
+        with self._lock:
+            return sum(len(turns) for turns in self._pending.values())
+
+    def has_pending(self, user_id: str) -> bool:
+        """Whether a turn of the user is queued or in progress"""
+        with self._lock:
+            return user_id in self._pending
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"queued": self._queued, "in_progress": len(self._busy), "merged": self._merged,
+                    "shed": self._shed}
+
+    def join(self, timeout: float | None = None) -> bool:
+        """
+        Wait until every submitted turn has been processed
+
+        Returns:
+            True if the dispatcher became idle, False on timeout
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def stop(self) -> None:
+        """Stop the workers after the turns already queued have been processed"""
+        with self._lock:
+            self._stopping = True
+            self._work.notify_all()
+        for thread in self._workers:
+            thread.join()
+
+    @staticmethod
+    def _cost(message: Dict) -> int:
+        """Share a turn takes from its user's round, in characters"""
+        return max(1, len(message.get("content") or ""))
+
+    def _next_user(self) -> str:
+        """Deficit round robin over the users in _active; called with the lock held and _active not empty"""
+        quantum = self.config.dispatch_quantum
+        while True:
+            user_id = self._active[0]
+            cost = self._cost(self._pending[user_id][0])
+            deficit = self._deficit.get(user_id, 0.0)
+            if deficit >= cost:
+                self._active.popleft()
+                self._deficit[user_id] = deficit - cost
+                return user_id
+            # Not enough credit yet: earn this round's share and let the next user go first
+            self._deficit[user_id] = deficit + quantum * self._priorities.get(user_id, 1.0)
+            self._active.rotate(-1)
+
+    def _worker(self) -> None:
+        while True:
+            with self._lock:
+                self._work.wait_for(lambda: self._active or self._stopping)
+                if not self._active:
+                    break
+                user_id = self._next_user()
+                self._busy.add(user_id)
+                self._queued -= 1
+                message = self._pending[user_id][0]
+                self._report_depth()
+            try:
+                self.handler(user_id, message)
+            except Exception as e:
+                # A failing turn must not kill the worker or block the user's later turns
+                print(f"Failed to process message of {user_id}: {e}")
+            finally:
+                with self._lock:
+                    self._busy.discard(user_id)
+                    turns = self._pending[user_id]
+                    turns.popleft()
+                    if turns:
+                        if self._deficit.get(user_id, 0.0) >= self._cost(turns[0]):
+                            # The user's visit continues while their credit of this round lasts
+                            self._active.appendleft(user_id)
+                        else:
+                            # Back at the end of the round so a busy user cannot monopolise a worker
+                            self._active.append(user_id)
+                        self._work.notify()
+                    else:
+                        # An idle user does not keep credit (deficit round robin)
+                        del self._pending[user_id]
+                        self._deficit.pop(user_id, None)
+                        self._idle.notify_all()
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
+
+from config import Config
+from tracing import tracer
+
+try:
+    import numpy
+except ImportError:
+    # The similarity tier falls back to sparse vectors in pure Python
+    numpy = None
+
+# Dimensions of the hashed character n-gram vectors of the similarity tier
+VECTOR_DIMENSIONS = 512
+# Characters stripped from both ends of a normalized message, e.g. "what files do you have?"
+_EDGE_PUNCTUATION = " \t\r\n.,!?~。，！？～…"
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str | None) -> str:
+    """Case, width and whitespace insensitive form of a message, used in cache keys"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _WHITESPACE.sub(" ", text).strip(_EDGE_PUNCTUATION)
+
+
+def _vectorize(text: str):
+    """
+    Unit vector of the hashed character unigrams and bigrams of a normalized text
+
+    Returns:
+        A numpy array if numpy is installed, otherwise a {dimension: weight} dictionary
+    """
+    counts: Dict[int, float] = {}
+    grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+    for gram in grams:
+        if gram == " ":
+            continue
+        dimension = zlib.crc32(gram.encode("utf-8")) % VECTOR_DIMENSIONS
+        counts[dimension] = counts.get(dimension, 0.0) + 1.0
+    norm = math.sqrt(sum(weight * weight for weight in counts.values())) or 1.0
+    if numpy == None:
+        return {dimension: weight / norm for dimension, weight in counts.items()}
+    vector = numpy.zeros(VECTOR_DIMENSIONS, dtype=numpy.float32)
+    for dimension, weight in counts.items():
+        vector[dimension] = weight / norm
+    return vector
+
+
+class CacheKey:
+    """Fingerprint of a request: the context (system prompt, model, history tail) and the new message"""
+    __slots__ = ("context", "message", "exact")
+
+    def __init__(self, context: str, message: str) -> None:
+        self.context = context
+        # Normalized text of the new message
+        self.message = message
+        self.exact = (context, message)
+
+
+class _Entry:
+    __slots__ = ("response", "segments", "created", "key", "vector")
+
+    def __init__(self, response: Dict, segments: List[str], key: CacheKey, vector) -> None:
+        self.response = response
+        # Streamed segments, delivered again one by one on a hit
+        self.segments = segments
+        self.created = time.monotonic()
+        self.key = key
+        self.vector = vector
+
+
+class _SimilarityIndex:
+    """Vectors of the cached messages that share one context"""
+
+    def __init__(self) -> None:
+        self.entries: List[_Entry] = []
+        # Stacked vectors, rebuilt after the entries change (numpy only)
+        self._matrix = None
+
+    def add(self, entry: _Entry) -> None:
+        self.entries.append(entry)
+        self._matrix = None
+
+    def remove(self, entry: _Entry) -> None:
+        self.entries.remove(entry)
+        self._matrix = None
+
+    def nearest(self, vector) -> Tuple[_Entry | None, float]:
+        """The most similar entry and its cosine similarity"""
+        if not self.entries:
+            return None, 0.0
+        if numpy != None:
+            if self._matrix is None:
+                self._matrix = numpy.stack([entry.vector for entry in self.entries])
+            scores = self._matrix @ vector
+            best = int(numpy.argmax(scores))
+            return self.entries[best], float(scores[best])
+        best_entry, best_score = None, -1.0
+        for entry in self.entries:
+            small, large = (vector, entry.vector) if len(vector) < len(entry.vector) else (entry.vector, vector)
+            score = sum(weight * large.get(dimension, 0.0) for dimension, weight in small.items())
+            if score > best_score:
+                best_entry, best_score = entry, score
+        return best_entry, best_score
+
+
+class ResponseCache:
+    """
+    Replies to repeated questions, shared between users.
+
+    A request is fingerprinted by its system prompt, the model, the running summary
+    of the conversation, the last RESPONSE_CACHE_CONTEXT_MESSAGES messages of the
+    history and the new message, all normalized (case, width and whitespace). The exact tier matches the whole
+    fingerprint. If RESPONSE_CACHE_SIMILARITY is greater than 0, a request with the
+    same context whose new message is at least that similar (cosine of hashed
+    character n-grams, vectorized with numpy when it is installed) to a cached one
+    is answered from the similarity tier.
+
+    Entries expire after RESPONSE_CACHE_TTL seconds and at most
+    RESPONSE_CACHE_MAX_ENTRIES are kept, least recently used first out. Users in
+    RESPONSE_CACHE_OPT_OUT are neither answered from nor added to the cache. Replies
+    of turns that called a tool not listed in RESPONSE_CACHE_SAFE_TOOLS (e.g.
+    send_a_file) are never stored. Everything is dropped when the information files
+    directory or the system prompts change.
+    """
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._indexes: Dict[str, _SimilarityIndex] = {}
+        self._hits = {"exact": 0, "similar": 0}
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+        self._invalidations = 0
+        # A reply may name the files that can be sent, so it is stale once they change
+        config.watch_file(config.info_files_directory, lambda path: self.clear(f"{path} changed"))
+
+    def enabled_for(self, user_id: str) -> bool:
+        return user_id not in self.config.response_cache_opt_out
+
+    def key(self, system_message: Dict, history: Sequence[Dict], new_message: Dict, summary: str = "") -> CacheKey:
+        """
+        Fingerprint of a request
+
+        The summary is part of it: it holds the friend's earlier conversation, so two friends
+        with the same recent messages but different summaries must not share a reply.
+        """
+        depth = self.config.response_cache_context_messages
+        tail = list(history)[-depth:] if depth > 0 else []
+        context = [self.config.model_name, system_message.get("content") or "", summary or "",
+                   [[message.get("role"), normalize_text(message.get("content"))] for message in tail]]
+        digest = hashlib.sha1(json.dumps(context, ensure_ascii=False).encode("utf-8")).hexdigest()
+        return CacheKey(digest, normalize_text(new_message.get("content")))
+
+    def get(self, key: CacheKey) -> _Entry | None:
+        """The cached reply of the request, or None"""
+        similarity = self.config.response_cache_similarity
+        with self._lock:
+            entry = self._live(self._entries.get(key.exact))
+            tier = "exact"
+            if entry == None and similarity > 0 and key.context in self._indexes:
+                candidate, score = self._indexes[key.context].nearest(_vectorize(key.message))
+                if score >= similarity:
+                    entry = self._live(candidate)
+                    tier = "similar"
+            if entry == None:
+                self._misses += 1
+                tracer.count("response_cache_misses")
+                return None
+            self._entries.move_to_end(entry.key.exact)
+            self._hits[tier] += 1
+        tracer.count("response_cache_hits", tier=tier)
+        return entry
+
+    def _live(self, entry: _Entry | None) -> _Entry | None:
+        """entry, unless it has expired (then it is removed)"""
+        if entry == None:
+            return None
+        if time.monotonic() - entry.created > self.config.response_cache_ttl:
+            self._remove(entry)
+            return None
+        return entry
+
+    def cacheable(self, tools_called: Sequence[str]) -> bool:
+        """Whether a reply produced by calling these tools may be replayed"""
+        safe_tools = self.config.response_cache_safe_tools
+        return all(name in safe_tools for name in tools_called)
+
+    def put(self, key: CacheKey, response: Dict, segments: List[str] = ()) -> None:
+        """Store the reply of a request"""
+        if not response.get("content") or not key.message:
+            return
+        vector = _vectorize(key.message) if self.config.response_cache_similarity > 0 else None
+        entry = _Entry({"role": response["role"], "content": response["content"]}, list(segments), key, vector)
+        with self._lock:
+            old = self._entries.get(key.exact)
+            if old != None:
+                self._remove(old)
+            self._entries[key.exact] = entry
+            if vector is not None:
+                self._indexes.setdefault(key.context, _SimilarityIndex()).add(entry)
+            self._stores += 1
+            max_entries = self.config.response_cache_max_entries
+            while len(self._entries) > max_entries:
+                self._remove(next(iter(self._entries.values())))
+                self._evictions += 1
+
+    def _remove(self, entry: _Entry) -> None:
+        del self._entries[entry.key.exact]
+        if entry.vector is not None:
+            index = self._indexes[entry.key.context]
+            index.remove(entry)
+            if not index.entries:
+                del self._indexes[entry.key.context]
+
+    def clear(self, reason: str = "") -> None:
+        """Drop every cached reply, e.g. because the information files changed"""
+        with self._lock:
+            dropped = len(self._entries)
+            self._entries.clear()
+            self._indexes.clear()
+            self._invalidations += 1
+        if dropped:
+            print(f"Response cache cleared ({dropped} replies){': ' + reason if reason else ''}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._hits["exact"] + self._hits["similar"] + self._misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self._hits["exact"],
+                "similar_hits": self._hits["similar"],
+                "misses": self._misses,
+                "hit_rate": (lookups - self._misses) / lookups if lookups else 0.0,
+                "stores": self._stores,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
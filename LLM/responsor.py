@@ -1,17 +1,61 @@
 from config import Config
 from tools.tools_manager import ToolManager
-from openai import OpenAI
-from typing import List, Dict, Any
+from LLM.segmenter import SegmentSplitter
+from LLM.response_cache import ResponseCache
+from LLM.single_flight import SingleFlight
+from LLM.client_pool import ClientPool, Endpoint
+from context.token_counter import create_token_counter
+from typing import List, Dict, Any, Callable, Sequence, Tuple
+import hashlib
 import json
+import threading
+import time
+from tracing import tracer
+
+class RequestCancelled(Exception):
+    """Raised when a request is abandoned through its cancel event"""
+
 
 class Responsor:
     def __init__(self, config: Config):
         self.config=config
         self.tool_manager = ToolManager(config)
-        self.openai_client = OpenAI(api_key=config.openai_key,
-                                    base_url=config.openai_endpoint)
-        self.temp_context = []
-        self.system_prompt: Dict[str,str] = self._load_system_prompt(self.config.system_prompt_path)
+        # Global cap on concurrent API calls, shared by every dispatch worker and the context summarizer
+        self.inflight_limit = threading.BoundedSemaphore(self.config.llm_max_inflight)
+        # Clients of every LLM endpoint (LLM_ENDPOINTS, or OPENAI_ENDPOINT), with hedging and failover;
+        # hedged duplicates take a free slot of the same cap
+        self.client_pool = ClientPool(config, RequestCancelled, self.inflight_limit)
+        # In streaming mode, finished sentences are delivered while the rest is still generated
+        self.stream_response = self.config.stream_response
+        self.token_counter = create_token_counter(self.config)
+        # Identical requests in flight at the same time share one upstream call (LLM_COALESCE)
+        self.single_flight = SingleFlight(RequestCancelled)
+        # Replies to repeated questions, shared between users (RESPONSE_CACHE)
+        self.response_cache = ResponseCache(self.config) if self.config.response_cache else None
+        # Tokens of the tool schemas, counted once
+        self._tools_tokens = self.token_counter.count_text(json.dumps(self.tool_manager.get_tools(), ensure_ascii=False))
+        # Prompt table: user_id (or "default") -> (system message, its tokens), built once per version of the file.
+        # A reload replaces the whole table in one assignment, so a request never sees half of two versions.
+        self._system_messages: Dict[str, Tuple[Dict, int]] = self._build_system_messages(
+            self._load_system_prompt(self.config.system_prompt_path))
+
+    def _read_system_prompt(self, path: str) -> Dict[str,str]:
+        """
+        Read system prompt JSON file
+
+        Args:
+            path: JSON file path
+
+        Returns:
+            System prompt dictionary, with a "default" prompt
+        """
+        with open(path, 'r', encoding='utf-8') as file:
+            system_prompt = json.load(file)
+        if not isinstance(system_prompt, dict):
+            raise ValueError("the system prompt file must contain a JSON object")
+        if "default" not in system_prompt:
+            system_prompt["default"] = "You are an helpful assistant."
+        return system_prompt
 
     def _load_system_prompt(self, path: str) -> Dict[str,str]:
         """
@@ -24,50 +68,310 @@ class Responsor:
             System prompt dictionary
         """
         try:
-            with open(path, 'r', encoding='utf-8') as file:
-                system_prompt = json.load(file)
-                if "default" not in system_prompt:
-                    system_prompt["default"] = "You are an helpful assistant."
-                return system_prompt
+            return self._read_system_prompt(path)
         except:
             return {"default": "You are an helpful assistant."}
 
-    def _send_single_request(self):
-        # print(self.temp_context)
-        response = self.openai_client.chat.completions.create(
-                model=self.config.model_name,
-                messages=self.temp_context,
-                temperature=float(self.config.model_temperature),
-                top_p=float(self.config.model_top_p),
-                stream=False,
-                tools=self.tool_manager.get_tools())
-        
-        return response.choices[0].message
-
-    def send_request(self, user_id: str, new_message: Dict | None, history: List[Dict] = []) -> Dict:
-        # Concatenate historical and new messages and assign them to temp_context
-        self.temp_context=history
-        # If the new message is not None, it means it's the first call, so concatenate the system prompt and then add the new message to the context
-        if new_message != None:
-            if user_id in self.system_prompt:
-                self.temp_context.insert(0,{"role": "system", "content": self.system_prompt[user_id]})
-            else:
-                self.temp_context.insert(0,{"role": "system", "content": self.system_prompt["default"]})
-            self.temp_context.append(new_message)
-        # Send a single request
-        res_message = self._send_single_request()
-        # Check if it's a general message, return if true; if it's a tool call, concatenate responses one by one and resend until a general message is returned
-        # Continue until there are no tool_calls. If it's a general message initially, the while loop won't be entered
-        if res_message.tool_calls != None:
-            # First concatenate the tool_calls response into the context, then execute the tools one by one
-            self.temp_context.append(res_message)
-            for item in res_message.tool_calls:
-                # Execute tools one by one, then concatenate
-                toolname=item.function.name
-                toolargument=json.loads(item.function.arguments.strip())
-                toolargument.update({"user_id": user_id})
-                tool_res = self.tool_manager.execute_tool(toolname, toolargument)
-                self.temp_context.append({"role": "tool", "content": tool_res,"tool_call_id": item.id})
-            # Recursively call send_request to prevent the LLM from needing to call tools again after submitting the tools.
-            return self.send_request(user_id, None, self.temp_context)
-        return {"role":res_message.role, "content":res_message.content}
\ No newline at end of file
+    def _build_system_messages(self, system_prompt: Dict[str,str]) -> Dict[str, Tuple[Dict, int]]:
+        table = {}
+        for user_id, prompt in system_prompt.items():
+            message = {"role": "system", "content": prompt}
+            table[user_id] = (message, self.token_counter.count_message(message))
+        return table
+
+    def reload_system_prompt(self, path: str | None = None) -> bool:
+        """
+        Re-read the system prompt file and swap in the new prompts
+
+        Turns already being processed finish with the prompt they started with.
+        An unreadable or invalid file is reported and the current prompts are kept.
+
+        Returns:
+            Whether the new prompts were applied
+        """
+        path = path or self.config.system_prompt_path
+        try:
+            system_prompt = self._read_system_prompt(path)
+        except (OSError, ValueError) as e:
+            print(f"System prompts not reloaded from {path}: {e}")
+            return False
+        self._system_messages = self._build_system_messages(system_prompt)
+        if self.response_cache != None:
+            self.response_cache.clear("system prompts changed")
+        print(f"System prompts reloaded from {path}: {len(system_prompt)} prompts")
+        return True
+
+    def _get_system_entry(self, user_id: str) -> Tuple[Dict, int]:
+        table = self._system_messages
+        entry = table.get(user_id)
+        return entry if entry != None else table["default"]
+
+    def _get_system_message(self, user_id: str) -> Dict:
+        # The cached message is shared by every request of the user and must not be modified
+        return self._get_system_entry(user_id)[0]
+
+    def _get_summary_message(self, summary: str) -> Dict:
+        return {"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}
+
+    def count_reserved_tokens(self, user_id: str, new_message: Dict, summary: str = "") -> int:
+        """
+        Tokens of a request that are not history: system prompt, summary, tool schemas and the new message
+
+        ContextManager.get subtracts them from the token budget before trimming the history.
+        """
+        reserved = self._get_system_entry(user_id)[1] + self._tools_tokens + self.token_counter.count_message(new_message)
+        if summary:
+            reserved += self.token_counter.count_message(self._get_summary_message(summary))
+        return reserved
+
+    def _send_single_request(self, messages: List[Dict], on_segment: Callable[[str], None] | None = None,
+                             allow_tools: bool = True, cancel_event: threading.Event | None = None,
+                             usage: Dict[str, int] | None = None) -> Dict:
+        """
+        Send one completion request, sharing it with identical requests already in flight
+
+        When the same prompt reaches many chats at once (a group broadcast, a forwarded
+        message), only the first request goes upstream and the others wait for its answer.
+        Token usage is accounted to the request that was sent. Arguments and result are
+        those of _request_completion.
+        """
+        if not self.config.llm_coalesce:
+            return self._request_completion(messages, on_segment, allow_tools, cancel_event, usage)
+        settings = self.config.snapshot()
+        key = hashlib.sha1(json.dumps([settings.model_name, settings.model_temperature, settings.model_top_p,
+                                       self.stream_response, allow_tools, messages],
+                                      ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        return self.single_flight.run(
+            key, lambda publish, flight_cancel: self._request_completion(messages, publish, allow_tools,
+                                                                         flight_cancel, usage),
+            on_segment, cancel_event)
+
+    def _request_completion(self, messages: List[Dict], on_segment: Callable[[str], None] | None = None,
+                            allow_tools: bool = True, cancel_event: threading.Event | None = None,
+                            usage: Dict[str, int] | None = None) -> Dict:
+        """
+        Send one completion request
+
+        Args:
+            messages: Request messages
+            on_segment: Called with every finished text segment while the answer is streamed; must not block,
+                        the LLM_MAX_INFLIGHT slot is held meanwhile
+            allow_tools: If False, the model is told not to call any tool
+            cancel_event: When set, a streamed answer is abandoned and RequestCancelled is raised
+            usage: Token usage of the request is added to "prompt_tokens" and "completion_tokens"; of a hedged
+                   request, only the usage of the attempt that won
+
+        Returns:
+            The assistant message as a dictionary, with "tool_calls" if the model called tools
+        """
+        # print(messages)
+        wait_start = time.perf_counter()
+        with self.inflight_limit:
+            # Time spent waiting for a free LLM_MAX_INFLIGHT slot
+            tracer.record("llm_queue", time.perf_counter() - wait_start)
+            if cancel_event != None and cancel_event.is_set():
+                raise RequestCancelled()
+            tracer.count("llm_requests", stream=str(self.stream_response).lower())
+            # Model settings may be changed in .env while the bot runs; use one consistent version
+            settings = self.config.snapshot()
+
+            def attempt(endpoint: Endpoint, attempt_segment: Callable[[str], None], attempt_cancel) -> tuple:
+                # Runs once per endpoint tried; attempt_cancel is set when another endpoint answered first.
+                # Usage is returned with the answer, so that only the winning attempt is accounted
+                attempt_usage = {}
+                response = endpoint.client.chat.completions.create(
+                        model=endpoint.model or settings.model_name,
+                        messages=messages,
+                        temperature=settings.model_temperature,
+                        top_p=settings.model_top_p,
+                        stream=self.stream_response,
+                        tools=self.tool_manager.get_tools(),
+                        tool_choice="auto" if allow_tools else "none")
+                if self.stream_response:
+                    result = self._consume_stream(response, messages, attempt_segment, attempt_cancel, attempt_usage)
+                else:
+                    result = self._parse_completion(response, attempt_usage)
+                return result, attempt_usage
+
+            with tracer.span("llm"):
+                result, attempt_usage = self.client_pool.request(attempt, on_segment, cancel_event)
+            if attempt_usage:
+                self._add_usage(usage, attempt_usage["prompt_tokens"], attempt_usage["completion_tokens"])
+            return result
+
+    def _parse_completion(self, response, usage: Dict[str, int]) -> Dict:
+        """The assistant message of a non-streamed completion; its token usage is stored in usage"""
+        if response.usage != None:
+            usage.update(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+        res_message = response.choices[0].message
+        result = {"role": res_message.role, "content": res_message.content}
+        if res_message.tool_calls:
+            result["tool_calls"] = [{"id": item.id,
+                                     "type": "function",
+                                     "function": {"name": item.function.name, "arguments": item.function.arguments}}
+                                    for item in res_message.tool_calls]
+        return result
+
+    @staticmethod
+    def _add_usage(usage: Dict[str, int] | None, prompt_tokens: int, completion_tokens: int) -> None:
+        """Account the token usage of a response to the caller's usage dictionary and the metrics"""
+        tracer.add_usage(prompt_tokens, completion_tokens)
+        if usage != None:
+            usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + prompt_tokens
+            usage["completion_tokens"] = usage.get("completion_tokens", 0) + completion_tokens
+
+    def _consume_stream(self, stream, messages: List[Dict], on_segment: Callable[[str], None] | None,
+                        cancel_event: threading.Event | None, usage: Dict[str, int]) -> Dict:
+        """
+        Assemble a streamed completion, handing finished segments to on_segment as they complete;
+        its token usage is stored in usage
+        """
+        splitter = SegmentSplitter(self.config.stream_min_segment_length)
+        start = time.perf_counter()
+        content_parts = []
+        reported_usage = None
+        # Tool call deltas arrive in pieces and are keyed by their index
+        tool_calls: Dict[int, Dict] = {}
+        try:
+            for chunk in stream:
+                if cancel_event != None and cancel_event.is_set():
+                    raise RequestCancelled()
+                if getattr(chunk, "usage", None) != None:
+                    reported_usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    if not content_parts:
+                        tracer.record("llm_first_token", time.perf_counter() - start)
+                    content_parts.append(delta.content)
+                    for segment in splitter.feed(delta.content):
+                        if on_segment != None:
+                            on_segment(segment)
+                for item in delta.tool_calls or []:
+                    call = tool_calls.setdefault(item.index, {"id": "", "type": "function",
+                                                              "function": {"name": "", "arguments": ""}})
+                    if item.id:
+                        call["id"] = item.id
+                    if item.function != None:
+                        call["function"]["name"] += item.function.name or ""
+                        call["function"]["arguments"] += item.function.arguments or ""
+        finally:
+            # Closing the response stops the generation we no longer read
+            stream.close()
+        if reported_usage != None:
+            usage.update(prompt_tokens=reported_usage.prompt_tokens, completion_tokens=reported_usage.completion_tokens)
+        else:
+            # Most endpoints do not report usage when streaming, estimate it
+            usage.update(prompt_tokens=sum(self.token_counter.count_message(message) for message in messages),
+                         completion_tokens=self.token_counter.count_text("".join(content_parts)))
+        for segment in splitter.flush():
+            if on_segment != None:
+                on_segment(segment)
+
+        result = {"role": "assistant", "content": "".join(content_parts) or None}
+        if tool_calls:
+            result["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+        return result
+
+    def send_request(self, user_id: str, new_message: Dict, history: Sequence[Dict] = (),
+                     on_segment: Callable[[str], None] | None = None, summary: str = "",
+                     cancel_event: threading.Event | None = None, usage: Dict[str, int] | None = None,
+                     stop_at_tools: bool = False) -> Dict | None:
+        """
+        Request a reply to new_message
+
+        Args:
+            user_id: Friend the reply is for
+            new_message: The debounced user message
+            history: Previous messages, read-only and not modified
+            on_segment: In streaming mode, called with every finished segment of the reply as soon as it is complete.
+                        It runs while an LLM_MAX_INFLIGHT slot is held, so it must hand the segment over
+                        (e.g. to the outbound queue) without waiting for it to be sent
+            summary: Running summary of the conversation before history, inserted after the system prompt
+            cancel_event: When set, the request is abandoned and RequestCancelled is raised
+            usage: Receives the token usage of every request of the turn
+            stop_at_tools: Return None instead of executing tools, e.g. for speculative requests that must not have side effects
+
+        Returns:
+            The final assistant message. In streaming mode its content holds every segment delivered during the turn.
+        """
+        # Build a request-local message list: the system prompt, the history and the new message.
+        # Nothing is stored on self, so concurrent users never share a prompt, and history is not modified.
+        messages = [self._get_system_message(user_id)]
+        if summary:
+            messages.append(self._get_summary_message(summary))
+        messages.extend(history)
+        messages.append(new_message)
+        if self.response_cache == None or not self.response_cache.enabled_for(user_id):
+            return self._resolve(user_id, messages, on_segment, cancel_event, usage, stop_at_tools)
+
+        cache_key = self.response_cache.key(messages[0], history, new_message, summary)
+        cached = self.response_cache.get(cache_key)
+        if cached != None:
+            if self.stream_response and on_segment != None:
+                for segment in cached.segments:
+                    on_segment(segment)
+            return dict(cached.response)
+        # Segments are recorded so that a hit is delivered the same way
+        segments: List[str] = []
+
+        def record_segment(segment: str) -> None:
+            segments.append(segment)
+            if on_segment != None:
+                on_segment(segment)
+
+        tools_called: List[str] = []
+        response = self._resolve(user_id, messages, record_segment, cancel_event, usage, stop_at_tools, tools_called)
+        # A turn that called a tool with side effects (e.g. send_a_file) must not be replayed
+        if response != None and self.response_cache.cacheable(tools_called):
+            self.response_cache.put(cache_key, response, segments)
+        return response
+
+    def _resolve(self, user_id: str, messages: List[Dict], on_segment: Callable[[str], None] | None,
+                 cancel_event: threading.Event | None, usage: Dict[str, int] | None, stop_at_tools: bool,
+                 tools_called: List[str] | None = None) -> Dict | None:
+        # When streaming, text produced before a tool call has already reached the user
+        delivered: List[str] = []
+        rounds = 0
+        while True:
+            # Once the tool round limit is reached, the model must answer without calling more tools
+            allow_tools = rounds < self.config.max_tool_rounds
+            res_message = self._send_single_request(messages, on_segment, allow_tools, cancel_event, usage)
+            if self.stream_response and res_message["content"]:
+                delivered.append(res_message["content"])
+            # Check if it's a general message, return if true; if it's a tool call, execute the tools and resend until a general message is returned
+            if "tool_calls" not in res_message or not allow_tools:
+                break
+            if stop_at_tools:
+                return None
+            rounds += 1
+            # First concatenate the tool_calls response into the context, then execute all tools of this message concurrently
+            messages.append(res_message)
+            calls = []
+            for item in res_message["tool_calls"]:
+                try:
+                    toolargument = json.loads(item["function"]["arguments"].strip() or "{}")
+                except json.JSONDecodeError:
+                    toolargument = None
+                calls.append((item["function"]["name"], toolargument))
+                if tools_called != None:
+                    tools_called.append(item["function"]["name"])
+            runnable = [(name, dict(arguments, user_id=user_id)) for name, arguments in calls if arguments != None]
+            tool_results = iter(self.tool_manager.execute_tools(runnable))
+            # Results come back in call order, so each one is matched to its tool_call_id
+            for item, (toolname, toolargument) in zip(res_message["tool_calls"], calls):
+                if toolargument == None:
+                    tool_res = f"Error executing tool: invalid arguments for '{toolname}'"
+                else:
+                    tool_res = next(tool_results)
+                messages.append({"role": "tool", "content": str(tool_res), "tool_call_id": item["id"]})
+        if self.stream_response:
+            content = "\n\n".join(delivered)
+        else:
+            content = res_message["content"] or ""
+        if not content:
+            # E.g. the model still asked for tools after the round limit; content is a string in any case,
+            # so the segmenter and the history never receive None
+            print(f"Empty reply for {user_id} after {rounds} tool rounds")
+        return {"role": res_message["role"], "content": content}
@@ -0,0 +1,69 @@
+from typing import List
+
+# Characters ending a sentence. CJK punctuation ends a sentence by itself, latin
+# punctuation only when followed by whitespace (so "3.14" or "e.g." stay intact).
+CJK_SENTENCE_ENDINGS = "。！？；…"
+LATIN_SENTENCE_ENDINGS = ".!?;"
+
+
+class SegmentSplitter:
+    """
+    Split a token stream into segments that can be sent as separate WeChat messages
+
+    Text is cut at paragraph breaks and sentence endings. Sentences shorter than
+    min_length are merged with the following ones so the user is not flooded with
+    tiny messages; a paragraph break always ends the current segment.
+    """
+
+    def __init__(self, min_length: int = 20) -> None:
+        self.min_length = min_length
+        self._buffer = ""
+        # Position in _buffer up to which boundaries have already been searched
+        self._scanned = 0
+
+    def feed(self, text: str) -> List[str]:
+        """
+        Add streamed text
+
+        Args:
+            text: Newly received content delta
+
+        Returns:
+            Segments completed by this delta, in order
+        """
+        self._buffer += text
+        segments = []
+        start = 0
+        position = max(self._scanned, 0)
+        while position < len(self._buffer):
+            char = self._buffer[position]
+            end = -1
+            if char == "\n" and position + 1 < len(self._buffer) and self._buffer[position + 1] == "\n":
+                # Paragraph break: always flush
+                end = position + 2
+                candidate = self._buffer[start:end].strip()
+                if candidate:
+                    segments.append(candidate)
+                start = end
+                position = end
+                continue
+            if char in CJK_SENTENCE_ENDINGS:
+                end = position + 1
+            elif char in LATIN_SENTENCE_ENDINGS and position + 1 < len(self._buffer) and self._buffer[position + 1].isspace():
+                end = position + 1
+            if end != -1 and len(self._buffer[start:end].strip()) >= self.min_length:
+                segments.append(self._buffer[start:end].strip())
+                start = end
+            position += 1
+
+        self._buffer = self._buffer[start:]
+        # The last character may still become a boundary once the next delta arrives
+        self._scanned = max(0, len(self._buffer) - 1)
+        return segments
+
+    def flush(self) -> List[str]:
+        """Return the remaining text as the final segment once the stream has ended"""
+        remaining = self._buffer.strip()
+        self._buffer = ""
+        self._scanned = 0
+        return [remaining] if remaining else []
@@ -0,0 +1,139 @@
+import copy
+import threading
+from typing import Any, Callable, Dict, Hashable, List
+
+from tracing import tracer
+
+
+class _Flight:
+    """One upstream call and everything it has produced so far"""
+    __slots__ = ("condition", "segments", "result", "error", "finished", "cancel_events")
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        # Cancel events of the leader and the waiters; None for a caller that cannot be cancelled
+        self.cancel_events: List[threading.Event | None] = []
+        # Streamed segments in order, replayed to every waiter
+        self.segments: List[str] = []
+        self.result: Any = None
+        self.error: BaseException | None = None
+        self.finished = False
+
+    def publish(self, segment: str) -> None:
+        with self.condition:
+            self.segments.append(segment)
+            self.condition.notify_all()
+
+    def is_set(self) -> bool:
+        """The upstream call is abandoned only once every caller has been cancelled"""
+        return all(event != None and event.is_set() for event in list(self.cancel_events))
+
+    def finish(self, result: Any = None, error: BaseException | None = None) -> None:
+        with self.condition:
+            self.result = result
+            self.error = error
+            self.finished = True
+            self.condition.notify_all()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one upstream call.
+
+    The first caller of a key (the leader) runs the call; callers arriving while it
+    is in flight wait for it and receive a copy of its result, or its exception.
+    Segments the leader publishes while streaming are handed to every waiter's own
+    on_segment as they arrive, on the waiter's thread. The call is abandoned only when
+    every caller's cancel event is set; until then a cancelled caller just stops
+    waiting and raises cancelled_error, and the others still get the result.
+    """
+
+    def __init__(self, cancelled_error: type = Exception) -> None:
+        self.cancelled_error = cancelled_error
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._upstream = 0
+        self._coalesced = 0
+
+    def run(self, key: Hashable, call: Callable[[Callable[[str], None], Any], Any],
+            on_segment: Callable[[str], None] | None = None,
+            cancel_event: threading.Event | None = None) -> Any:
+        """
+        Run call, or wait for the identical call already in flight
+
+        Args:
+            key: Fingerprint of the call
+            call: Performs the upstream call; receives the callback its streamed segments go to, and
+                  an object whose is_set() tells whether every caller has been cancelled
+            on_segment: Receives the streamed segments of the call
+            cancel_event: When set, stop waiting and raise cancelled_error
+
+        Returns:
+            The result of call (a copy for waiters)
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight == None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                    self._upstream += 1
+                else:
+                    self._coalesced += 1
+                flight.cancel_events.append(cancel_event)
+            if leader:
+                return self._lead(key, flight, call, on_segment)
+            tracer.count("llm_coalesced")
+            try:
+                return self._follow(flight, on_segment, cancel_event)
+            except self.cancelled_error:
+                if cancel_event != None and cancel_event.is_set():
+                    raise
+                # The call was abandoned just before this caller joined: try again
+
+    def _lead(self, key: Hashable, flight: _Flight, call: Callable[[Callable[[str], None], Any], Any],
+              on_segment: Callable[[str], None] | None) -> Any:
+        def publish(segment: str) -> None:
+            flight.publish(segment)
+            if on_segment != None:
+                on_segment(segment)
+
+        try:
+            result = call(publish, flight)
+        except BaseException as e:
+            flight.finish(error=e)
+            raise
+        finally:
+            # Later callers start a new flight
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+        flight.finish(result=result)
+        return result
+
+    def _follow(self, flight: _Flight, on_segment: Callable[[str], None] | None,
+                cancel_event: threading.Event | None) -> Any:
+        delivered = 0
+        while True:
+            with flight.condition:
+                while len(flight.segments) == delivered and not flight.finished:
+                    if cancel_event != None and cancel_event.is_set():
+                        raise self.cancelled_error()
+                    flight.condition.wait(0.1)
+                segments = flight.segments[delivered:]
+                finished = flight.finished
+            # Segments are delivered outside the condition, so a slow receiver does not block the leader
+            for segment in segments:
+                if on_segment != None:
+                    on_segment(segment)
+            delivered += len(segments)
+            if finished and delivered == len(flight.segments):
+                break
+        if flight.error != None:
+            raise flight.error
+        return copy.deepcopy(flight.result)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"upstream_calls": self._upstream, "coalesced_calls": self._coalesced,
+                    "in_flight": len(self._flights)}
@@ -0,0 +1,148 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from config import Config
+
+
+class _Speculation:
+    """One speculative reply in flight"""
+    __slots__ = ("message", "future", "cancel_event", "start_time", "end_time", "sealed_time", "segments", "usage")
+
+    def __init__(self, message: Dict) -> None:
+        self.message = message
+        self.future: Future | None = None
+        self.cancel_event = threading.Event()
+        self.start_time = time.monotonic()
+        self.end_time: float | None = None
+        self.sealed_time: float | None = None
+        # Streamed segments are held back until the speculation is committed
+        self.segments: List[str] = []
+        # Token usage reported by the run, used to account wasted tokens
+        self.usage: Dict[str, int] = {}
+
+
+class SpeculationManager:
+    """
+    Speculative LLM requests during the debounce window.
+
+    After SPECULATIVE_IDLE_THRESHOLD seconds without a new message, DebouncePool
+    starts a request on the messages buffered so far. If the flush happens with the
+    same messages, the speculation is sealed and the reply is taken over by the turn
+    (it may already be complete); if another message arrives first, the speculative
+    request is cancelled and its result is never sent nor written to the context.
+
+    The run callable must not deliver anything or touch the context itself: it
+    receives the message, a cancel event, a list collecting the streamed segments
+    and a usage dictionary, and returns the reply, or None if it could not be
+    completed speculatively (e.g. the model wants to call a tool).
+    """
+
+    def __init__(self, config: Config,
+                 run: Callable[[str, Dict, threading.Event, List[str], Dict[str, int]], Dict | None],
+                 can_speculate: Callable[[str], bool] = lambda user_id: True) -> None:
+        self.idle_threshold = config.speculative_idle_threshold
+        self.run = run
+        # e.g. the user still has a turn in progress, so the history is not final yet
+        self.can_speculate = can_speculate
+        self._executor = ThreadPoolExecutor(max_workers=config.speculative_workers,
+                                            thread_name_prefix="speculative-worker")
+        self._lock = threading.Lock()
+        # Open speculations, cancelled by the next message of the user
+        self._speculations: Dict[str, _Speculation] = {}
+        # Speculations whose messages were flushed, waiting for the turn to take them
+        self._sealed: Dict[str, _Speculation] = {}
+        self._hits = 0
+        self._misses = 0
+        self._aborted = 0
+        self._wasted_tokens = 0
+        self._latency_saved = 0.0
+
+    def start(self, user_id: str, message: Dict) -> None:
+        """Start a speculative reply to message, replacing any previous speculation of the user"""
+        if not self.can_speculate(user_id):
+            return
+        self.cancel(user_id)
+        speculation = _Speculation(message)
+        with self._lock:
+            self._speculations[user_id] = speculation
+        speculation.future = self._executor.submit(self.run, user_id, message, speculation.cancel_event,
+                                                   speculation.segments, speculation.usage)
+        speculation.future.add_done_callback(lambda _: setattr(speculation, "end_time", time.monotonic()))
+
+    def cancel(self, user_id: str) -> None:
+        """Cancel the user's open speculation, e.g. because a new message arrived"""
+        with self._lock:
+            speculation = self._speculations.pop(user_id, None)
+            if speculation == None:
+                return
+            self._misses += 1
+        speculation.cancel_event.set()
+        speculation.future.add_done_callback(lambda _: self._add_wasted_tokens(speculation.usage))
+
+    def seal(self, user_id: str, message: Dict) -> None:
+        """
+        Called when the user's messages are flushed: keep the speculation for take() if it
+        was made on exactly this message, otherwise cancel it. A sealed speculation is no
+        longer cancelled by new messages; one sealed for an earlier flush is discarded.
+        """
+        self.discard(user_id)
+        with self._lock:
+            speculation = self._speculations.get(user_id)
+            if speculation == None or speculation.message["content"] != message["content"]:
+                speculation = None
+            else:
+                speculation.sealed_time = time.monotonic()
+                self._sealed[user_id] = self._speculations.pop(user_id)
+        if speculation == None:
+            self.cancel(user_id)
+
+    def discard(self, user_id: str) -> None:
+        """Drop the user's sealed speculation, e.g. because its turn was shed or merged into another"""
+        with self._lock:
+            speculation = self._sealed.pop(user_id, None)
+            if speculation == None:
+                return
+            self._misses += 1
+        speculation.cancel_event.set()
+        speculation.future.add_done_callback(lambda _: self._add_wasted_tokens(speculation.usage))
+
+    def take(self, user_id: str) -> Tuple[Dict, List[str]] | None:
+        """
+        Wait for the sealed speculation of the user
+
+        Returns:
+            (reply, held back segments) if the speculative request succeeded, otherwise None
+        """
+        with self._lock:
+            speculation = self._sealed.pop(user_id, None)
+        if speculation == None:
+            return None
+
+        try:
+            reply = speculation.future.result()
+        except Exception as e:
+            print(f"Speculative request of {user_id} failed: {e}")
+            reply = None
+        with self._lock:
+            if reply == None:
+                self._aborted += 1
+                self._wasted_tokens += sum(speculation.usage.values())
+                return None
+            self._hits += 1
+            # Time the reply had already been generating before the flush
+            self._latency_saved += min(speculation.sealed_time, speculation.end_time or speculation.sealed_time) - speculation.start_time
+        return reply, speculation.segments
+
+    def _add_wasted_tokens(self, usage: Dict[str, int]) -> None:
+        with self._lock:
+            self._wasted_tokens += sum(usage.values())
+
+    def stats(self) -> Dict[str, float]:
+        """Hit rate, wasted tokens and total latency saved (seconds)"""
+        with self._lock:
+            finished = self._hits + self._misses + self._aborted
+            return {"hits": self._hits, "misses": self._misses, "aborted": self._aborted,
+                    "hit_rate": self._hits / finished if finished else 0.0,
+                    "wasted_tokens": self._wasted_tokens, "latency_saved": self._latency_saved}
@@ -0,0 +1,92 @@
+"""
+Cold-load benchmark for FileManager
+
+Compares the latency of loading the latest messages of a user that is not in the
+cache, for the legacy format (one JSON array parsed with json.load, then sliced),
+the JSONL log read backwards from the end of the file, and the SQLite backend
+(an indexed (user_id, seq) range scan, with --users histories in the database).
+
+Usage:
+    python -m bench.bench_cold_load [--messages 10000] [--tail 50] [--repeat 20] [--users 1000]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context.file_manager import FileManager, StorageDirConfig
+from context.sqlite_storage import SQLiteStorage
+
+
+def _make_history(count: int):
+    return [{"role": "user" if i % 2 == 0 else "assistant",
+             "content": f"Message {i}: " + "lorem ipsum dolor sit amet " * 8}
+            for i in range(count)]
+
+
+def _legacy_load(path: str, tail: int):
+    """The loader used before the JSONL format: parse everything, keep the tail"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data[-tail:]
+
+
+def _measure(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000, help="Length of the history")
+    parser.add_argument("--tail", type=int, default=50, help="Number of messages loaded")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of measured loads")
+    parser.add_argument("--users", type=int, default=1000, help="Other users stored in the SQLite database")
+    args = parser.parse_args()
+
+    storage_dir = tempfile.mkdtemp()
+    try:
+        file_manager = FileManager(StorageDirConfig(storage_dir))
+        history = _make_history(args.messages)
+
+        legacy_path = os.path.join(storage_dir, "legacy.json")
+        with open(legacy_path, 'w', encoding='utf-8') as f:
+            json.dump(history, f, ensure_ascii=False, indent=2)
+        file_manager.save_context("user", history)
+
+        database = SQLiteStorage(os.path.join(storage_dir, "history.db"))
+        database.save_context("user", history)
+        for index in range(args.users):
+            database.save_context(f"other{index}", history[:20])
+
+        assert _legacy_load(legacy_path, args.tail) == file_manager.load_context("user")[-args.tail:]
+        assert database.load_context("user")[-args.tail:] == file_manager.load_context("user")[-args.tail:]
+        results = {
+            "legacy json.load": _measure(lambda: _legacy_load(legacy_path, args.tail), args.repeat),
+            "jsonl tail read": _measure(lambda: file_manager.load_records("user", args.tail), args.repeat),
+            "sqlite tail read": _measure(lambda: database.load_records("user", args.tail), args.repeat),
+        }
+        database.close()
+
+        print(f"Cold load of the last {args.tail} of {args.messages} messages ({args.repeat} runs)")
+        for name, timings in results.items():
+            print(f"  {name:<18} median {statistics.median(timings):8.3f} ms   "
+                  f"min {min(timings):8.3f} ms   max {max(timings):8.3f} ms")
+        speedup = statistics.median(results["legacy json.load"]) / statistics.median(results["jsonl tail read"])
+        print(f"  speedup: {speedup:.1f}x")
+    finally:
+        shutil.rmtree(storage_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Debounce policy simulation
+
+Replays message timings through each debounce policy on a virtual clock and
+compares the reply latency (time from the last message of a flush to the flush)
+and how often a burst of messages meant as one turn is split over several flushes.
+
+Timings are read from a JSONL file with one message per line:
+    {"user_id": "alice", "ts": 1700000000.0, "burst": 12}
+"burst" labels the turn the message belongs to; without it, messages closer than
+--burst-gap seconds are assumed to belong to the same burst. Without --timings,
+a synthetic population of single-message senders and multi-part senders is used.
+
+Usage:
+    python -m bench.bench_debounce_policy [--timings FILE] [--max-wait 5] [--threshold 10]
+                                          [--users 200] [--seed 1]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from LLM.debounce_policy import AdaptiveDebouncePolicy, FixedDebouncePolicy
+
+# (timestamp, burst id) of every message of a user, in order
+Timings = Dict[str, List[Tuple[float, int]]]
+
+
+def _synthetic_timings(users: int, seed: int) -> Timings:
+    """Half the users send single messages, the others send bursts of 2-6 parts with their own cadence"""
+    rng = random.Random(seed)
+    timings: Timings = {}
+    burst = 0
+    for index in range(users):
+        multipart = index % 2 == 1
+        # Typical gap between two parts of a burst of this user
+        cadence = rng.uniform(0.8, 3.5)
+        now = 0.0
+        messages = []
+        for _ in range(40):
+            now += rng.uniform(20, 300)
+            parts = rng.randint(2, 6) if multipart else (1 if rng.random() > 0.1 else 2)
+            for part in range(parts):
+                if part > 0:
+                    now += rng.lognormvariate(0, 0.35) * cadence
+                messages.append((now, burst))
+            burst += 1
+        timings[f"user{index}"] = messages
+    return timings
+
+
+def _load_timings(path: str, burst_gap: float) -> Timings:
+    rows: Dict[str, List[Tuple[float, int | None]]] = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                rows.setdefault(record["user_id"], []).append((float(record["ts"]), record.get("burst")))
+    timings: Timings = {}
+    burst = 0
+    for user_id, messages in rows.items():
+        messages.sort(key=lambda item: item[0])
+        labelled = []
+        previous = None
+        for ts, label in messages:
+            if label != None:
+                labelled.append((ts, hash((user_id, label))))
+                continue
+            if previous != None and ts - previous > burst_gap:
+                burst += 1
+            labelled.append((ts, burst))
+            previous = ts
+        burst += 1
+        timings[user_id] = labelled
+    return timings
+
+
+def simulate(policy, timings: Timings, threshold: int) -> Dict[str, float]:
+    """Replay the timings through a policy, flushing exactly like DebouncePool does"""
+    latencies: List[float] = []
+    flushes_per_burst: Dict[Tuple[str, int], int] = {}
+    flushes = 0
+    for user_id, messages in timings.items():
+        pending: List[Tuple[float, int]] = []
+        deadline = 0.0
+
+        def flush(at: float) -> None:
+            nonlocal flushes
+            flushes += 1
+            latencies.append(at - pending[-1][0])
+            for burst in {burst for _, burst in pending}:
+                flushes_per_burst[(user_id, burst)] = flushes_per_burst.get((user_id, burst), 0) + 1
+            pending.clear()
+
+        for ts, burst in messages:
+            if pending and deadline <= ts:
+                flush(deadline)
+            policy.observe(user_id, ts)
+            pending.append((ts, burst))
+            deadline = ts + policy.wait_duration(user_id)
+            if len(pending) >= threshold:
+                flush(ts)
+        if pending:
+            flush(deadline)
+
+    split = sum(1 for count in flushes_per_burst.values() if count > 1)
+    latencies.sort()
+    return {"flushes": flushes,
+            "median": statistics.median(latencies),
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "split_rate": split / len(flushes_per_burst)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timings", help="JSONL file of recorded message timings")
+    parser.add_argument("--burst-gap", type=float, default=10, help="Gap ending an unlabelled burst (seconds)")
+    parser.add_argument("--max-wait", type=float, default=5, help="MAX_WAIT_DURATION")
+    parser.add_argument("--min-wait", type=float, default=0.5, help="DEBOUNCE_MIN_WAIT")
+    parser.add_argument("--threshold", type=int, default=10, help="DEBOUNCE_THRESHOLD")
+    parser.add_argument("--users", type=int, default=200, help="Synthetic users")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic timings")
+    args = parser.parse_args()
+
+    if args.timings:
+        timings = _load_timings(args.timings, args.burst_gap)
+    else:
+        timings = _synthetic_timings(args.users, args.seed)
+    policies = {
+        "fixed": FixedDebouncePolicy(args.max_wait),
+        "adaptive": AdaptiveDebouncePolicy(args.max_wait, min_wait=args.min_wait),
+    }
+
+    print(f"{sum(len(messages) for messages in timings.values())} messages of {len(timings)} users, "
+          f"max wait {args.max_wait}s, threshold {args.threshold}")
+    for name, policy in policies.items():
+        result = simulate(policy, timings, args.threshold)
+        print(f"  {name:<9} flushes {result['flushes']:6d}   median latency {result['median']:6.2f} s   "
+              f"p95 latency {result['p95']:6.2f} s   bursts split {result['split_rate'] * 100:5.1f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+End-to-end load benchmark of WechatBot
+
+Drives N simulated friends through the whole bot - WechatClient, DebouncePool,
+RequestDispatcher, ContextManager, Responsor and the outbound queue - with an
+in-process fake WeChat (bench/fake_wechat.py) and a local OpenAI-compatible stub
+endpoint (bench/stub_openai.py). Every friend sends bursts of messages and waits
+for the reply before the next burst.
+
+Reported: messages/sec and turns/sec, p50/p95/p99 latency of every stage of a
+turn, peak thread count and peak RSS.
+
+Stages of a turn:
+    debounce  last message of the burst -> flush by DebouncePool
+    queue     flush -> a dispatch worker starts the turn
+    context   turn start -> history loaded by ContextManager
+    llm       Responsor.send_request, including tool rounds
+    first     start of send_request -> first streamed segment (streaming only)
+    deliver   end of send_request -> turn finished (context append, sending)
+    reply     last message of the burst -> first message sent back
+    total     last message of the burst -> turn finished
+
+Usage:
+    python -m bench.bench_load [--users 50] [--rounds 5] [--burst 3] [--gap 0.05] [--think 0.2]
+                               [--latency 0.2] [--token-delay 0.005] [--stream] [--tool-rate 0.2] [--broadcast]
+                               [--media-rate 0.1]
+                               [--set KEY=VALUE ...]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from bench import fake_wechat
+# wxauto must be replaced before wechat_client creates its WeChat() instance
+fake_wechat.install()
+
+from bench.stub_openai import StubOpenAIServer, StubSettings
+from config import Config
+from wechat_client import WechatClient
+from wechat_bot import WechatBot
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ("debounce", "queue", "context", "llm", "first", "deliver", "reply", "total")
+
+
+def _write_config(directory: str, endpoint: str, users: List[str], overrides: Dict[str, str]) -> Config:
+    friend_file = os.path.join(directory, "listen_friendname.txt")
+    with open(friend_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(users))
+    settings = {
+        "OPENAI_KEY": "sk-bench",
+        "OPENAI_ENDPOINT": endpoint,
+        "MODEL_NAME": "bench-model",
+        "MODEL_TEMPERATURE": "1.0",
+        "MODEL_TOP_P": "0.95",
+        "SYSTEM_PROMPT_PATH": os.path.join(REPO_DIR, "system_prompt.json"),
+        "TOOLS_DESCRIPTION_PATH": os.path.join(REPO_DIR, "tools_descriptions.json"),
+        "TOOLS_IMPLEMENTATION_PATH": os.path.join(REPO_DIR, "tools_implementations.py"),
+        "CONTEXT_WINDOW_LENGTH": "10",
+        "CONTEXT_STAY_DURATION": "30",
+        "CONTEXT_STORAGE_DIR": os.path.join(directory, "chat_history"),
+        "DEBOUNCE_THRESHOLD": "10",
+        "MAX_WAIT_DURATION": "0.3",
+        "FILE_DOWNLOAD_DIR": os.path.join(directory, "downloads"),
+        "INFO_FILES_DIRECTORY": os.path.join(directory, "files"),
+        "LISTEN_FRIENDNAME_FILE": friend_file,
+        # Do not let WeChat's rate limit hide the bot's own throughput
+        "OUTBOUND_RATE": "1000",
+        "OUTBOUND_BURST": "1000",
+    }
+    settings.update(overrides)
+    path = os.path.join(directory, ".env")
+    with open(path, "w", encoding="utf-8") as f:
+        for key, value in settings.items():
+            f.write(f"{key} = {value}\n")
+    return Config(path)
+
+
+class _TurnRecorder:
+    """Timestamps of the turn in progress of every friend, collected by wrapping the bot's stages"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.current: Dict[str, Dict[str, float]] = {}
+        self.done: Dict[str, threading.Event] = {}
+        self.stages: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+        self.turns = 0
+
+    def begin(self, user_id: str, last_message: float) -> threading.Event:
+        with self.lock:
+            self.current[user_id] = {"last_message": last_message}
+            self.done[user_id] = threading.Event()
+            return self.done[user_id]
+
+    def mark(self, user_id: str, name: str) -> None:
+        now = time.monotonic()
+        with self.lock:
+            turn = self.current.get(user_id)
+            if turn != None and name not in turn:
+                turn[name] = now
+
+    def finish(self, user_id: str) -> None:
+        self.mark(user_id, "end")
+        with self.lock:
+            turn = self.current.pop(user_id, None)
+            event = self.done.pop(user_id, None)
+            if turn == None:
+                return
+            self.turns += 1
+            spans = {"debounce": ("last_message", "flush"), "queue": ("flush", "start"),
+                     "context": ("start", "context"), "llm": ("llm_start", "llm_end"),
+                     "first": ("llm_start", "first_segment"), "deliver": ("llm_end", "end"),
+                     "reply": ("last_message", "first_send"), "total": ("last_message", "end")}
+            for stage, (begin, end) in spans.items():
+                if begin in turn and end in turn:
+                    self.stages[stage].append(turn[end] - turn[begin])
+        if event != None:
+            event.set()
+
+    def instrument(self, bot: WechatBot) -> None:
+        pool_callback = bot.debounce_pool.callback
+        handler = bot.dispatcher.handler
+        get_context = bot.context_manager.get
+        send_request = bot.responsor.send_request
+
+        def flushed(user_id, message):
+            self.mark(user_id, "flush")
+            pool_callback(user_id, message)
+
+        def handle(user_id, message):
+            self.mark(user_id, "start")
+            try:
+                handler(user_id, message)
+            finally:
+                self.finish(user_id)
+
+        def get(user_id, *args, **kwargs):
+            result = get_context(user_id, *args, **kwargs)
+            self.mark(user_id, "context")
+            return result
+
+        def request(user_id, new_message, history=(), on_segment=None, *args, **kwargs):
+            self.mark(user_id, "llm_start")
+            if on_segment != None:
+                original = on_segment
+
+                def on_segment(segment):
+                    self.mark(user_id, "first_segment")
+                    original(segment)
+            try:
+                return send_request(user_id, new_message, history, on_segment, *args, **kwargs)
+            finally:
+                self.mark(user_id, "llm_end")
+
+        bot.debounce_pool.callback = flushed
+        bot.dispatcher.handler = handle
+        bot.context_manager.get = get
+        bot.responsor.send_request = request
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _peak_rss_mb() -> float | None:
+    if resource == None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="Simulated friends")
+    parser.add_argument("--rounds", type=int, default=5, help="Bursts sent by every friend")
+    parser.add_argument("--burst", type=int, default=3, help="Messages per burst")
+    parser.add_argument("--gap", type=float, default=0.05, help="Seconds between the messages of a burst")
+    parser.add_argument("--think", type=float, default=0.2, help="Seconds between a reply and the next burst")
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub endpoint time to first token (seconds)")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="Stub endpoint seconds per token")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="Tokens per stub reply")
+    parser.add_argument("--stream", action="store_true", help="Enable STREAM_RESPONSE")
+    parser.add_argument("--tool-rate", type=float, default=0.0, help="Share of turns starting with a tool call")
+    parser.add_argument("--media-rate", type=float, default=0.0,
+                        help="Share of messages sent as images, downloaded and stored by the media ingestor")
+    parser.add_argument("--broadcast", action="store_true",
+                        help="Every friend sends the same texts, as with a forwarded group message (LLM_COALESCE)")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Extra configuration items")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    overrides = {"STREAM_RESPONSE": "true" if args.stream else "false"}
+    for item in args.set:
+        key, value = item.split("=", 1)
+        overrides[key.strip().upper()] = value.strip()
+
+    work_dir = tempfile.mkdtemp()
+    stub = StubOpenAIServer(StubSettings(args.latency, args.token_delay, args.reply_tokens, args.tool_rate)).start()
+    users = [f"friend{index}" for index in range(args.users)]
+    recorder = _TurnRecorder()
+    try:
+        config = _write_config(work_dir, stub.base_url, users, overrides)
+        bot = WechatBot(config=config)
+        WechatClient.wechat = fake_wechat.FakeWeChat(lambda who, kind, payload: recorder.mark(who, "first_send"))
+        recorder.instrument(bot)
+        bot.start_event_loop()
+
+        peak_threads = threading.active_count()
+        sampling = threading.Event()
+
+        def sample_threads() -> None:
+            nonlocal peak_threads
+            while not sampling.wait(0.05):
+                peak_threads = max(peak_threads, threading.active_count())
+
+        timeouts = 0
+
+        def simulate(user_id: str) -> None:
+            nonlocal timeouts
+            rng = random.Random(user_id)
+            for round_index in range(args.rounds):
+                for index in range(args.burst):
+                    if index > 0:
+                        time.sleep(args.gap)
+                    last_message = time.monotonic()
+                    if index == args.burst - 1:
+                        done = recorder.begin(user_id, last_message)
+                    text = f"round {round_index} message {index}"
+                    kind = "image" if rng.random() < args.media_rate else "text"
+                    WechatClient.wechat.deliver(user_id, text if args.broadcast else f"{user_id} {text}", kind)
+                if not done.wait(60):
+                    timeouts += 1
+                time.sleep(args.think)
+
+        sampler = threading.Thread(target=sample_threads, daemon=True)
+        sampler.start()
+        start = time.monotonic()
+        threads = [threading.Thread(target=simulate, args=(user_id,)) for user_id in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        sampling.set()
+        sampler.join()
+        bot.stop_event_loop()
+    finally:
+        stub.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    messages = args.users * args.rounds * args.burst
+    results = {
+        "users": args.users, "messages": messages, "turns": recorder.turns, "timeouts": timeouts,
+        "elapsed": elapsed, "messages_per_sec": messages / elapsed, "turns_per_sec": recorder.turns / elapsed,
+        "peak_threads": peak_threads, "peak_rss_mb": _peak_rss_mb(),
+        "llm_requests": stub.settings.requests,
+        "stages_ms": {stage: {"p50": _percentile(values, 0.5) * 1000, "p95": _percentile(values, 0.95) * 1000,
+                              "p99": _percentile(values, 0.99) * 1000, "mean": statistics.mean(values) * 1000}
+                      for stage, values in recorder.stages.items() if values},
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.users} friends x {args.rounds} bursts x {args.burst} messages in {elapsed:.2f} s "
+          f"({recorder.turns} turns, {timeouts} timed out, {stub.settings.requests} LLM requests)")
+    print(f"  throughput   {results['messages_per_sec']:8.1f} messages/s   {results['turns_per_sec']:8.1f} turns/s")
+    rss = f"{results['peak_rss_mb']:.1f} MB" if results["peak_rss_mb"] != None else "n/a"
+    print(f"  peak threads {peak_threads:8d}   peak RSS {rss}")
+    print(f"  {'stage':<9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, values in results["stages_ms"].items():
+        print(f"  {stage:<9} {values['p50']:9.1f} {values['p95']:9.1f} {values['p99']:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+Replay of recorded chat histories through WechatBot
+
+Reads the histories of a storage directory (CONTEXT_STORAGE_DIR of the file
+backend: base64-named .json/.jsonl files) and sends every user message again,
+through the same pipeline as bench_load - the fake WeChat listener and
+WechatClient's handler, DebouncePool, RequestDispatcher, ContextManager and
+Responsor against the local stub endpoint. The recorded replies are not used;
+the stub answers instead.
+
+Timing of the messages:
+    Histories whose user messages have increasing timestamps (JSONL records) are
+    replayed on their recorded timeline, shared by all friends so that their
+    concurrency is kept; idle gaps longer than --max-gap are shortened to it.
+    Histories without timestamps (the legacy JSON arrays) get a synthetic
+    timeline: the first message within --spread seconds of the start, then one
+    every --think seconds on average (exponentially distributed).
+
+--speed 10 plays the timeline ten times faster. With --speed max the timeline
+is ignored and every friend sends their next message as soon as the previous
+one has been answered. --scale K replays every history K times as different
+friends, each copy shifted by up to --spread seconds and its texts numbered so
+that they are not coalesced or cached, to see how the bot copes with K times
+the chats.
+
+Reported every --interval seconds: messages sent and turns finished per second,
+p50/p95 time from the last message of a turn to the first reply and to the end
+of the turn (from the TRACE_FILE records), dispatch queue depth, threads and RSS.
+
+Usage:
+    python -m bench.bench_replay [--history chat_history] [--speed 1|10|max] [--scale 1] [--max-gap 60]
+                                 [--think 20] [--spread 10] [--interval 1] [--latency 0.2] [--stream]
+                                 [--set KEY=VALUE ...]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from bench.bench_load import REPO_DIR, _peak_rss_mb, _percentile, _write_config
+from bench import fake_wechat
+from bench.stub_openai import StubOpenAIServer, StubSettings
+from context.file_manager import FileManager, StorageDirConfig
+from wechat_client import WechatClient
+from wechat_bot import WechatBot
+
+
+def load_histories(directory: str) -> Dict[str, List[Tuple[float, str]]]:
+    """
+    User messages of every history in directory
+
+    Returns:
+        {user_id: [(ts, content), ...]} in history order; users without messages are left out
+    """
+    file_manager = FileManager(StorageDirConfig(directory))
+    histories = {}
+    for user_id in file_manager.user_ids():
+        # Read only: the legacy files are not migrated
+        messages = [(record.get("ts", 0), record["message"]["content"])
+                    for record in file_manager._read_all_records(user_id)
+                    if record["message"].get("role") == "user" and isinstance(record["message"]["content"], str)]
+        if messages:
+            histories[user_id] = messages
+    return histories
+
+
+def _has_timeline(messages: List[Tuple[float, str]]) -> bool:
+    """Whether the recorded timestamps can be replayed: legacy files give every record the file's mtime"""
+    stamps = [ts for ts, _ in messages]
+    return all(ts > 0 for ts in stamps) and all(later > earlier for earlier, later in zip(stamps, stamps[1:]))
+
+
+def build_schedule(histories: Dict[str, List[Tuple[float, str]]], scale: int = 1, max_gap: float = 60,
+                   think: float = 20, spread: float = 10, seed: int = 0) -> List[Tuple[float, str, str]]:
+    """
+    Timeline of the replay
+
+    Returns:
+        (offset in seconds from the start, user_id, content) sorted by offset
+    """
+    rng = random.Random(seed)
+    # The recorded histories share one timeline, so friends that chatted at the same time still do
+    recorded = sorted((ts, user_id, index) for user_id, messages in histories.items() if _has_timeline(messages)
+                      for index, (ts, _) in enumerate(messages))
+    offsets: Dict[Tuple[str, int], float] = {}
+    offset, previous = 0.0, None
+    for ts, user_id, index in recorded:
+        if previous != None:
+            offset += min(ts - previous, max_gap)
+        previous = ts
+        offsets[(user_id, index)] = offset
+    schedule = []
+    for user_id, messages in histories.items():
+        timed = _has_timeline(messages)
+        for copy_index in range(scale):
+            name = user_id if copy_index == 0 else f"{user_id}#{copy_index}"
+            shift = rng.uniform(0, spread) if copy_index > 0 or not timed else 0.0
+            at = shift
+            for index, (_, content) in enumerate(messages):
+                if timed:
+                    at = shift + offsets[(user_id, index)]
+                elif index > 0:
+                    at += min(rng.expovariate(1 / think) if think > 0 else 0.0, max_gap)
+                # Copies must not be answered by coalescing or the response cache in place of the upstream
+                schedule.append((at, name, content if copy_index == 0 else f"{content} #{copy_index}"))
+    schedule.sort(key=lambda item: item[0])
+    return schedule
+
+
+def _current_rss_mb() -> float | None:
+    """Resident set size now; the peak where /proc is not available"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return _peak_rss_mb()
+
+
+class _Progress:
+    """Turns finished or rejected per friend, for the closed loop of --speed max"""
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.answered: Dict[str, int] = {}
+
+    def done(self, user_id: str) -> None:
+        with self.condition:
+            self.answered[user_id] = self.answered.get(user_id, 0) + 1
+            self.condition.notify_all()
+
+    def wait(self, user_id: str, count: int, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.answered.get(user_id, 0) >= count, timeout)
+
+    def instrument(self, bot: WechatBot) -> None:
+        handler = bot.dispatcher.handler
+        on_shed = bot.dispatcher.on_shed
+
+        def handle(user_id, message):
+            try:
+                handler(user_id, message)
+            finally:
+                self.done(user_id)
+
+        def shed(user_id, message):
+            try:
+                on_shed(user_id, message)
+            finally:
+                self.done(user_id)
+
+        bot.dispatcher.handler = handle
+        bot.dispatcher.on_shed = shed
+
+
+def _read_turns(trace_path: str) -> List[Dict]:
+    turns = []
+    try:
+        with open(trace_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    turns.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except OSError:
+        pass
+    return turns
+
+
+def _turn_latencies(turn: Dict) -> Tuple[float, float | None]:
+    """(last message -> end of the turn, last message -> first reply) of a trace record, in seconds"""
+    spans: Dict[str, float] = {}
+    for span in turn["spans"]:
+        spans[span["stage"]] = spans.get(span["stage"], 0.0) + span["duration"]
+    waited = spans.get("debounce", 0.0) + spans.get("queue", 0.0)
+    first = spans.get("first_message")
+    return waited + turn["duration"], (waited + first if first != None else None)
+
+
+def _curves(start: float, elapsed: float, interval: float, sent: List[float], turns: List[Dict],
+            samples: List[Tuple[float, int, int, float | None]]) -> List[Dict]:
+    """Per-interval rows of the run; sent and samples are relative to start, turns carry wall-clock times"""
+    count = max(1, int(elapsed / interval + 0.999))
+    rows = [{"t": (index + 1) * interval, "sent": 0, "turns": 0, "total": [], "reply": [],
+             "queued": 0, "threads": 0, "rss_mb": None} for index in range(count)]
+
+    def row(offset: float) -> Dict:
+        return rows[min(count - 1, max(0, int(offset / interval)))]
+
+    for offset in sent:
+        row(offset)["sent"] += 1
+    for turn in turns:
+        target = row(turn["ts"] + turn["duration"] - start)
+        target["turns"] += 1
+        total, reply = _turn_latencies(turn)
+        target["total"].append(total)
+        if reply != None:
+            target["reply"].append(reply)
+    for offset, queued, threads, rss in samples:
+        target = row(offset)
+        target["queued"] = max(target["queued"], queued)
+        target["threads"] = max(target["threads"], threads)
+        if rss != None:
+            target["rss_mb"] = max(target["rss_mb"] or 0.0, rss)
+    curves = []
+    for values in rows:
+        curves.append({
+            "t": values["t"], "messages_per_sec": values["sent"] / interval, "turns_per_sec": values["turns"] / interval,
+            "total_p50_ms": _percentile(values["total"], 0.5) * 1000 if values["total"] else None,
+            "total_p95_ms": _percentile(values["total"], 0.95) * 1000 if values["total"] else None,
+            "reply_p50_ms": _percentile(values["reply"], 0.5) * 1000 if values["reply"] else None,
+            "reply_p95_ms": _percentile(values["reply"], 0.95) * 1000 if values["reply"] else None,
+            "queued": values["queued"], "threads": values["threads"], "rss_mb": values["rss_mb"],
+        })
+    return curves
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", default=os.path.join(REPO_DIR, "chat_history"),
+                        help="Directory of the recorded histories (file storage backend)")
+    parser.add_argument("--speed", default="1", help="Replay speed factor, or max")
+    parser.add_argument("--scale", type=int, default=1, help="Copies of every history, replayed as different friends")
+    parser.add_argument("--max-gap", type=float, default=60, help="Longest idle gap of the timeline (seconds)")
+    parser.add_argument("--think", type=float, default=20,
+                        help="Mean seconds between the messages of a history without timestamps")
+    parser.add_argument("--spread", type=float, default=10, help="Seconds over which synthetic timelines and copies start")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic timelines")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds per row of the curves")
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub endpoint time to first token (seconds)")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="Stub endpoint seconds per token")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="Tokens per stub reply")
+    parser.add_argument("--stream", action="store_true", help="Enable STREAM_RESPONSE")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Extra configuration items")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    max_speed = args.speed.lower() == "max"
+    speed = None if max_speed else float(args.speed)
+    if speed != None and speed <= 0:
+        parser.error("--speed must be greater than 0, or max")
+    histories = load_histories(args.history)
+    if not histories:
+        parser.error(f"no history with user messages in {args.history}")
+    schedule = build_schedule(histories, max(1, args.scale), args.max_gap, args.think, args.spread, args.seed)
+    users = sorted({user_id for _, user_id, _ in schedule})
+
+    work_dir = tempfile.mkdtemp()
+    trace_path = os.path.join(work_dir, "trace.jsonl")
+    overrides = {"STREAM_RESPONSE": "true" if args.stream else "false", "TRACE_FILE": trace_path}
+    for item in args.set:
+        key, value = item.split("=", 1)
+        overrides[key.strip().upper()] = value.strip()
+
+    stub = StubOpenAIServer(StubSettings(args.latency, args.token_delay, args.reply_tokens)).start()
+    progress = _Progress()
+    sent: List[float] = []
+    samples: List[Tuple[float, int, int, float | None]] = []
+    timeouts = 0
+    try:
+        config = _write_config(work_dir, stub.base_url, users, overrides)
+        bot = WechatBot(config=config)
+        WechatClient.wechat = fake_wechat.FakeWeChat()
+        progress.instrument(bot)
+        bot.start_event_loop()
+
+        sampling = threading.Event()
+        start_wall = time.time()
+        start = time.monotonic()
+
+        def sample() -> None:
+            while not sampling.wait(min(0.25, args.interval)):
+                samples.append((time.monotonic() - start, bot.dispatcher.stats()["queued"],
+                                threading.active_count(), _current_rss_mb()))
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        if max_speed:
+            # Closed loop: a friend's next message waits for the answer to the previous one
+            per_user: Dict[str, List[str]] = {}
+            for _, user_id, content in schedule:
+                per_user.setdefault(user_id, []).append(content)
+            sent_lock = threading.Lock()
+
+            def simulate(user_id: str) -> None:
+                nonlocal timeouts
+                for index, content in enumerate(per_user[user_id]):
+                    with sent_lock:
+                        sent.append(time.monotonic() - start)
+                    WechatClient.wechat.deliver(user_id, content)
+                    if not progress.wait(user_id, index + 1, 60):
+                        with sent_lock:
+                            timeouts += 1
+                        return
+
+            threads = [threading.Thread(target=simulate, args=(user_id,)) for user_id in per_user]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            # One feeder keeps the timeline; deliver() only queues, the fake listener hands the messages over
+            for at, user_id, content in schedule:
+                delay = start + at / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                sent.append(time.monotonic() - start)
+                WechatClient.wechat.deliver(user_id, content)
+        WechatClient.wechat.join()
+        # Flushes the debounce buffers and waits for every turn in progress
+        bot.stop_event_loop()
+        elapsed = time.monotonic() - start
+        sampling.set()
+        sampler.join()
+        dispatch_stats = bot.dispatcher.stats()
+        turns = _read_turns(trace_path)
+    finally:
+        stub.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    totals, replies = [], []
+    for turn in turns:
+        total, reply = _turn_latencies(turn)
+        totals.append(total)
+        if reply != None:
+            replies.append(reply)
+    results = {
+        "histories": len(histories), "friends": len(users), "messages": len(sent), "turns": len(turns),
+        "failed_turns": sum(1 for turn in turns if turn["status"] != "ok"),
+        "merged": dispatch_stats["merged"], "shed": dispatch_stats["shed"], "timeouts": timeouts,
+        "speed": "max" if max_speed else speed, "elapsed": elapsed,
+        "messages_per_sec": len(sent) / elapsed, "turns_per_sec": len(turns) / elapsed,
+        "llm_requests": stub.settings.requests, "peak_rss_mb": _peak_rss_mb(),
+        "latency_ms": {name: {"p50": _percentile(values, 0.5) * 1000, "p95": _percentile(values, 0.95) * 1000,
+                              "p99": _percentile(values, 0.99) * 1000}
+                       for name, values in (("total", totals), ("reply", replies)) if values},
+        "curves": _curves(start_wall, elapsed, args.interval, sent, turns, samples),
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    speed_text = "max speed" if max_speed else f"{speed:g}x"
+    print(f"{len(histories)} histories as {len(users)} friends, {len(sent)} messages at {speed_text} in {elapsed:.2f} s "
+          f"({len(turns)} turns, {results['merged']} merged, {results['shed']} shed, {timeouts} timed out, "
+          f"{stub.settings.requests} LLM requests)")
+    print(f"  throughput   {results['messages_per_sec']:8.2f} messages/s   {results['turns_per_sec']:8.2f} turns/s")
+    for name, values in results["latency_ms"].items():
+        print(f"  {name:<12} p50 {values['p50']:8.1f} ms   p95 {values['p95']:8.1f} ms   p99 {values['p99']:8.1f} ms")
+    rss = f"{results['peak_rss_mb']:.1f} MB" if results["peak_rss_mb"] != None else "n/a"
+    print(f"  peak RSS {rss}")
+
+    def cell(value, digits: int = 0) -> str:
+        return "-" if value == None else f"{value:.{digits}f}"
+
+    print(f"  {'t s':>7} {'msg/s':>7} {'turn/s':>7} {'reply p50':>10} {'reply p95':>10} {'total p95':>10} "
+          f"{'queued':>7} {'threads':>8} {'RSS MB':>8}")
+    for row in results["curves"]:
+        print(f"  {row['t']:7.1f} {row['messages_per_sec']:7.2f} {row['turns_per_sec']:7.2f} "
+              f"{cell(row['reply_p50_ms']):>10} {cell(row['reply_p95_ms']):>10} {cell(row['total_p95_ms']):>10} "
+              f"{row['queued']:7d} {row['threads']:8d} {cell(row['rss_mb'], 1):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Write-ahead log durability cost
+
+N threads, one per simulated user, each append messages through
+StorageManager.add_contexts and wait until they are durable, as the bot does
+once per turn. Reported: wall time per durable message, p50/p99 latency of
+one durable append, and how many records each fsync carried (group commit).
+Compare with --set CONTEXT_WAL=false to see what durability adds, and with
+--set CONTEXT_STORAGE_BACKEND=sqlite for the SQLite backend.
+
+Usage:
+    python -m bench.bench_wal [--users 50] [--turns 200] [--set KEY=VALUE ...]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context.storage_backend import create_storage_backend
+from context.storage_manager import StorageManager
+from tests.config_helper import make_config
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="Concurrent appending threads")
+    parser.add_argument("--turns", type=int, default=200, help="Turns (message and reply) per user")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Extra configuration items")
+    args = parser.parse_args()
+
+    overrides = {}
+    for item in args.set:
+        key, value = item.split("=", 1)
+        overrides[key.strip().upper()] = value.strip()
+    work_dir = tempfile.mkdtemp()
+    try:
+        config = make_config(work_dir, CONTEXT_STORAGE_DIR=work_dir, **overrides)
+        backend = create_storage_backend(config)
+        storage = StorageManager(config, backend)
+        latencies: List[float] = []
+        lock = threading.Lock()
+
+        def append(user_id: str) -> None:
+            local = []
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                storage.add_contexts(user_id, [{"role": "user", "content": f"message {turn}"},
+                                               {"role": "assistant", "content": f"reply {turn}"}])
+                local.append(time.perf_counter() - start)
+            with lock:
+                latencies.extend(local)
+
+        threads = [threading.Thread(target=append, args=(f"user{index}",)) for index in range(args.users)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        wal_stats = storage.wal.stats() if storage.wal != None else None
+        storage.close()
+        backend.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    messages = args.users * args.turns * 2
+    latencies.sort()
+    print(f"{args.users} users x {args.turns} turns, {messages} messages in {elapsed:.2f} s")
+    print(f"  wall time per message  {elapsed / messages * 1e6:9.1f} us")
+    print(f"  append latency p50     {latencies[len(latencies) // 2] * 1e3:9.3f} ms")
+    print(f"  append latency p99     {latencies[int(len(latencies) * 0.99)] * 1e3:9.3f} ms")
+    if wal_stats != None:
+        print(f"  fsyncs {wal_stats['commits']}, {wal_stats['records_per_commit']:.1f} records per fsync")
+
+
+if __name__ == "__main__":
+    main()
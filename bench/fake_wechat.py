@@ -0,0 +1,113 @@
+"""
+In-process stand-ins for the wxauto WeChat and Chat objects
+
+install() registers a fake wxauto package before wechat_client is imported, so
+the bot can be driven without a logged-in WeChat window (WechatClient creates
+its WeChat() instance at import time). Messages are delivered to the listener
+callbacks by one thread, like the wxauto listener, and everything the bot sends
+is recorded on the FakeChat.
+"""
+import os
+import sys
+import threading
+import uuid
+import time
+import types
+from queue import Queue
+from typing import Callable, Dict, List, Tuple
+
+
+class FakeMessage:
+    """The attributes of wxauto.msgs.BaseMessage that WechatClient reads"""
+
+    def __init__(self, sender: str, content: str, type: str = "text") -> None:
+        self.sender = sender
+        self.content = content
+        self.type = type
+
+    def to_text(self) -> str:
+        return self.content
+
+    # Extensions of the downloaded media, by message type
+    EXTENSIONS = {"image": ".jpg", "video": ".mp4", "file": ".bin"}
+
+    def download(self, dir_path: str) -> str:
+        """Write the content into dir_path as the downloaded file, so equal contents are equal files"""
+        path = os.path.join(dir_path, uuid.uuid4().hex + self.EXTENSIONS.get(self.type, ".bin"))
+        with open(path, "wb") as f:
+            f.write(self.content.encode("utf-8"))
+        return path
+
+
+class FakeChat:
+    """Records SendMsg/SendFiles calls instead of driving the WeChat UI"""
+
+    def __init__(self, who: str, on_send: Callable[[str, str, str], None] | None = None) -> None:
+        self.who = who
+        self.on_send = on_send
+        self.sent: List[Tuple[float, str, str]] = []
+
+    def _record(self, kind: str, payload: str) -> None:
+        self.sent.append((time.monotonic(), kind, payload))
+        if self.on_send != None:
+            self.on_send(self.who, kind, payload)
+
+    def SendMsg(self, msg: str, *args, **kwargs) -> None:
+        self._record("text", msg)
+
+    def SendFiles(self, filepath: str, *args, **kwargs) -> None:
+        self._record("file", filepath)
+
+
+class FakeWeChat:
+    """Replaces WechatClient.wechat; deliver() plays the role of the wxauto listener thread"""
+
+    def __init__(self, on_send: Callable[[str, str, str], None] | None = None) -> None:
+        self.on_send = on_send
+        self.chats: Dict[str, FakeChat] = {}
+        self._callbacks: Dict[str, Callable] = {}
+        self._inbox: Queue = Queue()
+        self._listener = threading.Thread(target=self._listen, name="fake-wxauto-listener", daemon=True)
+        self._listener.start()
+
+    def AddListenChat(self, nickname: str, callback: Callable) -> FakeChat:
+        chat = FakeChat(nickname, self.on_send)
+        self.chats[nickname] = chat
+        self._callbacks[nickname] = callback
+        return chat
+
+    def RemoveListenChat(self, nickname: str) -> None:
+        self._callbacks.pop(nickname, None)
+
+    def deliver(self, who: str, content: str, type: str = "text") -> None:
+        """Simulate a message from friend who"""
+        self._inbox.put((who, FakeMessage(who, content, type)))
+
+    def join(self) -> None:
+        """Wait until every delivered message has been handed to its listener callback"""
+        self._inbox.join()
+
+    def _listen(self) -> None:
+        while True:
+            who, message = self._inbox.get()
+            callback = self._callbacks.get(who)
+            if callback != None:
+                try:
+                    callback(message, self.chats[who])
+                except Exception as e:
+                    print(f"Listener callback of {who} failed: {e}")
+            self._inbox.task_done()
+
+
+def install() -> None:
+    """Register fake wxauto modules, unless wechat_client is already imported"""
+    if "wechat_client" in sys.modules:
+        return
+    wxauto = types.ModuleType("wxauto")
+    wxauto.WeChat = lambda *args, **kwargs: None
+    wxauto.Chat = FakeChat
+    msgs = types.ModuleType("wxauto.msgs")
+    msgs.BaseMessage = FakeMessage
+    wxauto.msgs = msgs
+    sys.modules["wxauto"] = wxauto
+    sys.modules["wxauto.msgs"] = msgs
@@ -0,0 +1,161 @@
+"""
+Local OpenAI-compatible /chat/completions endpoint for benchmarks
+
+Replies after a configurable latency, optionally streamed token by token, and
+can answer a share of the user turns with a call to the "add" tool first, or
+fail every request with an HTTP error status.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+
+class StubSettings:
+    def __init__(self, latency: float = 0.2, token_delay: float = 0.005, reply_tokens: int = 40,
+                 tool_rate: float = 0.0, seed: int = 1, fail_status: int = 0) -> None:
+        # Seconds before the first token (or the whole reply when not streaming)
+        self.latency = latency
+        # Seconds between streamed tokens; also added per token to non-streamed replies
+        self.token_delay = token_delay
+        self.reply_tokens = reply_tokens
+        # Share of user turns answered with a tool call first
+        self.tool_rate = tool_rate
+        # If set, every request is answered with this HTTP error status (e.g. 503)
+        self.fail_status = fail_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def count_request(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    def wants_tool(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.tool_rate
+
+
+def _reply_tokens(settings: StubSettings) -> List[str]:
+    words = [f"word{index} " for index in range(settings.reply_tokens)]
+    # Sentence endings give the segmenter something to cut at
+    for index in range(9, len(words), 10):
+        words[index] = words[index].strip() + ". "
+    return words
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings: StubSettings = None
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def handle(self) -> None:
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # A client closed its pooled connection, or a cancelled request
+            pass
+
+    def _send_json(self, payload: Dict) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int) -> None:
+        data = json.dumps({"error": {"message": "stub failure", "type": "server_error"}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        settings = self.settings
+        settings.count_request()
+        if settings.fail_status:
+            self._send_error(settings.fail_status)
+            return
+        last = body["messages"][-1]
+        call_tool = last["role"] == "user" and body.get("tool_choice") != "none" and body.get("tools") \
+            and settings.wants_tool()
+        time.sleep(settings.latency)
+        if body.get("stream"):
+            self._stream(body, call_tool)
+            return
+        if call_tool:
+            message = {"role": "assistant", "content": None,
+                       "tool_calls": [{"id": "call_1", "type": "function",
+                                       "function": {"name": "add", "arguments": '{"a": 1, "b": 2}'}}]}
+            completion_tokens = 10
+        else:
+            tokens = _reply_tokens(settings)
+            time.sleep(settings.token_delay * len(tokens))
+            message = {"role": "assistant", "content": "".join(tokens)}
+            completion_tokens = len(tokens)
+        prompt_tokens = sum(len(str(item.get("content") or "")) // 4 for item in body["messages"])
+        self._send_json({"id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                         "choices": [{"index": 0, "finish_reason": "tool_calls" if call_tool else "stop",
+                                      "message": message}],
+                         "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                   "total_tokens": prompt_tokens + completion_tokens}})
+
+    def _stream(self, body: Dict, call_tool: bool) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def chunk(delta: Dict, finish_reason=None) -> None:
+            payload = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                       "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+            self.wfile.flush()
+
+        try:
+            if call_tool:
+                chunk({"role": "assistant", "tool_calls": [{"index": 0, "id": "call_1", "type": "function",
+                                                            "function": {"name": "add", "arguments": ""}}]})
+                chunk({"tool_calls": [{"index": 0, "function": {"arguments": '{"a": 1, "b": 2}'}}]}, "tool_calls")
+            else:
+                chunk({"role": "assistant", "content": ""})
+                for token in _reply_tokens(self.settings):
+                    time.sleep(self.settings.token_delay)
+                    chunk({"content": token})
+                chunk({}, "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed a cancelled stream
+            pass
+        self.close_connection = True
+
+
+class StubOpenAIServer:
+    """Runs the stub endpoint on a background thread; base_url is what OPENAI_ENDPOINT should be set to"""
+
+    def __init__(self, settings: StubSettings | None = None, port: int = 0) -> None:
+        self.settings = settings if settings != None else StubSettings()
+        handler = type("StubHandler", (_StubHandler,), {"settings": self.settings})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stub-openai", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def start(self) -> "StubOpenAIServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,11 +1,254 @@
 import os
+import threading
+from typing import Any, Callable, Dict, FrozenSet, List
 from dotenv import dotenv_values
 
+
+def _parse_bool(value: str) -> bool:
+    lowered = value.strip().lower()
+    if lowered in ("1", "true", "yes", "on"):
+        return True
+    if lowered in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(f"expected true or false, got '{value}'")
+
+
+def _choice(*choices: str) -> Callable[[str], str]:
+    def parse(value: str) -> str:
+        lowered = value.strip().lower()
+        if lowered not in choices:
+            raise ValueError(f"expected one of {', '.join(choices)}, got '{value}'")
+        return lowered
+    return parse
+
+
+def _parse_timeouts(value: str) -> Dict[str, float]:
+    """Per-name seconds in the form: send_a_file=120,list_files_in_directory=5"""
+    timeouts = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        name, seconds = item.split("=", 1)
+        timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+
+def _parse_names(value: str) -> FrozenSet[str]:
+    """Comma separated names, e.g. send_a_file,list_files_in_directory"""
+    return frozenset(name.strip() for name in value.split(",") if name.strip())
+
+
+def _parse_endpoints(value: str) -> tuple:
+    """
+    LLM endpoints in the form url|model|weight|key, separated by commas. Only the url is
+    required; missing parts are empty (MODEL_NAME and OPENAI_KEY are used) or weight 1.
+    """
+    endpoints = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        parts = [part.strip() for part in item.split("|")] + ["", "", ""]
+        url, model, weight, key = parts[:4]
+        if not url:
+            raise ValueError(f"endpoint without url: '{item.strip()}'")
+        weight = float(weight) if weight else 1.0
+        if weight <= 0:
+            raise ValueError(f"weight of {url} must be greater than 0")
+        endpoints.append((url, model, weight, key))
+    return tuple(endpoints)
+
+
+class Setting:
+    """Schema entry of one configuration item"""
+    __slots__ = ("parse", "default", "required", "reloadable", "minimum")
+
+    def __init__(self, parse: Callable[[str], Any], default: Any = None, required: bool = False,
+                 reloadable: bool = False, minimum: float | None = None) -> None:
+        # Converts the text of the .env file into the typed value
+        self.parse = parse
+        # Value when the item is missing or empty
+        self.default = default
+        self.required = required
+        # Whether a changed value takes effect without restarting the bot
+        self.reloadable = reloadable
+        self.minimum = minimum
+
+
+# Every known configuration item, by lowercase name. Items of the .env file that are
+# not listed here are kept as strings.
+SCHEMA: Dict[str, Setting] = {
+    "openai_key": Setting(str, required=True),
+    "openai_endpoint": Setting(str, required=True),
+    "model_name": Setting(str, required=True, reloadable=True),
+    "model_temperature": Setting(float, required=True, reloadable=True, minimum=0),
+    "model_top_p": Setting(float, required=True, reloadable=True, minimum=0),
+    "stream_response": Setting(_parse_bool, False),
+    "stream_min_segment_length": Setting(int, 20, reloadable=True, minimum=0),
+    "system_prompt_path": Setting(str, required=True),
+    "tools_description_path": Setting(str, required=True),
+    "tools_implementation_path": Setting(str, required=True),
+    "tool_workers": Setting(int, 8, minimum=1),
+    "tool_timeout": Setting(float, 30.0, reloadable=True, minimum=0),
+    "tool_timeouts": Setting(_parse_timeouts, {}, reloadable=True),
+    "max_tool_rounds": Setting(int, 5, reloadable=True, minimum=0),
+    "response_cache": Setting(_parse_bool, False),
+    "response_cache_max_entries": Setting(int, 1000, reloadable=True, minimum=1),
+    "response_cache_ttl": Setting(float, 3600.0, reloadable=True, minimum=0),
+    "response_cache_context_messages": Setting(int, 2, reloadable=True, minimum=0),
+    "response_cache_similarity": Setting(float, 0.0, reloadable=True, minimum=0),
+    "response_cache_opt_out": Setting(_parse_names, frozenset(), reloadable=True),
+    "response_cache_safe_tools": Setting(_parse_names, frozenset({"list_files_in_directory"}), reloadable=True),
+    "context_window_length": Setting(int, required=True, reloadable=True, minimum=1),
+    "context_trim_mode": Setting(_choice("messages", "tokens"), "messages"),
+    "context_token_budget": Setting(int, 4000, reloadable=True, minimum=1),
+    "context_tokenizer": Setting(str, "heuristic"),
+    "context_stay_duration": Setting(float, required=True, reloadable=True, minimum=0),
+    "context_summary": Setting(_parse_bool, False),
+    "summary_batch_size": Setting(int, 6, reloadable=True, minimum=1),
+    "summary_max_words": Setting(int, 200, reloadable=True, minimum=1),
+    "summary_model_name": Setting(str),
+    "summary_key": Setting(str),
+    "summary_endpoint": Setting(str),
+    "context_storage_dir": Setting(str, required=True),
+    "context_storage_backend": Setting(_choice("file", "sqlite"), "file"),
+    "context_sqlite_path": Setting(str),
+    "context_cache_window": Setting(int, 50, minimum=1),
+    "context_cache_max_entries": Setting(int, 1000, reloadable=True, minimum=1),
+    "context_cache_max_bytes": Setting(int, 64 * 1024 * 1024, reloadable=True, minimum=0),
+    "context_flush_interval": Setting(float, 0.5, reloadable=True, minimum=0),
+    "context_fsync_policy": Setting(_choice("always", "interval", "never"), "interval"),
+    "context_fsync_interval": Setting(float, 5.0, reloadable=True, minimum=0),
+    "context_log_max_messages": Setting(int, 0, reloadable=True, minimum=0),
+    "context_compact_interval": Setting(float, 3600.0, reloadable=True, minimum=0),
+    "context_retention_days": Setting(float, 0.0, reloadable=True, minimum=0),
+    "context_wal": Setting(_parse_bool, True),
+    "context_wal_segment_bytes": Setting(int, 16 * 1024 * 1024, minimum=1),
+    "debounce_threshold": Setting(int, required=True, reloadable=True, minimum=1),
+    "max_wait_duration": Setting(float, required=True, reloadable=True, minimum=0),
+    "debounce_policy": Setting(_choice("fixed", "adaptive"), "fixed"),
+    "debounce_min_wait": Setting(float, 0.5, reloadable=True, minimum=0),
+    "debounce_gap_alpha": Setting(float, 0.1, reloadable=True, minimum=0),
+    "debounce_gap_deviations": Setting(float, 3.0, reloadable=True, minimum=0),
+    "debounce_follow_rate": Setting(float, 0.2, reloadable=True, minimum=0),
+    "debounce_min_samples": Setting(int, 3, reloadable=True, minimum=0),
+    "debounce_policy_max_users": Setting(int, 10000, reloadable=True, minimum=1),
+    "speculative_idle_threshold": Setting(float, 0.0, minimum=0),
+    "speculative_workers": Setting(int, 4, minimum=1),
+    "dispatch_workers": Setting(int, 8, minimum=1),
+    "dispatch_max_queued": Setting(int, 100, reloadable=True, minimum=0),
+    "dispatch_quantum": Setting(int, 100, reloadable=True, minimum=1),
+    "dispatch_busy_reply": Setting(str, "I'm receiving a lot of messages right now, please try again in a moment.",
+                                   reloadable=True),
+    "llm_max_inflight": Setting(int, 4, minimum=1),
+    "llm_coalesce": Setting(_parse_bool, True, reloadable=True),
+    "llm_endpoints": Setting(_parse_endpoints, ()),
+    "llm_pool_connections": Setting(int, 20, minimum=1),
+    "llm_request_timeout": Setting(float, 120.0, minimum=1),
+    "llm_hedge": Setting(_parse_bool, True, reloadable=True),
+    "llm_hedge_min_samples": Setting(int, 20, reloadable=True, minimum=1),
+    "llm_latency_alpha": Setting(float, 0.2, reloadable=True, minimum=0),
+    "llm_breaker_failures": Setting(int, 5, reloadable=True, minimum=1),
+    "llm_breaker_cooldown": Setting(float, 30.0, reloadable=True, minimum=0),
+    "outbound_rate": Setting(float, 2.0, reloadable=True, minimum=0.001),
+    "outbound_burst": Setting(float, 5.0, reloadable=True, minimum=1),
+    "outbound_coalesce_max_chars": Setting(int, 2000, reloadable=True, minimum=0),
+    "file_download_dir": Setting(str, required=True),
+    "media_workers": Setting(int, 2, minimum=1),
+    "media_timeout": Setting(float, 30.0, reloadable=True, minimum=0),
+    "media_cache_max_entries": Setting(int, 1000, reloadable=True, minimum=1),
+    "info_files_directory": Setting(str, required=True, reloadable=True),
+    "listen_friendname_file": Setting(str, required=True),
+    "metrics_port": Setting(int, 0, minimum=0),
+    "metrics_host": Setting(str, "127.0.0.1"),
+    "metrics_window": Setting(float, 60.0, minimum=0),
+    "trace_file": Setting(str, ""),
+    "config_reload_interval": Setting(float, 2.0, minimum=0),
+}
+
+
+class ConfigSnapshot:
+    """
+    Immutable, typed values of one version of the .env file.
+
+    Every item of SCHEMA is parsed and validated once, when the snapshot is built,
+    so readers get ints, floats and bools instead of re-parsing strings.
+    """
+    __slots__ = ("_values", "mtime")
+
+    def __init__(self, values: Dict[str, Any], mtime: float = 0.0) -> None:
+        object.__setattr__(self, "_values", values)
+        # Modification time of the file the snapshot was read from
+        object.__setattr__(self, "mtime", mtime)
+
+    @classmethod
+    def parse(cls, settings: Dict[str, str | None], mtime: float = 0.0) -> "ConfigSnapshot":
+        """
+        Validate raw .env settings against SCHEMA
+
+        Raises:
+            ValueError: Listing every missing or invalid item
+        """
+        values: Dict[str, Any] = {k.lower(): v for k, v in settings.items()}
+        errors: List[str] = []
+        for name, setting in SCHEMA.items():
+            raw = values.get(name)
+            if raw == None or raw.strip() == "":
+                if setting.required:
+                    errors.append(f"{name.upper()} is required")
+                values[name] = setting.default
+                continue
+            try:
+                value = setting.parse(raw.strip())
+            except ValueError as e:
+                errors.append(f"{name.upper()}: {e}")
+                continue
+            if setting.minimum != None and value < setting.minimum:
+                errors.append(f"{name.upper()} must be at least {setting.minimum}, got {value}")
+                continue
+            values[name] = value
+        if errors:
+            raise ValueError("Invalid configuration: " + "; ".join(errors))
+        return cls(values, mtime)
+
+    def __getattr__(self, name):
+        """Enable attribute-style access to configuration values (e.g., config.color)"""
+        # Convert attribute names to lowercase to match configuration keys
+        try:
+            return self._values[name.lower()]
+        except KeyError:
+            # If the configuration item does not exist, raise an AttributeError exception
+            raise AttributeError(f"Configuration item '{name.lower()}' does not exist") from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Configuration snapshots are read-only")
+
+    def get(self, name, default=None):
+        """Return a configuration item, or default if it is neither set nor in SCHEMA"""
+        value = self._values.get(name.lower())
+        return default if value == None else value
+
+    def __dir__(self):
+        """Return all available configuration item names"""
+        return list(self._values.keys())
+
+
 class Config:
+    """
+    Live configuration of the bot: the current ConfigSnapshot of a .env file.
+
+    One Config is shared by every component. Reads go to the current snapshot, and
+    when the file changes on disk (checked every CONFIG_RELOAD_INTERVAL seconds once
+    start_watching() is called) a new snapshot is validated and swapped in atomically.
+    Only items marked reloadable in SCHEMA change at runtime; a changed value of any
+    other item is reported and keeps its old value until the bot restarts. A file that
+    fails validation is reported and ignored. Components that need several values to
+    be consistent with each other read them from one snapshot().
+    """
+
     def __init__(self, path=None):
         """
         Initialize configuration loader with .env file path validation.
-        
+
         Args:
             path (str): Path to .env configuration file. Defaults to '.env'.
         """
@@ -14,27 +257,149 @@ class Config:
             # Get the directory where the current file (config.py) is located
             current_dir = os.path.dirname(os.path.abspath(__file__))
             path = os.path.join(current_dir, '.env')
-        
+
         # Check if the configuration file exists
         if not os.path.isfile(path):
             raise FileNotFoundError(f"The configuration file {path} does not exist.")
-        self._settings = dotenv_values(path)
+        self.path = path
+        self._snapshot = self._read()
+        self._listeners: List[Callable[[ConfigSnapshot, FrozenSet[str]], None]] = []
+        self._reload_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._watch_thread: threading.Thread | None = None
+        # Other files checked by the watcher: path -> [callback, last seen modification time]
+        self._watched_files: Dict[str, list] = {}
+
+    def _read(self) -> ConfigSnapshot:
+        mtime = os.path.getmtime(self.path)
+        settings = dotenv_values(self.path)
         # Check if configuration items are empty
-        if not self._settings:
+        if not settings:
             raise ValueError("The configuration file is empty or does not contain any valid configuration items.")
-
-        # Convert all configuration keys to lowercase for case-insensitive access
-        self._settings = {k.lower(): v for k, v in self._settings.items()}
+        return ConfigSnapshot.parse(settings, mtime)
 
     def __getattr__(self, name):
-        """Enable attribute-style access to configuration values (e.g., config.color)"""
-        # Convert attribute names to lowercase to match configuration keys
-        name = name.lower()
-        if name in self._settings:
-            return self._settings[name]
-        # If the configuration item does not exist, raise an AttributeError exception
-        raise AttributeError(f"Configuration item '{name}' does not exist")
+        """Enable attribute-style access to the current values (e.g., config.max_wait_duration)"""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._snapshot, name)
+
+    def get(self, name, default=None):
+        """Return a configuration item, or default if it is neither set nor in SCHEMA"""
+        return self._snapshot.get(name, default)
 
     def __dir__(self):
         """Return all available configuration item names"""
-        return list(self._settings.keys())
+        return dir(self._snapshot)
+
+    def snapshot(self) -> ConfigSnapshot:
+        """The current values, unaffected by later reloads"""
+        return self._snapshot
+
+    def on_change(self, listener: Callable[[ConfigSnapshot, FrozenSet[str]], None]) -> None:
+        """Call listener(new snapshot, names of the changed items) after every reload that changed something"""
+        self._listeners.append(listener)
+
+    def reload(self) -> FrozenSet[str]:
+        """
+        Re-read the file and swap in the new values
+
+        Returns:
+            Names of the items whose value changed (empty if the file is invalid or unchanged)
+        """
+        with self._reload_lock:
+            old = self._snapshot
+            try:
+                new = self._read()
+            except (OSError, ValueError) as e:
+                print(f"Configuration {self.path} not reloaded: {e}")
+                return frozenset()
+            values = dict(new._values)
+            changed = set()
+            for name in set(values) | set(old._values):
+                if values.get(name) == old._values.get(name):
+                    continue
+                setting = SCHEMA.get(name)
+                if setting != None and not setting.reloadable:
+                    print(f"{name.upper()} changed in {self.path}, it takes effect after a restart")
+                    values[name] = old._values.get(name)
+                    continue
+                changed.add(name)
+            self._snapshot = ConfigSnapshot(values, new.mtime)
+            changed = frozenset(changed)
+        if changed:
+            print(f"Configuration reloaded: {', '.join(sorted(name.upper() for name in changed))}")
+            for listener in list(self._listeners):
+                try:
+                    listener(self._snapshot, changed)
+                except Exception as e:
+                    print(f"Configuration listener failed: {e}")
+        return changed
+
+    def watch_file(self, path: str, callback: Callable[[str], None]) -> None:
+        """
+        Call callback(path) whenever the file at path changes, checked together with the .env file
+
+        Args:
+            path: File to watch, e.g. the system prompts or the listen list; it may not exist yet.
+                  A directory changes when one of its files is added, removed or modified.
+            callback: Called on the watcher thread; it must not raise for an invalid file
+        """
+        self._watched_files[path] = [callback, self._fingerprint(path)]
+
+    @staticmethod
+    def _mtime(path: str) -> float | None:
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    @classmethod
+    def _fingerprint(cls, path: str) -> Any:
+        """Modification time of a file; of a directory, (name, mtime, size) of each entry, since editing
+        a file in place does not change the directory's own mtime"""
+        if not os.path.isdir(path):
+            return cls._mtime(path)
+        try:
+            with os.scandir(path) as entries:
+                return tuple(sorted((entry.name, entry.stat().st_mtime, entry.stat().st_size) for entry in entries))
+        except OSError:
+            return None
+
+    def start_watching(self) -> None:
+        """
+        Reload the file whenever it changes, checked every CONFIG_RELOAD_INTERVAL seconds (0 disables).
+        Files registered with watch_file() are checked at the same time.
+        """
+        interval = self._snapshot.config_reload_interval
+        if interval <= 0 or self._watch_thread != None:
+            return
+        self._stop_event.clear()
+        self._watch_thread = threading.Thread(target=self._watch, args=(interval,), name="config-watcher",
+                                              daemon=True)
+        self._watch_thread.start()
+
+    def stop_watching(self) -> None:
+        if self._watch_thread != None:
+            self._stop_event.set()
+            self._watch_thread.join()
+            self._watch_thread = None
+
+    def _watch(self, interval: float) -> None:
+        # An invalid version is reported once, not on every check
+        last_mtime = self._snapshot.mtime
+        while not self._stop_event.wait(interval):
+            mtime = self._mtime(self.path)
+            if mtime != None and mtime != last_mtime:
+                last_mtime = mtime
+                self.reload()
+            for path, watched in list(self._watched_files.items()):
+                fingerprint = self._fingerprint(path)
+                # A deleted file is not reported; it is picked up again once it is recreated
+                if fingerprint == None or fingerprint == watched[1]:
+                    continue
+                watched[1] = fingerprint
+                try:
+                    watched[0](path)
+                except Exception as e:
+                    print(f"Reloading {path} failed: {e}")
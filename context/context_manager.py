@@ -1,24 +1,69 @@
-from typing import Dict, List
+import threading
+from typing import Dict, Sequence
 from config import Config
+from LLM.client_pool import ClientPool
 from .storage_manager import StorageManager
 from .context_trimmer import ContextTrimmer
-from .file_manager import FileManager
+from .storage_backend import create_storage_backend
+from .token_counter import create_token_counter
+from .summarizer import ContextSummarizer
 
 class ContextManager:
-    def __init__(self, config: Config) -> None:
+    def __init__(self, config: Config, client_pool: ClientPool | None = None,
+                 inflight_limit: threading.Semaphore | None = None) -> None:
+        """
+        Args:
+            config: Configuration
+            client_pool: LLM clients the summaries are requested through, shared with the replies
+            inflight_limit: LLM_MAX_INFLIGHT slots the summary requests take, shared with the replies
+        """
         self.config = config
-        self.file_manager = FileManager(config)
-        self.storage = StorageManager(config, self.file_manager)
+        # Where histories and summaries are persisted (CONTEXT_STORAGE_BACKEND)
+        self.backend = create_storage_backend(config)
         self.trimmer = ContextTrimmer(config)
+        # Token counts are only needed (and cached) when trimming to a token budget
+        self.token_counter = create_token_counter(config) if self.trimmer.mode == "tokens" else None
+        self.storage = StorageManager(config, self.backend, self.token_counter)
         self.storage.start_eviction_daemon()
+        # Messages trimmed off the window are folded into a running summary in the background
+        self.summary_enabled = config.context_summary
+        self.summarizer = ContextSummarizer(config, self.backend, client_pool,
+                                            inflight_limit) if self.summary_enabled else None
 
     def append(self, user_id: str, message: Dict) -> None:
         self.storage.add_context(user_id, message)
 
-    def get(self, user_id: str) -> List[Dict]:
-        full_context = self.storage.get_context(user_id)
-        return self.trimmer.trim(full_context)
+    def extend(self, user_id: str, messages: Sequence[Dict]) -> None:
+        """Append the messages of one turn; with the write-ahead log they share one durable commit"""
+        self.storage.add_contexts(user_id, list(messages))
+
+    def get(self, user_id: str, reserved_tokens: int = 0) -> Sequence[Dict]:
+        """
+        Return the trimmed context window as a read-only sequence, without copying it
+
+        Args:
+            user_id: User ID
+            reserved_tokens: Tokens used by the rest of the prompt, subtracted from the token budget in tokens mode
+        """
+        full_context, token_counts, first_seq = self.storage.get_context_window(user_id)
+        trimmed = self.trimmer.trim(full_context, token_counts, reserved_tokens)
+        if self.summarizer != None and len(trimmed) < len(full_context):
+            self.summarizer.submit(user_id, full_context[:len(full_context) - len(trimmed)], first_seq)
+        return trimmed
+
+    def get_summary(self, user_id: str) -> str:
+        """Running summary of the messages that fell out of the window ("" if disabled or none yet)"""
+        if self.summarizer == None:
+            return ""
+        return self.summarizer.get_summary(user_id)
 
     def savefile(self, user_id: str) -> None:
-        context = self.storage.get_context(user_id)
-        self.file_manager.save_context(user_id, context)
\ No newline at end of file
+        # Messages are appended to the history file in the background; wait until they are written
+        self.storage.flush()
+
+    def close(self) -> None:
+        """Persist every message added so far and stop the background threads"""
+        if self.summarizer != None:
+            self.summarizer.join()
+        self.storage.close()
+        self.backend.close()
@@ -1,20 +1,55 @@
-import copy
-from typing import List, Dict
+from typing import Sequence, Dict
 
 from config import Config
 
 class ContextTrimmer:
+    """
+    Selects the part of the history sent to the LLM.
+
+    CONTEXT_TRIM_MODE=messages keeps the latest CONTEXT_WINDOW_LENGTH messages.
+    CONTEXT_TRIM_MODE=tokens keeps as many of the latest messages as fit into
+    CONTEXT_TOKEN_BUDGET, after the tokens reserved for the system prompt, the tool
+    schemas and the new message.
+    """
     def __init__(self, config: Config) -> None:
-        self.window_size = self._validate_window_size(config.context_window_length)
+        self.config = config
+        # The mode decides whether token counts are cached at all, so it is fixed at startup
+        self.mode = config.context_trim_mode
+
+    # The window and the budget are read on every trim, so they can be tuned while the bot runs
+    @property
+    def window_size(self) -> int:
+        return max(10, self.config.context_window_length)
 
-    def _validate_window_size(self, raw_size: int) -> int:
-        return max(10, int(raw_size))
+    @property
+    def token_budget(self) -> int:
+        return self.config.context_token_budget
 
-    def trim(self, full_history: List[Dict]) -> List[Dict]:
-        if len(full_history) <= self.window_size:
-            return copy.deepcopy(full_history)
+    def trim(self, full_history: Sequence[Dict], token_counts: Sequence[int] = (), reserved_tokens: int = 0) -> Sequence[Dict]:
+        """
+        Args:
+            full_history: Read-only history, oldest first
+            token_counts: Cached token count of every message of full_history (tokens mode)
+            reserved_tokens: Tokens already used by the rest of the prompt (tokens mode)
+        """
+        if self.mode == "tokens":
+            return self._trim_to_budget(full_history, token_counts, self.token_budget - reserved_tokens)
+
+        # The history is read-only, so a short one is returned as it is
+        window_size = self.window_size
+        if len(full_history) <= window_size:
+            return full_history
         
         # trim from the latest news
-        trimmed = full_history[-self.window_size:]
+        trimmed = full_history[-window_size:]
         
-        return trimmed
\ No newline at end of file
+        return trimmed
+
+    def _trim_to_budget(self, full_history: Sequence[Dict], token_counts: Sequence[int], budget: int) -> Sequence[Dict]:
+        # Walk back from the latest message using the cached counts, nothing is re-tokenized
+        used = 0
+        start = len(full_history)
+        while start > 0 and used + token_counts[start - 1] <= budget:
+            start -= 1
+            used += token_counts[start]
+        return full_history[start:]
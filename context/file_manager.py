@@ -1,13 +1,32 @@
 import os
 import json
 import base64
-import shutil
-import datetime
+import time
 from typing import List, Dict
 from config import Config
 from locker import Locker
+from .storage_backend import StorageBackend
+
+
+class StorageDirConfig:
+    """Minimal stand-in for Config, for tools that only open a storage directory with FileManager"""
+    def __init__(self, storage_dir: str) -> None:
+        self.context_storage_dir = storage_dir
+
+
+class FileManager(StorageBackend):
+    """
+    Stores the history of every user as an append-only JSONL log (CONTEXT_STORAGE_BACKEND=file).
+
+    Each line is a record {"seq": n, "ts": unix time, "message": {...}}, so saving a
+    new message costs O(1) instead of rewriting the whole history, and loading the
+    latest N messages only reads the end of the file. Histories written by older
+    versions as one JSON array (<name>.json) are migrated on first use.
+    """
+
+    # Size of the blocks read when scanning a log backwards
+    TAIL_BLOCK_SIZE = 64 * 1024
 
-class FileManager:
     def __init__(self, config: Config) -> None:
         self.storage_dir = config.context_storage_dir
         self.file_locker = Locker()
@@ -17,62 +36,254 @@ class FileManager:
         encoded = base64.urlsafe_b64encode(user_id.encode()).decode().rstrip('=')
         return f"{encoded}.json"
 
+    @staticmethod
+    def _decode_filename(filename: str) -> str | None:
+        """User ID of a history file name, or None for files that are not histories"""
+        stem, extension = os.path.splitext(filename)
+        if extension not in (".json", ".jsonl") or "." in stem:
+            return None
+        try:
+            return base64.urlsafe_b64decode(stem + "=" * (-len(stem) % 4)).decode()
+        except (ValueError, UnicodeDecodeError):
+            return None
+
     def _get_filepath(self, user_id: str) -> str:
+        """Path of the legacy JSON array history"""
         filename = self._encode_filename(user_id)
         return os.path.join(self.storage_dir, filename)
 
-    def save_context(self, user_id: str, context: List[Dict]) -> None:
+    def _get_log_filepath(self, user_id: str) -> str:
+        """Path of the append-only JSONL history"""
+        return os.path.splitext(self._get_filepath(user_id))[0] + ".jsonl"
+
+    def _get_summary_filepath(self, user_id: str) -> str:
+        """Path of the running summary stored next to the history"""
+        return os.path.splitext(self._get_filepath(user_id))[0] + ".summary.json"
+
+    @staticmethod
+    def _is_valid_message(message) -> bool:
+        return isinstance(message, dict) and 'role' in message and 'content' in message
+
+    def _read_legacy_records(self, user_id: str) -> List[Dict]:
+        """Read a legacy JSON array history as records"""
         filepath = self._get_filepath(user_id)
-        
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return []
+        if not isinstance(data, list):
+            return []
+        mtime = os.path.getmtime(filepath)
+        return [{"seq": seq, "ts": mtime, "message": message}
+                for seq, message in enumerate(msg for msg in data if self._is_valid_message(msg))]
+
+    def _read_all_records(self, user_id: str) -> List[Dict]:
+        """
+        Read every valid record of a user
+
+        A torn last line (e.g. after a crash during an append) or any other invalid
+        line is skipped instead of discarding the whole history.
+        """
+        log_filepath = self._get_log_filepath(user_id)
+        if not os.path.exists(log_filepath):
+            return self._read_legacy_records(user_id)
+        records = []
+        with open(log_filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(record, dict) and self._is_valid_message(record.get("message")):
+                    records.append(record)
+        return records
+
+    def _write_records(self, user_id: str, records: List[Dict]) -> None:
+        """Atomically replace the log of a user with records. Must hold the user's file lock."""
+        log_filepath = self._get_log_filepath(user_id)
+        # Create temporary file path
+        temp_filepath = log_filepath + '.tmp'
+        try:
+            # Write the content to a temporary file first
+            with open(temp_filepath, 'w', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            # Replace the original file using an atomic rename operation
+            os.replace(temp_filepath, log_filepath)
+        except Exception as e:
+            # If an error occurs, clean up temporary files
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            # Re-throw the exception to ensure the caller knows an error has occurred
+            raise e
+
+    def _migrate_legacy(self, user_id: str) -> None:
+        """Convert a legacy JSON array history into a JSONL log. Must hold the user's file lock."""
+        if os.path.exists(self._get_log_filepath(user_id)) or not os.path.exists(self._get_filepath(user_id)):
+            return
+        self._write_records(user_id, self._read_legacy_records(user_id))
+        # Keep the legacy file as a backup instead of deleting user data
+        os.replace(self._get_filepath(user_id), self._get_filepath(user_id) + ".migrated")
+
+    def append_records(self, user_id: str, records: List[Dict], fsync: bool = False) -> None:
+        """
+        Append records to the end of the user's log
+
+        Args:
+            user_id: User ID
+            records: Records {"seq", "ts", "message"} in seq order
+            fsync: Force the appended data to disk before returning
+        """
+        with self.file_locker.acquire_user_lock(user_id):
+            self._migrate_legacy(user_id)
+            with open(self._get_log_filepath(user_id), 'a', encoding='utf-8') as f:
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+
+    def sync(self, user_id: str) -> None:
+        """Force data appended earlier without fsync to disk"""
+        with self.file_locker.acquire_user_lock(user_id):
+            log_filepath = self._get_log_filepath(user_id)
+            if os.path.exists(log_filepath):
+                with open(log_filepath, 'a', encoding='utf-8') as f:
+                    os.fsync(f.fileno())
+
+    def compact(self, user_id: str, max_messages: int = 0) -> None:
+        """
+        Rewrite the user's log, dropping torn lines and duplicated sequence numbers
+
+        Args:
+            user_id: User ID
+            max_messages: If greater than 0, keep only the latest max_messages messages
+        """
+        with self.file_locker.acquire_user_lock(user_id):
+            self._migrate_legacy(user_id)
+            if not os.path.exists(self._get_log_filepath(user_id)):
+                return
+            records = {}
+            for record in self._read_all_records(user_id):
+                records[record["seq"]] = record
+            compacted = [records[seq] for seq in sorted(records)]
+            if max_messages > 0:
+                compacted = compacted[-max_messages:]
+            self._write_records(user_id, compacted)
+
+    def prune(self, before_ts: float) -> int:
+        """Rewrite the logs that have records older than before_ts without them"""
+        removed = 0
+        for user_id in self.user_ids():
+            with self.file_locker.acquire_user_lock(user_id):
+                self._migrate_legacy(user_id)
+                if not os.path.exists(self._get_log_filepath(user_id)):
+                    continue
+                records = self._read_all_records(user_id)
+                kept = [record for record in records if record.get("ts", 0) >= before_ts]
+                if len(kept) < len(records):
+                    self._write_records(user_id, kept)
+                    removed += len(records) - len(kept)
+        return removed
+
+    def user_ids(self) -> List[str]:
+        user_ids = set()
+        for filename in os.listdir(self.storage_dir):
+            user_id = self._decode_filename(filename)
+            if user_id != None:
+                user_ids.add(user_id)
+        return sorted(user_ids)
+
+    def save_summary(self, user_id: str, summary: Dict) -> None:
+        """Atomically replace the running summary of a user ({"summary": text, "upto_seq": n})"""
+        summary_filepath = self._get_summary_filepath(user_id)
+        temp_filepath = summary_filepath + '.tmp'
+        with self.file_locker.acquire_user_lock(user_id):
+            with open(temp_filepath, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False)
+            os.replace(temp_filepath, summary_filepath)
+
+    def load_summary(self, user_id: str) -> Dict:
+        """Load the running summary of a user; an empty summary covers no message"""
         with self.file_locker.acquire_user_lock(user_id):
-            # If the file already exists, append to the end of the old file
-            # If the file does not exist, create it directly
-            # Create temporary file path
-            temp_filepath = filepath + '.tmp'
-            
             try:
-                # Write the content to a temporary file first
-                with open(temp_filepath, 'w', encoding='utf-8') as f:
-                    if os.path.exists(filepath):
-                        # If the original file exists, first read the content of the original file
-                        with open(filepath, 'r', encoding='utf-8') as original_file:
-                            original_context = json.load(original_file)
-                        if len(original_context) != 0:  
-                            # If the original file is not empty, rename the old context
-                            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                            os.replace(filepath, filepath + "." + timestamp + ".bak")
-                    # Write new content
-                    json.dump(context, f, ensure_ascii=False, indent=2)
-                
-                # Replace the original file using an atomic rename operation
-                os.replace(temp_filepath, filepath)
-                
-            except Exception as e:
-                # If an error occurs, clean up temporary files
-                if os.path.exists(temp_filepath):
-                    os.remove(temp_filepath)
-                # Re-throw the exception to ensure the caller knows an error has occurred
-                raise e
-
-
-    def load_context(self, user_id: str) -> List[Dict]:
-        filepath = self._get_filepath(user_id)
-        if not os.path.exists(filepath):
+                with open(self._get_summary_filepath(user_id), 'r', encoding='utf-8') as f:
+                    summary = json.load(f)
+                if isinstance(summary, dict) and "summary" in summary and "upto_seq" in summary:
+                    return summary
+            except (OSError, json.JSONDecodeError):
+                pass
+        return {"summary": "", "upto_seq": 0}
+
+    def save_context(self, user_id: str, context: List[Dict]) -> None:
+        """Replace the whole history of a user with context"""
+        now = time.time()
+        with self.file_locker.acquire_user_lock(user_id):
+            self._write_records(user_id, [{"seq": seq, "ts": now, "message": message}
+                                          for seq, message in enumerate(context)])
+
+    def _read_tail_records(self, user_id: str, limit: int) -> List[Dict]:
+        """
+        Read the last limit valid records by scanning the log backwards
+
+        Only the blocks containing those records are read, so the cost is O(limit)
+        whatever the length of the history.
+        """
+        records = []
+        with open(self._get_log_filepath(user_id), 'rb') as f:
+            position = f.seek(0, os.SEEK_END)
+            # Bytes of a line whose beginning has not been read yet
+            partial = b""
+            while position > 0 and len(records) < limit:
+                read_size = min(self.TAIL_BLOCK_SIZE, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + partial).split(b"\n")
+                # The first piece may continue in the previous block, unless the start of the file was reached
+                partial = lines.pop(0) if position > 0 else b""
+                for line in reversed(lines):
+                    record = self._parse_record(line)
+                    if record != None:
+                        records.append(record)
+                        if len(records) == limit:
+                            break
+            if len(records) < limit and partial:
+                record = self._parse_record(partial)
+                if record != None:
+                    records.append(record)
+        records.reverse()
+        return records
+
+    def _parse_record(self, line: bytes) -> Dict | None:
+        """Parse one log line, returning None for empty, torn or invalid lines"""
+        if not line.strip():
+            return None
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return None
+        if isinstance(record, dict) and self._is_valid_message(record.get("message")):
+            return record
+        return None
+
+    def load_records(self, user_id: str, limit: int = 50) -> List[Dict]:
+        """
+        Load the latest records of a user
+
+        Args:
+            user_id: User ID
+            limit: Maximum number of records to return
+
+        Returns:
+            The latest records in seq order
+        """
+        if limit <= 0:
             return []
-        
         with self.file_locker.acquire_user_lock(user_id):
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # If the message history exceeds 50, keep only the last 50
-                    if isinstance(data, list) and len(data) > 50:
-                        data = data[-50:]
-                if not isinstance(data, list) or not all(isinstance(msg, dict) and 'role' in msg and 'content' in msg for msg in data):
-                    raise ValueError("Invalid context structure")
-                return data
-            except (json.JSONDecodeError, ValueError):
-                backup_path = f"{filepath}.bak"
-                shutil.move(filepath, backup_path)
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    json.dump([], f)
-                return []
\ No newline at end of file
+            # A legacy history has to be parsed completely once; afterwards only the tail is read
+            self._migrate_legacy(user_id)
+            if not os.path.exists(self._get_log_filepath(user_id)):
+                return []
+            return self._read_tail_records(user_id, limit)
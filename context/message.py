@@ -0,0 +1,44 @@
+from typing import Any, Dict
+
+
+class FrozenMessage(dict):
+    """
+    Read-only chat message
+
+    Cached context is shared with every reader instead of being deep-copied on each
+    read, so its messages must not change. FrozenMessage is a dict subclass (it can be
+    passed to the OpenAI client and json.dumps as-is) whose mutating methods raise.
+    """
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Cached messages are read-only, build a new dict instead")
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    __ior__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __copy__(self) -> "FrozenMessage":
+        return self
+
+    def __deepcopy__(self, memo: Dict) -> "FrozenMessage":
+        return self
+
+    def __reduce__(self):
+        return (FrozenMessage, (dict(self),))
+
+
+def freeze(value: Any) -> Any:
+    """Return a read-only version of a message: dicts become FrozenMessage, lists become tuples"""
+    if isinstance(value, FrozenMessage):
+        return value
+    if isinstance(value, dict):
+        return FrozenMessage({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
@@ -0,0 +1,77 @@
+"""
+Import the file-based chat history into the SQLite storage backend
+
+Every history in the source directory (JSONL logs, and legacy JSON arrays that
+were never migrated) is copied into the database with its sequence numbers and
+timestamps, together with the running summaries. Duplicated and torn records are
+dropped on the way; .bak copies are ignored. The source files are left untouched
+and running the tool again is harmless, so it can be repeated before switching
+CONTEXT_STORAGE_BACKEND to sqlite.
+
+Usage:
+    python -m context.migrate_storage [--source ./chat_history] [--database ./chat_history/history.db]
+                                      [--batch 1000]
+By default both paths come from the .env (CONTEXT_STORAGE_DIR and CONTEXT_SQLITE_PATH).
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context.file_manager import FileManager, StorageDirConfig
+from context.sqlite_storage import SQLiteStorage
+
+
+def migrate(source: FileManager, target: SQLiteStorage, batch_size: int = 1000) -> tuple:
+    """
+    Copy every history and summary of source into target
+
+    Returns:
+        (users, records) copied
+    """
+    users = records_copied = 0
+    for user_id in source.user_ids():
+        records = {}
+        for record in source._read_all_records(user_id):
+            records[record["seq"]] = record
+        ordered = [records[seq] for seq in sorted(records)]
+        for start in range(0, len(ordered), batch_size):
+            target.append_records(user_id, ordered[start:start + batch_size])
+        summary = source.load_summary(user_id)
+        if summary["summary"]:
+            target.save_summary(user_id, summary)
+        users += 1
+        records_copied += len(ordered)
+    target.sync("")
+    return users, records_copied
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", help="Directory of the file-based history (default: CONTEXT_STORAGE_DIR)")
+    parser.add_argument("--database", help="SQLite database (default: CONTEXT_SQLITE_PATH or <source>/history.db)")
+    parser.add_argument("--batch", type=int, default=1000, help="Records inserted per transaction")
+    args = parser.parse_args()
+
+    source_dir, database = args.source, args.database
+    if source_dir == None or database == None:
+        from config import Config
+        config = Config()
+        source_dir = source_dir or config.context_storage_dir
+        database = database or config.context_sqlite_path
+    database = database or os.path.join(source_dir, "history.db")
+
+    start = time.monotonic()
+    target = SQLiteStorage(database)
+    try:
+        users, records = migrate(FileManager(StorageDirConfig(source_dir)), target, args.batch)
+    finally:
+        target.close()
+    print(f"Imported {records} records of {users} users from {source_dir} into {database} "
+          f"in {time.monotonic() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+from .storage_backend import StorageBackend
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    Stores every user's history in one SQLite database (CONTEXT_STORAGE_BACKEND=sqlite).
+
+    Records are rows of messages(user_id, seq, ts, message) keyed by (user_id, seq),
+    so the tail of a history is an index range scan whatever the number of chats,
+    and retention is a single DELETE on the ts index. The database runs in WAL mode:
+    all writes go through one writer connection, one transaction per batch, while
+    every reading thread has its own connection and never blocks the writer.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            message TEXT NOT NULL,
+            PRIMARY KEY (user_id, seq)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            upto_seq INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path: str, synchronous_full: bool = False) -> None:
+        """
+        Args:
+            path: Database file, created if missing
+            synchronous_full: fsync every commit; otherwise commits are synced at checkpoints (sync())
+        """
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._synchronous = "FULL" if synchronous_full else "NORMAL"
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.executescript(self.SCHEMA)
+        # Readers of every thread, closed together by close()
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(f"PRAGMA synchronous={self._synchronous}")
+        connection.execute("PRAGMA busy_timeout=5000")
+        return connection
+
+    def _reader(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection == None:
+            connection = self._connect()
+            self._local.connection = connection
+            with self._readers_lock:
+                self._readers.append(connection)
+        return connection
+
+    def _write(self, statements: List[tuple]) -> int:
+        """Run (sql, parameters or list of parameters) statements in one transaction; returns the rows changed"""
+        changed = 0
+        with self._write_lock:
+            cursor = self._writer.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, parameters in statements:
+                    if isinstance(parameters, list):
+                        cursor.executemany(sql, parameters)
+                    else:
+                        cursor.execute(sql, parameters)
+                    changed += max(0, cursor.rowcount)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        return changed
+
+    @staticmethod
+    def _to_row(user_id: str, record: Dict) -> tuple:
+        return (user_id, record["seq"], record.get("ts", 0), json.dumps(record["message"], ensure_ascii=False))
+
+    def append_records(self, user_id: str, records: List[Dict], fsync: bool = False) -> None:
+        # A record written twice (e.g. replayed from the write-ahead log) replaces itself
+        self._write([("INSERT OR REPLACE INTO messages (user_id, seq, ts, message) VALUES (?, ?, ?, ?)",
+                      [self._to_row(user_id, record) for record in records])])
+        if fsync and self._synchronous != "FULL":
+            self.sync(user_id)
+
+    def append_batch(self, batch: Dict[str, List[Dict]], fsync: bool = False) -> Dict[str, Exception]:
+        # One transaction for the whole batch; if it fails, retry user by user to isolate the failure
+        try:
+            rows = [self._to_row(user_id, record) for user_id, records in batch.items() for record in records]
+            self._write([("INSERT OR REPLACE INTO messages (user_id, seq, ts, message) VALUES (?, ?, ?, ?)", rows)])
+        except Exception:
+            return super().append_batch(batch, fsync)
+        if fsync and self._synchronous != "FULL":
+            self.sync("")
+        return {}
+
+    def sync(self, user_id: str) -> None:
+        # In WAL mode with synchronous=NORMAL, a checkpoint syncs every commit made so far
+        with self._write_lock:
+            self._writer.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def sync_batch(self, user_ids: List[str]) -> Dict[str, Exception]:
+        # The database is shared by every user, so one checkpoint syncs them all
+        if not user_ids:
+            return {}
+        try:
+            self.sync("")
+        except Exception as e:
+            return {user_id: e for user_id in user_ids}
+        return {}
+
+    def load_records(self, user_id: str, limit: int = 50) -> List[Dict]:
+        if limit <= 0:
+            return []
+        rows = self._reader().execute(
+            "SELECT seq, ts, message FROM messages WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+            (user_id, limit)).fetchall()
+        return [{"seq": seq, "ts": ts, "message": json.loads(message)} for seq, ts, message in reversed(rows)]
+
+    def save_context(self, user_id: str, context: List[Dict]) -> None:
+        now = time.time()
+        self._write([("DELETE FROM messages WHERE user_id = ?", (user_id,)),
+                     ("INSERT INTO messages (user_id, seq, ts, message) VALUES (?, ?, ?, ?)",
+                      [self._to_row(user_id, {"seq": seq, "ts": now, "message": message})
+                       for seq, message in enumerate(context)])])
+
+    def compact(self, user_id: str, max_messages: int = 0) -> None:
+        # Rows are unique per (user_id, seq), so only the length limit applies
+        if max_messages <= 0:
+            return
+        self._write([("DELETE FROM messages WHERE user_id = ? AND seq <= "
+                      "(SELECT seq FROM messages WHERE user_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                      (user_id, user_id, max_messages))])
+
+    def prune(self, before_ts: float) -> int:
+        return self._write([("DELETE FROM messages WHERE ts < ?", (before_ts,))])
+
+    def user_ids(self) -> List[str]:
+        rows = self._reader().execute("SELECT DISTINCT user_id FROM messages ORDER BY user_id").fetchall()
+        return [user_id for user_id, in rows]
+
+    def save_summary(self, user_id: str, summary: Dict) -> None:
+        self._write([("INSERT OR REPLACE INTO summaries (user_id, summary, upto_seq) VALUES (?, ?, ?)",
+                      (user_id, summary["summary"], summary["upto_seq"]))])
+
+    def load_summary(self, user_id: str) -> Dict:
+        row = self._reader().execute("SELECT summary, upto_seq FROM summaries WHERE user_id = ?",
+                                     (user_id,)).fetchone()
+        if row == None:
+            return {"summary": "", "upto_seq": 0}
+        return {"summary": row[0], "upto_seq": row[1]}
+
+    def close(self) -> None:
+        with self._readers_lock:
+            for connection in self._readers:
+                connection.close()
+            self._readers.clear()
+        with self._write_lock:
+            self._writer.close()
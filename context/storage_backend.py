@@ -0,0 +1,142 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, List
+
+from config import Config
+
+
+class StorageBackend(ABC):
+    """
+    Persistent storage of the users' history and running summaries.
+
+    Histories are sequences of records {"seq": n, "ts": unix time, "message": {...}}
+    numbered consecutively per user. Everything above this interface (the write-behind
+    writer, the write-ahead log, the cache) only appends records and reads the tail,
+    so a backend has to make those two cheap. CONTEXT_STORAGE_BACKEND selects it:
+        file   - one append-only JSONL log per user (FileManager, default)
+        sqlite - one SQLite database in WAL mode (SQLiteStorage)
+    A backend missing one of the abstract methods cannot be instantiated.
+    """
+
+    @abstractmethod
+    def append_records(self, user_id: str, records: List[Dict], fsync: bool = False) -> None:
+        """
+        Append records to the end of the user's history
+
+        Args:
+            user_id: User ID
+            records: Records {"seq", "ts", "message"} in seq order
+            fsync: Force the appended data to disk before returning
+        """
+        raise NotImplementedError
+
+    def append_batch(self, batch: Dict[str, List[Dict]], fsync: bool = False) -> Dict[str, Exception]:
+        """
+        Append the records of several users, e.g. one write-behind batch
+
+        Returns:
+            The error of every user whose records could not be appended
+        """
+        failures = {}
+        for user_id, records in batch.items():
+            try:
+                self.append_records(user_id, records, fsync)
+            except Exception as e:
+                failures[user_id] = e
+        return failures
+
+    @abstractmethod
+    def sync(self, user_id: str) -> None:
+        """Force data appended earlier without fsync to disk"""
+        raise NotImplementedError
+
+    def sync_batch(self, user_ids: List[str]) -> Dict[str, Exception]:
+        """
+        Sync the data of several users appended without fsync, e.g. at a write-behind checkpoint
+
+        Returns:
+            The error of every user whose data could not be synced
+        """
+        failures = {}
+        for user_id in user_ids:
+            try:
+                self.sync(user_id)
+            except Exception as e:
+                failures[user_id] = e
+        return failures
+
+    @abstractmethod
+    def load_records(self, user_id: str, limit: int = 50) -> List[Dict]:
+        """
+        Load the latest records of a user
+
+        Args:
+            user_id: User ID
+            limit: Maximum number of records to return
+
+        Returns:
+            The latest records in seq order
+        """
+        raise NotImplementedError
+
+    def load_context(self, user_id: str) -> List[Dict]:
+        # Keep only the last 50 messages
+        return [record["message"] for record in self.load_records(user_id, 50)]
+
+    @abstractmethod
+    def save_context(self, user_id: str, context: List[Dict]) -> None:
+        """Replace the whole history of a user with context"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def compact(self, user_id: str, max_messages: int = 0) -> None:
+        """
+        Drop invalid and duplicated records of a user
+
+        Args:
+            user_id: User ID
+            max_messages: If greater than 0, keep only the latest max_messages messages
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def prune(self, before_ts: float) -> int:
+        """
+        Retention: delete the records of every user older than before_ts
+
+        Returns:
+            Number of records deleted
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def user_ids(self) -> List[str]:
+        """Every user with a stored history"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_summary(self, user_id: str, summary: Dict) -> None:
+        """Atomically replace the running summary of a user ({"summary": text, "upto_seq": n})"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_summary(self, user_id: str) -> Dict:
+        """Load the running summary of a user; an empty summary covers no message"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Release files and connections"""
+        pass
+
+
+def create_storage_backend(config: Config) -> StorageBackend:
+    """Build the StorageBackend selected by CONTEXT_STORAGE_BACKEND"""
+    backend = config.context_storage_backend
+    if backend == "file":
+        from .file_manager import FileManager
+        return FileManager(config)
+    if backend == "sqlite":
+        from .sqlite_storage import SQLiteStorage
+        path = config.context_sqlite_path or os.path.join(config.context_storage_dir, "history.db")
+        return SQLiteStorage(path, synchronous_full=config.context_fsync_policy == "always")
+    raise ValueError(f"Unknown CONTEXT_STORAGE_BACKEND: {backend}")
@@ -1,84 +1,255 @@
 import threading
 import time
-import copy
+from collections import OrderedDict
 from typing import Dict, List, Tuple
 
 from config import Config
 from locker import Locker
-from .file_manager import FileManager
+from tracing import tracer
+from .storage_backend import StorageBackend
+from .message import FrozenMessage, freeze
+from .token_counter import TokenCounter
+from .wal import WriteAheadLog
+from .write_behind import WriteBehindWriter
+
+
+class _CacheEntry:
+    """Working window of one user held in memory"""
+    __slots__ = ("messages", "token_counts", "last_access", "next_seq", "size")
+
+    def __init__(self, messages: Tuple[FrozenMessage, ...], token_counts: Tuple[int, ...], next_seq: int,
+                 size: int) -> None:
+        # Immutable: appending builds a new tuple, so readers can keep the old one without copying
+        self.messages = messages
+        # Token count of each message, computed once when it enters the cache (empty without a counter)
+        self.token_counts = token_counts
+        self.last_access = time.time()
+        # Sequence number of the next message appended to the user's log
+        self.next_seq = next_seq
+        # Estimated memory used by the messages, in bytes
+        self.size = size
 
 
 class StorageManager:
-    def __init__(self, config: Config, file_manager: FileManager) -> None:
+    """
+    Memory-bounded LRU cache of the users' recent context.
+
+    Each entry holds only the latest CONTEXT_CACHE_WINDOW messages as a tuple of
+    read-only FrozenMessage, which readers share without copying; older messages
+    live on disk and messages not written yet wait in the write-behind queue. The
+    cache is capped by CONTEXT_CACHE_MAX_ENTRIES entries and CONTEXT_CACHE_MAX_BYTES
+    estimated bytes, evicting the least recently used users first, and entries idle
+    for CONTEXT_STAY_DURATION seconds are dropped by the eviction daemon.
+
+    With CONTEXT_WAL enabled (the default), every new message is also appended to
+    the write-ahead log, and add_context returns only once it is on disk, so a
+    crash loses nothing that was acknowledged. The log is replayed on startup.
+    """
+
+    # Estimated fixed cost of a cached message (dict and string headers)
+    MESSAGE_OVERHEAD = 200
+
+    def __init__(self, config: Config, backend: StorageBackend, token_counter: TokenCounter | None = None) -> None:
         self.config = config
-        self.file_manager = file_manager
-        self._cache: Dict[str, Tuple[List[dict], float]] = {}
+        self.backend = backend
+        self.token_counter = token_counter
+        self.window = self.config.context_cache_window
+        # Ordered from least to most recently used, so eviction pops from the front in O(1)
+        self._cache: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        # Guards the order of _cache, the byte total and the counters; per-user locks guard the entries
+        self._cache_lock = threading.Lock()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
         self._locker = Locker()
         self._stop_event = threading.Event()
+        self.wal = None
+        if self.config.context_wal:
+            self.wal = WriteAheadLog(config, backend)
+            # Recover what a crash left in the log before anything is read or written
+            self.wal.replay()
+            self.wal.start()
+        # New messages are persisted by appending them in the background
+        self.writer = WriteBehindWriter(config, backend, self.wal)
+
+    @classmethod
+    def _estimate_size(cls, message: dict) -> int:
+        content = message.get("content")
+        return cls.MESSAGE_OVERHEAD + (len(content.encode("utf-8")) if isinstance(content, str) else 0)
+
+    def _count_tokens(self, messages: Tuple[FrozenMessage, ...]) -> Tuple[int, ...]:
+        if self.token_counter == None:
+            return ()
+        return tuple(self.token_counter.count_message(message) for message in messages)
+
+    def _get_entry(self, user_id: str) -> _CacheEntry:
+        """Return the cache entry of a user, loading it on a miss. Must hold the user's lock."""
+        with self._cache_lock:
+            entry = self._cache.get(user_id)
+            if entry != None:
+                self._cache.move_to_end(user_id)
+                self._hits += 1
+                entry.last_access = time.time()
+                return entry
+            self._misses += 1
+
+        with tracer.span("context_disk_load"):
+            # A reload must see the messages still waiting in the write-behind queue
+            if self.writer.has_pending(user_id):
+                self.writer.flush()
+            records = self.backend.load_records(user_id, self.window)
+        messages = tuple(freeze(record["message"]) for record in records)
+        next_seq = records[-1]["seq"] + 1 if records else 0
+        entry = _CacheEntry(messages, self._count_tokens(messages), next_seq,
+                            sum(self._estimate_size(message) for message in messages))
+        with self._cache_lock:
+            self._cache[user_id] = entry
+            self._total_bytes += entry.size
+            self._enforce_limits(user_id)
+        return entry
+
+    def _enforce_limits(self, current_user_id: str) -> None:
+        """Evict least recently used entries until the cache fits its limits. Must hold _cache_lock."""
+        entries = len(self._cache)
+        total_bytes = self._total_bytes
+        # The limits are read on every check, so they can be tuned while the bot runs
+        max_entries, max_bytes = self.config.context_cache_max_entries, self.config.context_cache_max_bytes
+        victims = []
+        # Walk from the least recently used end only as far as needed, O(1) per evicted entry
+        for user_id, entry in self._cache.items():
+            if entries <= max_entries and total_bytes <= max_bytes:
+                break
+            if user_id == current_user_id:
+                continue
+            victims.append(user_id)
+            entries -= 1
+            total_bytes -= entry.size
+        self._remove_unused(victims)
+
+    def _remove_unused(self, user_ids: List[str]) -> None:
+        """Drop the entries of user_ids that are not in use right now. Must hold _cache_lock."""
+        for user_id in user_ids:
+            user_lock = self._locker.acquire_user_lock(user_id)
+            # Skip users whose entry is being used right now; they will be checked again later
+            if not user_lock.acquire(blocking=False):
+                continue
+            try:
+                self._remove(user_id)
+            finally:
+                user_lock.release()
+
+    def _remove(self, user_id: str) -> None:
+        """Drop an entry. Its messages are already on disk or queued for writing. Must hold _cache_lock."""
+        entry = self._cache.pop(user_id)
+        self._total_bytes -= entry.size
+        self._evictions += 1
 
     def add_context(self, user_id: str, context: dict) -> None:
+        self.add_contexts(user_id, [context])
+
+    def add_contexts(self, user_id: str, contexts: List[dict]) -> None:
+        """
+        Append messages to a user's context
+
+        With the write-ahead log, this blocks until the messages are durable. Appending
+        the messages of a turn together makes them share one group commit.
+        """
+        lsn = None
         with self._locker.acquire_user_lock(user_id):
             # If the user does not exist, try to load from the hard disk
-            if user_id not in self._cache:
-                self._cache[user_id] = (self.file_manager.load_context(user_id), time.time())
-            # Get the current context list and add a new context
-            current_contexts = self._cache[user_id][0]
-            current_contexts.append(context)
-            # Update cache and timestamp
-            self._cache[user_id] = (current_contexts, time.time())
-
-    def get_context(self, user_id: str) -> List[dict]:
+            entry = self._get_entry(user_id)
+            messages = tuple(freeze(context) for context in contexts)
+            for message in messages:
+                record = {"seq": entry.next_seq, "ts": time.time(), "message": message}
+                if self.wal != None:
+                    lsn = self.wal.append(user_id, record)
+                # Only the new message is written to the user log, in the background
+                self.writer.enqueue(user_id, record, lsn)
+                entry.next_seq += 1
+            # Add the new context (copy-on-write) and keep only the working window in memory
+            combined = entry.messages + messages
+            excess = max(0, len(combined) - self.window)
+            dropped = combined[:excess]
+            entry.messages = combined[excess:]
+            if self.token_counter != None:
+                entry.token_counts = (entry.token_counts + self._count_tokens(messages))[excess:]
+            size_change = sum(self._estimate_size(message) for message in messages) \
+                - sum(self._estimate_size(item) for item in dropped)
+            with self._cache_lock:
+                entry.size += size_change
+                if self._cache.get(user_id) is entry:
+                    self._total_bytes += size_change
+                    self._enforce_limits(user_id)
+        if lsn != None:
+            # Wait outside the user lock, so other threads keep appending into the same commit
+            with tracer.span("context_wal_wait"):
+                self.wal.wait(lsn)
+
+    def get_context(self, user_id: str) -> Tuple[FrozenMessage, ...]:
         """Get user context information
-        
+
         Args:
             user_id (str): User ID
-            
+
         Returns:
-            List[dict]: Deep copy of the user's context information list
-            
+            Tuple[FrozenMessage, ...]: The user's cached context (the latest CONTEXT_CACHE_WINDOW messages)
+
         Notes:
             1. Use thread lock to ensure thread safety
             2. If the user's context is not in the cache, load it from the file
-            3. Update the last access time of the user's context
-            4. Return a deep copy of the context to prevent external modifications from affecting the cache
+            3. Mark the user's context as most recently used
+            4. The context is returned without copying: the tuple and its messages are read-only,
+               and later appends replace the tuple instead of modifying it
         """
         with self._locker.acquire_user_lock(user_id):
-            # If the user context is not in the cache, load it from the file
-            if user_id not in self._cache:
-                self._cache[user_id] = (self.file_manager.load_context(user_id), time.time())
-            # Update Last Access Time
-            else:
-                self._cache[user_id] = (self._cache[user_id][0], time.time())
-            # Return a deep copy of the context
-            return copy.deepcopy(self._cache[user_id][0])
+            return self._get_entry(user_id).messages
+
+    def get_context_window(self, user_id: str) -> Tuple[Tuple[FrozenMessage, ...], Tuple[int, ...], int]:
+        """
+        Like get_context, also returning the cached token count of every message and the
+        sequence number of the first message (messages are numbered consecutively)
+        """
+        with self._locker.acquire_user_lock(user_id):
+            entry = self._get_entry(user_id)
+            return entry.messages, entry.token_counts, entry.next_seq - len(entry.messages)
+
+    def flush(self) -> None:
+        """Block until every message added so far has been written to the hard disk"""
+        self.writer.flush()
+
+    def close(self) -> None:
+        """Write and sync everything queued, stop the background threads and retire the write-ahead log"""
+        self._stop_event.set()
+        self.writer.stop()
+        if self.wal != None:
+            self.wal.stop(self.writer.written_lsn)
+
+    def stats(self) -> Dict[str, int]:
+        """Cache counters: hits, misses, evictions, current entries and estimated bytes"""
+        with self._cache_lock:
+            return {"hits": self._hits, "misses": self._misses, "evictions": self._evictions,
+                    "entries": len(self._cache), "bytes": self._total_bytes}
 
     def _evict_expired_contexts(self) -> None:
         """
         Regularly check and clean up expired context cache
-        
-        This listener thread uses seconds as the unit for checking because:
-        1. It needs to promptly respond to new user visits and reset the expiration time
-        2. It needs to ensure data security by saving to file before deletion
-        3. It needs to handle concurrent access scenarios
+
+        Entries are ordered by last access, so the scan starts at the least recently
+        used entry and stops at the first one that has not expired.
         """
         while not self._stop_event.is_set():
-            time.sleep(min(int(self.config.context_stay_duration)/2, 60))
-            now = time.time()
-            # 1. Take a snapshot of cache keys (to avoid dictionary modification during traversal)
-            uid_snapshot = list(self._cache.keys())
-            
-            for uid in uid_snapshot:
-                with self._locker.acquire_user_lock(uid):
-                    # 2. Secondary Verification: Check If the Cache Item Still Exists
-                    if uid not in self._cache:
-                        continue  # May have been deleted by another thread
-
-                    # 3. Get the latest timestamp within the lock (to prevent timestamp expiration)
-                    _, timestamp = self._cache[uid]
-                    if (now - timestamp) >= int(self.config.context_stay_duration):
-                        self.file_manager.save_context(uid, self._cache[uid][0])
-                        del self._cache[uid]
+            time.sleep(min(self.config.context_stay_duration/2, 60))
+            stay_duration = self.config.context_stay_duration
+            with self._cache_lock:
+                now = time.time()
+                expired = []
+                for user_id, entry in self._cache.items():
+                    if now - entry.last_access < stay_duration:
+                        break
+                    expired.append(user_id)
+                self._remove_unused(expired)
 
     def start_eviction_daemon(self) -> None:
         thread = threading.Thread(target=self._evict_expired_contexts, daemon=True)
-        thread.start()
\ No newline at end of file
+        thread.start()
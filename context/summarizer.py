@@ -0,0 +1,141 @@
+import threading
+from queue import Queue
+from typing import Dict, List, Sequence, Tuple
+
+from config import Config
+from LLM.client_pool import ClientPool
+from .storage_backend import StorageBackend
+
+SUMMARY_INSTRUCTION = (
+    "You maintain a running summary of a chat between a user and an assistant. "
+    "Update the summary with the new messages below. Keep facts about the user, their requests, "
+    "decisions and open questions; drop greetings and small talk. "
+    "Answer with the updated summary only, in the language of the conversation, in at most {max_words} words."
+)
+
+
+class ContextSummarizer:
+    """
+    Folds messages that fall out of the context window into a per-user running summary.
+
+    ContextManager.get reports the messages trimmed off the window; they are queued
+    here and, once SUMMARY_BATCH_SIZE of them are pending for a user, a background
+    thread asks the LLM to merge them into that user's summary. The summary and the
+    sequence number up to which it covers the history are stored next to the history,
+    so nothing is summarized twice. The reply path never waits for a summary.
+
+    Requests go through the client pool and LLM_MAX_INFLIGHT slots shared with the
+    replies, or through a pool of their own when SUMMARY_ENDPOINT is set.
+    """
+
+    def __init__(self, config: Config, backend: StorageBackend, client_pool: ClientPool | None = None,
+                 inflight_limit: threading.Semaphore | None = None) -> None:
+        self.config = config
+        self.backend = backend
+        if self.config.summary_endpoint:
+            client_pool = ClientPool(config, specs=((self.config.summary_endpoint, "", 1.0,
+                                                     self.config.summary_key or ""),))
+        self.client_pool = client_pool if client_pool != None else ClientPool(config)
+        self.inflight_limit = inflight_limit if inflight_limit != None else threading.BoundedSemaphore(
+            config.llm_max_inflight)
+        self._lock = threading.Lock()
+        # user_id -> {"summary": text, "upto_seq": first sequence number not covered}
+        self._summaries: Dict[str, Dict] = {}
+        # user_id -> {seq: message} waiting to be folded
+        self._pending: Dict[str, Dict[int, Dict]] = {}
+        # Users queued for the worker, each at most once
+        self._queued: set = set()
+        self._queue: Queue = Queue()
+        self._thread = threading.Thread(target=self._run, name="context-summarizer", daemon=True)
+        self._thread.start()
+
+    def _get_state(self, user_id: str) -> Dict:
+        """Must hold _lock"""
+        if user_id not in self._summaries:
+            self._summaries[user_id] = self.backend.load_summary(user_id)
+        return self._summaries[user_id]
+
+    def get_summary(self, user_id: str) -> str:
+        with self._lock:
+            return self._get_state(user_id)["summary"]
+
+    def submit(self, user_id: str, messages: Sequence[Dict], first_seq: int) -> None:
+        """
+        Queue messages that fell out of the window
+
+        Args:
+            user_id: User ID
+            messages: Consecutive messages trimmed off the window, oldest first
+            first_seq: Sequence number of messages[0]
+        """
+        with self._lock:
+            upto_seq = self._get_state(user_id)["upto_seq"]
+            pending = self._pending.setdefault(user_id, {})
+            for offset, message in enumerate(messages):
+                seq = first_seq + offset
+                if seq >= upto_seq:
+                    pending[seq] = message
+            if len(pending) >= self.config.summary_batch_size and user_id not in self._queued:
+                self._queued.add(user_id)
+                self._queue.put(user_id)
+            elif not pending:
+                del self._pending[user_id]
+
+    def join(self) -> None:
+        """Block until every queued summarization has finished"""
+        self._queue.join()
+
+    def _build_request(self, summary: str, messages: List[Tuple[int, Dict]]) -> List[Dict]:
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for _, message in messages
+                               if message.get("content"))
+        return [
+            {"role": "system", "content": SUMMARY_INSTRUCTION.format(max_words=self.config.summary_max_words)},
+            {"role": "user", "content": f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n{transcript}"},
+        ]
+
+    def _summarize(self, user_id: str) -> None:
+        with self._lock:
+            self._queued.discard(user_id)
+            pending = self._pending.pop(user_id, {})
+            state = self._get_state(user_id)
+            messages = sorted((seq, message) for seq, message in pending.items() if seq >= state["upto_seq"])
+            summary = state["summary"]
+        if not messages:
+            return
+        # The summary may only advance over consecutive messages; later ones wait for the gap to be filled
+        run = 1
+        while run < len(messages) and messages[run][0] == messages[run - 1][0] + 1:
+            run += 1
+        messages, later = messages[:run], messages[run:]
+        if later:
+            with self._lock:
+                self._pending.setdefault(user_id, {}).update(dict(later))
+
+        def attempt(endpoint, on_segment, cancel) -> str:
+            response = endpoint.client.chat.completions.create(
+                model=self.config.summary_model_name or endpoint.model or self.config.model_name,
+                messages=self._build_request(summary, messages),
+                temperature=0.3)
+            return (response.choices[0].message.content or "").strip()
+
+        try:
+            with self.inflight_limit:
+                new_summary = self.client_pool.request(attempt)
+        except Exception as e:
+            print(f"Failed to summarize context of {user_id}: {e}")
+            # Put the messages back, they are retried with the next batch
+            with self._lock:
+                self._pending.setdefault(user_id, {}).update(dict(messages))
+            return
+        new_state = {"summary": new_summary, "upto_seq": messages[-1][0] + 1}
+        with self._lock:
+            self._summaries[user_id] = new_state
+        self.backend.save_summary(user_id, new_state)
+
+    def _run(self) -> None:
+        while True:
+            user_id = self._queue.get()
+            try:
+                self._summarize(user_id)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,64 @@
+import importlib
+import json
+import math
+from typing import Callable, Dict
+
+from config import Config
+
+# Fixed cost of the role and separators of every chat message, as counted by OpenAI models
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def _is_cjk(char: str) -> bool:
+    code = ord(char)
+    return (0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or 0x3000 <= code <= 0x303F
+            or 0xFF00 <= code <= 0xFFEF or 0x3040 <= code <= 0x30FF or 0xAC00 <= code <= 0xD7AF)
+
+
+def estimate_tokens(text: str) -> int:
+    """Offline estimate: one token per CJK character, one per four other characters"""
+    cjk = sum(1 for char in text if _is_cjk(char))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class TokenCounter:
+    """
+    Counts the tokens of messages with a pluggable text estimator
+
+    CONTEXT_TOKENIZER selects the estimator:
+        heuristic             - estimate_tokens, needs nothing installed (default)
+        tiktoken[:encoding]   - the tiktoken package with a locally cached encoding (cl100k_base by default)
+        package.module:name   - any callable taking a string and returning its token count
+    """
+
+    def __init__(self, count_text: Callable[[str], int]) -> None:
+        self.count_text = count_text
+
+    def count_message(self, message: Dict) -> int:
+        tokens = MESSAGE_TOKEN_OVERHEAD
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += self.count_text(content)
+        elif content:
+            tokens += self.count_text(json.dumps(content, ensure_ascii=False))
+        if message.get("tool_calls"):
+            tokens += self.count_text(json.dumps(message["tool_calls"], ensure_ascii=False))
+        return tokens
+
+
+def create_token_counter(config: Config) -> TokenCounter:
+    """Build the TokenCounter selected by CONTEXT_TOKENIZER"""
+    tokenizer = config.context_tokenizer
+    if tokenizer == "heuristic":
+        return TokenCounter(estimate_tokens)
+    if tokenizer.split(":", 1)[0] == "tiktoken":
+        try:
+            import tiktoken
+        except ImportError:
+            raise ImportError("CONTEXT_TOKENIZER=tiktoken requires the tiktoken package: pip install tiktoken")
+        encoding = tiktoken.get_encoding(tokenizer.split(":", 1)[1] if ":" in tokenizer else "cl100k_base")
+        return TokenCounter(lambda text: len(encoding.encode(text, disallowed_special=())))
+    if ":" in tokenizer:
+        module_name, function_name = tokenizer.split(":", 1)
+        return TokenCounter(getattr(importlib.import_module(module_name), function_name))
+    raise ValueError(f"Unknown CONTEXT_TOKENIZER '{tokenizer}'")
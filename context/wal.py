@@ -0,0 +1,208 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from config import Config
+from .storage_backend import StorageBackend
+
+
+class WriteAheadLog:
+    """
+    Shared write-ahead log of new context records, with group commit.
+
+    add_context appends each record here and waits until it is on disk before
+    the reply is sent. One committer thread writes everything appended since the
+    previous commit with a single write and a single fsync, so concurrent users
+    share the cost of the fsync. The storage backend is still written by the
+    write-behind writer; once it is synced, the WAL segments it covers are
+    deleted (checkpoint). On startup, records found in the WAL but missing from
+    the storage backend are replayed into it.
+
+    The log is a series of segment files wal/<number>.log, each line being
+    {"lsn": n, "user_id": ..., "record": {"seq", "ts", "message"}}.
+    """
+
+    def __init__(self, config: Config, backend: StorageBackend) -> None:
+        self.backend = backend
+        self.directory = os.path.join(config.context_storage_dir, "wal")
+        os.makedirs(self.directory, exist_ok=True)
+        self.segment_bytes = config.context_wal_segment_bytes
+        self._condition = threading.Condition()
+        # Lines appended but not committed yet
+        self._pending: List[str] = []
+        self._next_lsn = 1
+        # Every record up to this LSN is on disk
+        self._durable_lsn = 0
+        self._error: Exception | None = None
+        self._stop = False
+        segments = self._segment_numbers()
+        self._segment_number = (segments[-1] + 1) if segments else 1
+        # (segment number, highest LSN written to it) of the closed segments not checkpointed yet
+        self._closed_segments: List[Tuple[int, int]] = []
+        self._segment_last_lsn = 0
+        self._file = None
+        self._commits = 0
+        self._committed_records = 0
+        self._thread = threading.Thread(target=self._run, name="context-wal", daemon=True)
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"{number:012d}.log")
+
+    def _segment_numbers(self) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            stem, extension = os.path.splitext(name)
+            if extension == ".log" and stem.isdigit():
+                numbers.append(int(stem))
+        return sorted(numbers)
+
+    def replay(self) -> int:
+        """
+        Apply the records of existing segments that are missing from the user logs, then remove the segments.
+        Must be called before start().
+
+        Returns:
+            Number of records replayed
+        """
+        segments = self._segment_numbers()
+        pending: Dict[str, Dict[int, Dict]] = {}
+        for number in segments:
+            with open(self._segment_path(number), 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                        user_id, record = entry["user_id"], entry["record"]
+                        seq = record["seq"]
+                    except (UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError):
+                        # A torn last line was never acknowledged, so nothing is lost by skipping it
+                        continue
+                    pending.setdefault(user_id, {})[seq] = record
+        replayed = 0
+        for user_id, records in pending.items():
+            tail = self.backend.load_records(user_id, 1)
+            last_seq = tail[-1]["seq"] if tail else -1
+            first_seq = min(records)
+            # Records stored since the first one in the WAL; a failed append may have left a gap below the tail
+            stored = {record["seq"] for record in self.backend.load_records(user_id, last_seq - first_seq + 1)}
+            missing = [records[seq] for seq in sorted(records) if seq not in stored]
+            if missing:
+                self.backend.append_records(user_id, missing, fsync=True)
+                replayed += len(missing)
+                if missing[0]["seq"] < last_seq:
+                    # Appended after newer records: rewrite the log in seq order
+                    self.backend.compact(user_id)
+        for number in segments:
+            os.remove(self._segment_path(number))
+        if replayed:
+            print(f"Replayed {replayed} context records from the write-ahead log")
+        return replayed
+
+    def start(self) -> None:
+        self._file = open(self._segment_path(self._segment_number), 'ab')
+        self._thread.start()
+
+    def append(self, user_id: str, record: Dict) -> int:
+        """Queue a record for the next group commit and return its LSN"""
+        body = json.dumps({"user_id": user_id, "record": record}, ensure_ascii=False)
+        with self._condition:
+            if self._stop:
+                raise RuntimeError("WriteAheadLog is stopped")
+            lsn = self._next_lsn
+            self._next_lsn += 1
+            self._pending.append(f'{{"lsn": {lsn}, {body[1:]}\n')
+            self._condition.notify_all()
+        return lsn
+
+    def wait(self, lsn: int) -> None:
+        """Block until the record with this LSN is on disk"""
+        with self._condition:
+            while self._durable_lsn < lsn:
+                if self._error != None:
+                    raise self._error
+                self._condition.wait()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._stop:
+                    self._condition.wait()
+                if not self._pending:
+                    break
+                lines = self._pending
+                self._pending = []
+                last_lsn = self._next_lsn - 1
+            try:
+                self._file.write("".join(lines).encode('utf-8'))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as e:
+                print(f"Failed to commit the write-ahead log: {e}")
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._durable_lsn = last_lsn
+                self._segment_last_lsn = last_lsn
+                self._commits += 1
+                self._committed_records += len(lines)
+                self._condition.notify_all()
+                if self._file.tell() >= self.segment_bytes:
+                    self._rotate()
+
+    def _rotate(self) -> None:
+        """Close the current segment and start a new one. Must hold _condition on the committer thread."""
+        self._file.close()
+        self._closed_segments.append((self._segment_number, self._segment_last_lsn))
+        self._segment_number += 1
+        self._file = open(self._segment_path(self._segment_number), 'ab')
+
+    def checkpoint(self, applied_lsn: int) -> None:
+        """
+        Delete the closed segments whose records are all durably stored in the user logs
+
+        Args:
+            applied_lsn: Every record up to this LSN has been written to its user log and synced
+        """
+        with self._condition:
+            removable = [number for number, last_lsn in self._closed_segments if last_lsn <= applied_lsn]
+            self._closed_segments = [(number, last_lsn) for number, last_lsn in self._closed_segments
+                                     if last_lsn > applied_lsn]
+        for number in removable:
+            try:
+                os.remove(self._segment_path(number))
+            except OSError as e:
+                print(f"Failed to remove write-ahead log segment {number}: {e}")
+
+    def stop(self, applied_lsn: int | None = None) -> None:
+        """
+        Commit what is pending and stop the committer thread
+
+        Args:
+            applied_lsn: If every record is already stored in the user logs, pass the last LSN
+                         to remove the whole log, so the next start has nothing to replay
+        """
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._file != None:
+            self._file.close()
+            self._file = None
+            if applied_lsn != None and applied_lsn >= self._durable_lsn:
+                self._closed_segments.append((self._segment_number, self._durable_lsn))
+                self.checkpoint(applied_lsn)
+
+    @property
+    def last_lsn(self) -> int:
+        with self._condition:
+            return self._next_lsn - 1
+
+    def stats(self) -> Dict[str, float]:
+        """Commits, records and records per commit (the group commit batching factor)"""
+        with self._condition:
+            return {"commits": self._commits, "records": self._committed_records,
+                    "records_per_commit": self._committed_records / self._commits if self._commits else 0.0}
@@ -0,0 +1,219 @@
+import heapq
+import threading
+import time
+from queue import Queue, Empty
+from typing import Dict, List, Set, Tuple
+
+from config import Config
+from .storage_backend import StorageBackend
+from .wal import WriteAheadLog
+
+
+class WriteBehindWriter:
+    """
+    Background writer that appends new context records to the user logs.
+
+    add_context only enqueues the new record; this thread batches everything queued
+    within CONTEXT_FLUSH_INTERVAL seconds into one append per user. Durability is
+    controlled by CONTEXT_FSYNC_POLICY:
+        always   - fsync every batch before it is acknowledged
+        interval - fsync the files written since the last sync every CONTEXT_FSYNC_INTERVAL seconds
+        never    - leave it to the operating system
+    If CONTEXT_LOG_MAX_MESSAGES is set, logs that received appends are compacted to
+    that many messages every CONTEXT_COMPACT_INTERVAL seconds, and with
+    CONTEXT_RETENTION_DAYS, older records of every user are pruned at the same interval.
+
+    With a write-ahead log, records carry their LSN. Every CONTEXT_FSYNC_INTERVAL
+    seconds the written logs are synced and the WAL segments they cover are
+    checkpointed.
+
+    Records whose append failed are retried every CONTEXT_FLUSH_INTERVAL seconds,
+    before any newer record of the same user, so a log never has a gap.
+    """
+
+    def __init__(self, config: Config, backend: StorageBackend, wal: WriteAheadLog | None = None) -> None:
+        self.backend = backend
+        self.wal = wal
+        self.config = config
+        self.fsync_policy = config.context_fsync_policy
+        self._queue: Queue = Queue()
+        # Number of queued records per user that have not been written yet
+        self._pending: Dict[str, int] = {}
+        # (record, LSN) of the appends that failed, per user, written again with the next batch
+        self._retry: Dict[str, List[Tuple[Dict, int | None]]] = {}
+        self._pending_lock = threading.Lock()
+        self._unsynced: Set[str] = set()
+        self._uncompacted: Set[str] = set()
+        self._last_sync = time.monotonic()
+        self._last_compaction = time.monotonic()
+        # Every record up to this LSN has been written to its user log
+        self._written_lsn = 0
+        # LSNs written ahead of a gap below them
+        self._written_ahead: List[int] = []
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="context-writer", daemon=True)
+        self._thread.start()
+
+    # Intervals and limits are read on every use, so they can be tuned in .env while the bot runs
+    @property
+    def flush_interval(self) -> float:
+        return self.config.context_flush_interval
+
+    @property
+    def fsync_interval(self) -> float:
+        return self.config.context_fsync_interval
+
+    @property
+    def compact_interval(self) -> float:
+        return self.config.context_compact_interval
+
+    @property
+    def max_messages(self) -> int:
+        return self.config.context_log_max_messages
+
+    @property
+    def retention(self) -> float:
+        """Records older than this many seconds are pruned at every compaction (0 keeps everything)"""
+        return self.config.context_retention_days * 86400
+
+    def enqueue(self, user_id: str, record: Dict, lsn: int | None = None) -> None:
+        """Queue a record for appending to the user's log, with its LSN if it was written ahead"""
+        with self._pending_lock:
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        self._queue.put((user_id, record, lsn))
+
+    def has_pending(self, user_id: str) -> bool:
+        """Whether records of the user are still waiting to be written"""
+        with self._pending_lock:
+            return user_id in self._pending
+
+    def flush(self) -> None:
+        """Block until every record queued so far has been written"""
+        self._queue.join()
+
+    @property
+    def written_lsn(self) -> int:
+        """Every record up to this LSN has been written to its user log"""
+        with self._pending_lock:
+            return self._written_lsn
+
+    def stop(self) -> None:
+        """Write everything still queued, sync it to disk and stop the thread"""
+        self.flush()
+        self._stop_event.set()
+        self._thread.join()
+        if self._retry:
+            # A last try; what still fails stays in the write-ahead log for the next start
+            self._write_batch([])
+        self._sync_all()
+
+    def _take_batch(self) -> List[Tuple[str, Dict, int | None]]:
+        """Wait for the first record, then collect everything arriving within the flush interval"""
+        flush_interval = self.flush_interval
+        try:
+            batch = [self._queue.get(timeout=flush_interval)]
+        except Empty:
+            return []
+        deadline = time.monotonic() + flush_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch: List[Tuple[str, Dict, int | None]]) -> None:
+        # Group by user so each log is opened once per batch (one transaction with SQLite), keeping the queue
+        # order; records that failed before come first
+        entries: Dict[str, List[Tuple[Dict, int | None]]] = self._retry
+        retried = set(entries)
+        self._retry = {}
+        for user_id, record, lsn in batch:
+            entries.setdefault(user_id, []).append((record, lsn))
+        grouped = {user_id: [record for record, _ in user_entries] for user_id, user_entries in entries.items()}
+        try:
+            failures = self.backend.append_batch(grouped, fsync=self.fsync_policy == "always")
+        except Exception as e:
+            failures = {user_id: e for user_id in grouped}
+        max_messages = self.max_messages
+        for user_id, records in grouped.items():
+            if user_id in failures:
+                # Kept pending and retried with the next batch; the watermark (and the checkpoints) wait for them
+                if user_id not in retried:
+                    print(f"Failed to save context of {user_id}, retrying: {failures[user_id]}")
+                self._retry[user_id] = entries[user_id]
+                continue
+            if user_id in retried:
+                print(f"Saved context of {user_id} after retrying")
+            with self._pending_lock:
+                self._pending[user_id] -= len(records)
+                if self._pending[user_id] == 0:
+                    del self._pending[user_id]
+            self._mark_written([lsn for _, lsn in entries[user_id] if lsn != None])
+            if max_messages > 0:
+                self._uncompacted.add(user_id)
+            if self.fsync_policy == "interval" or (self.wal != None and self.fsync_policy == "never"):
+                self._unsynced.add(user_id)
+
+    def _mark_written(self, lsns: List[int]) -> None:
+        """Advance the written watermark over the contiguous LSNs written so far"""
+        with self._pending_lock:
+            for lsn in lsns:
+                heapq.heappush(self._written_ahead, lsn)
+            while self._written_ahead and self._written_ahead[0] == self._written_lsn + 1:
+                self._written_lsn = heapq.heappop(self._written_ahead)
+
+    def _checkpoint(self) -> None:
+        """Sync the user logs, then drop the WAL segments they cover"""
+        written_lsn = self.written_lsn
+        if self._sync_all():
+            self.wal.checkpoint(written_lsn)
+
+    def _sync_all(self) -> bool:
+        """Sync the logs written since the last sync. Returns whether every sync succeeded."""
+        failures = self.backend.sync_batch(list(self._unsynced))
+        for user_id, e in failures.items():
+            print(f"Failed to sync context of {user_id}: {e}")
+        synced = not failures
+        self._unsynced.clear()
+        self._last_sync = time.monotonic()
+        return synced
+
+    def _compact_all(self) -> None:
+        max_messages = self.max_messages
+        for user_id in self._uncompacted:
+            try:
+                self.backend.compact(user_id, max_messages)
+            except Exception as e:
+                print(f"Failed to compact context of {user_id}: {e}")
+        self._uncompacted.clear()
+        retention = self.retention
+        if retention > 0:
+            try:
+                pruned = self.backend.prune(time.time() - retention)
+                if pruned:
+                    print(f"Pruned {pruned} context records older than the retention period")
+            except Exception as e:
+                print(f"Failed to prune context: {e}")
+        self._last_compaction = time.monotonic()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            batch = self._take_batch()
+            if batch or self._retry:
+                try:
+                    self._write_batch(batch)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+            now = time.monotonic()
+            if self.wal != None:
+                if now - self._last_sync >= self.fsync_interval:
+                    self._checkpoint()
+            elif self._unsynced and now - self._last_sync >= self.fsync_interval:
+                self._sync_all()
+            if (self._uncompacted or self.retention > 0) and now - self._last_compaction >= self.compact_interval:
+                self._compact_all()
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from config import Config
+
+
+class MediaStore:
+    """
+    Content-addressed store for downloaded media.
+
+    Files are kept as <directory>/<first two hex digits>/<sha256><extension>. A
+    download whose content is already stored (e.g. the same picture forwarded
+    twice) is discarded and the existing path is returned, so every distinct
+    file is stored, and later processed, only once.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        # Downloads are written here first, then moved to their content address
+        self.incoming_dir = os.path.join(directory, ".incoming")
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def new_incoming_dir(self) -> str:
+        """A fresh directory for one download, so concurrent downloads never collide"""
+        path = os.path.join(self.incoming_dir, uuid.uuid4().hex)
+        os.makedirs(path)
+        return path
+
+    def _digest(self, path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def add(self, path: str) -> str:
+        """
+        Move a downloaded file into the store
+
+        Args:
+            path: The downloaded file, removed from its location
+
+        Returns:
+            Path of the stored file with this content
+        """
+        digest = self._digest(path)
+        extension = os.path.splitext(path)[1].lower()
+        target_dir = os.path.join(self.directory, digest[:2])
+        target = os.path.join(target_dir, digest + extension)
+        with self._lock:
+            if os.path.exists(target):
+                os.remove(path)
+            else:
+                os.makedirs(target_dir, exist_ok=True)
+                shutil.move(path, target)
+        return os.path.abspath(target)
+
+
+class MediaIngestor:
+    """
+    Converts media messages to text on a bounded pool of worker threads.
+
+    Downloads and speech recognition can take seconds, so the listener callback
+    only submits the work here and carries on with the next message. Results of
+    identical media are shared: the text produced for a stored file is cached by
+    its content address, for the MEDIA_CACHE_MAX_ENTRIES most recently used files.
+    """
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.store = MediaStore(config.file_download_dir)
+        self._executor = ThreadPoolExecutor(max_workers=config.media_workers,
+                                            thread_name_prefix="media-worker")
+        self._lock = threading.Lock()
+        # Stored path -> text produced for it, least recently used first
+        self._processed: "OrderedDict[str, str]" = OrderedDict()
+
+    def submit(self, convert: Callable[[], str]) -> Future:
+        """Run a conversion that needs no download, e.g. voice to text"""
+        return self._executor.submit(convert)
+
+    def submit_download(self, download: Callable[[str], str], describe: Callable[[str], str]) -> Future:
+        """
+        Download a file into the store and describe it
+
+        Args:
+            download: Downloads the file into the given directory and returns its path
+            describe: Builds the message text from the stored path; called once per distinct file
+
+        Returns:
+            A future resolving to the message text
+        """
+        return self._executor.submit(self._ingest, download, describe)
+
+    def _ingest(self, download: Callable[[str], str], describe: Callable[[str], str]) -> str:
+        incoming_dir = self.store.new_incoming_dir()
+        try:
+            path = download(incoming_dir)
+            if not isinstance(path, (str, os.PathLike)) or not os.path.isfile(path):
+                raise RuntimeError(f"download failed: {path}")
+            stored = self.store.add(str(path))
+        finally:
+            shutil.rmtree(incoming_dir, ignore_errors=True)
+        with self._lock:
+            if stored in self._processed:
+                self._processed.move_to_end(stored)
+                return self._processed[stored]
+        text = describe(stored)
+        with self._lock:
+            self._processed[stored] = text
+            # The file stays in the store; an evicted one is only described again
+            while len(self._processed) > self.config.media_cache_max_entries:
+                self._processed.popitem(last=False)
+        return text
+
+    def stop(self) -> None:
+        """Wait for the media being processed and stop the workers"""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,188 @@
+import heapq
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, List, Tuple
+
+from config import Config
+from tracing import tracer
+
+# Priorities of outgoing messages, lower is sent first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+TEXT = "text"
+FILE = "file"
+
+
+class SendResult:
+    """Outcome of one outgoing message"""
+    __slots__ = ("status", "latency")
+
+    def __init__(self, status: bool, latency: float) -> None:
+        # Whether WeChat accepted the message
+        self.status = status
+        # Seconds from queueing to the end of the send
+        self.latency = latency
+
+    def __repr__(self) -> str:
+        return f"SendResult(status={self.status}, latency={self.latency:.3f})"
+
+
+class _Outgoing:
+    __slots__ = ("kind", "payload", "priority", "seq", "queued_time", "future")
+
+    def __init__(self, kind: str, payload: str, priority: int, seq: int) -> None:
+        self.kind = kind
+        self.payload = payload
+        self.priority = priority
+        self.seq = seq
+        self.queued_time = time.monotonic()
+        self.future: Future = Future()
+
+
+class OutboundQueue:
+    """
+    Serializes every outgoing WeChat message through one dispatcher thread.
+
+    The UI automation behind Chat.SendMsg/SendFiles is not thread-safe, so worker
+    threads only queue their messages here and get a Future of the SendResult.
+    Messages of one chat are sent in FIFO order; between chats, the chat whose
+    oldest message has the best priority (then the oldest) goes first. A global
+    token bucket allows OUTBOUND_RATE sends per second with bursts of up to
+    OUTBOUND_BURST, and adjacent text messages queued for the same chat are
+    coalesced into one send of at most OUTBOUND_COALESCE_MAX_CHARS characters.
+    """
+
+    def __init__(self, config: Config, resolve_chat: Callable[[str], Any]) -> None:
+        """
+        Args:
+            config: Configuration
+            resolve_chat: Returns the Chat object of a chat name, or None if it is not listened to
+        """
+        self.config = config
+        self.resolve_chat = resolve_chat
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._condition = threading.Condition()
+        # Per-chat FIFO of queued messages
+        self._chats: Dict[str, Deque[_Outgoing]] = {}
+        # (priority, seq, chat) of the head message of every chat with queued messages
+        self._ready: List[Tuple[int, int, str]] = []
+        self._seq = 0
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="outbound-dispatcher", daemon=True)
+        self._thread.start()
+
+    # The limits are read on every use, so changing them in .env applies to the messages still queued
+    @property
+    def rate(self) -> float:
+        return self.config.outbound_rate
+
+    @property
+    def burst(self) -> float:
+        return self.config.outbound_burst
+
+    @property
+    def coalesce_max_chars(self) -> int:
+        return self.config.outbound_coalesce_max_chars
+
+    def send_text(self, chat_name: str, text: str, priority: int = PRIORITY_NORMAL) -> Future:
+        """Queue a text message; the future resolves to its SendResult"""
+        return self._enqueue(chat_name, TEXT, text, priority)
+
+    def send_file(self, chat_name: str, file_path: str, priority: int = PRIORITY_NORMAL) -> Future:
+        """Queue a file; the future resolves to its SendResult"""
+        return self._enqueue(chat_name, FILE, file_path, priority)
+
+    def _enqueue(self, chat_name: str, kind: str, payload: str, priority: int) -> Future:
+        with self._condition:
+            if self._stop:
+                raise RuntimeError("OutboundQueue is stopped")
+            self._seq += 1
+            item = _Outgoing(kind, payload, priority, self._seq)
+            queue = self._chats.get(chat_name)
+            if queue == None:
+                self._chats[chat_name] = deque([item])
+                heapq.heappush(self._ready, (priority, item.seq, chat_name))
+                self._condition.notify()
+            else:
+                queue.append(item)
+        return item.future
+
+    def pending_count(self) -> int:
+        """Number of messages not sent yet"""
+        with self._condition:
+            return sum(len(queue) for queue in self._chats.values())
+
+    def stop(self) -> None:
+        """Send everything already queued, then stop the dispatcher thread"""
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _take_batch(self) -> Tuple[str, List[_Outgoing]] | None:
+        """Wait for a message and a send token, then pop the next send. Must hold _condition."""
+        while True:
+            if not self._ready:
+                if self._stop:
+                    return None
+                self._condition.wait()
+                continue
+            self._refill()
+            if self._tokens < 1:
+                # New messages may arrive meanwhile and be coalesced or take precedence
+                self._condition.wait((1 - self._tokens) / self.rate)
+                continue
+            self._tokens -= 1
+            _, _, chat_name = heapq.heappop(self._ready)
+            queue = self._chats[chat_name]
+            batch = [queue.popleft()]
+            if batch[0].kind == TEXT:
+                length = len(batch[0].payload)
+                while queue and queue[0].kind == TEXT and length + 1 + len(queue[0].payload) <= self.coalesce_max_chars:
+                    length += 1 + len(queue[0].payload)
+                    batch.append(queue.popleft())
+            if queue:
+                heapq.heappush(self._ready, (queue[0].priority, queue[0].seq, chat_name))
+            else:
+                del self._chats[chat_name]
+            return chat_name, batch
+
+    def _send(self, chat_name: str, batch: List[_Outgoing]) -> bool:
+        chat = self.resolve_chat(chat_name)
+        if chat == None:
+            print(f"Friend {chat_name} is not in listen list!")
+            return False
+        try:
+            if batch[0].kind == TEXT:
+                chat.SendMsg("\n".join(item.payload for item in batch))
+            else:
+                chat.SendFiles(batch[0].payload)
+        except Exception as e:
+            print(f"Failed to send message to {chat_name}: {e}")
+            return False
+        return True
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                taken = self._take_batch()
+            if taken == None:
+                break
+            chat_name, batch = taken
+            send_start = time.monotonic()
+            status = self._send(chat_name, batch)
+            now = time.monotonic()
+            tracer.record("send", now - send_start)
+            tracer.count("sends", status="ok" if status else "failed")
+            for item in batch:
+                item.future.set_result(SendResult(status, now - item.queued_time))
@@ -0,0 +1,41 @@
+import os
+
+from config import Config
+
+DEFAULT_SETTINGS = {
+    "OPENAI_KEY": "sk-test",
+    "OPENAI_ENDPOINT": "http://127.0.0.1:9/v1",
+    "MODEL_NAME": "test-model",
+    "MODEL_TEMPERATURE": "1.0",
+    "MODEL_TOP_P": "0.95",
+    "SYSTEM_PROMPT_PATH": "./system_prompt.json",
+    "TOOLS_DESCRIPTION_PATH": "./tools_descriptions.json",
+    "TOOLS_IMPLEMENTATION_PATH": "./tools_implementations.py",
+    "CONTEXT_WINDOW_LENGTH": "10",
+    "CONTEXT_STAY_DURATION": "30",
+    "CONTEXT_STORAGE_DIR": "./chat_history",
+    "DEBOUNCE_THRESHOLD": "10",
+    "MAX_WAIT_DURATION": "5",
+    "FILE_DOWNLOAD_DIR": "./downloads",
+    "INFO_FILES_DIRECTORY": "./files",
+    "LISTEN_FRIENDNAME_FILE": "./listen_friendname.txt",
+}
+
+
+def make_config(directory: str, **overrides) -> Config:
+    """Write a .env file into directory and load it, so tests do not depend on the real .env
+
+    Args:
+        directory: Directory the .env file is written to
+        overrides: Configuration items replacing the defaults, e.g. MAX_WAIT_DURATION="0.2"
+
+    Returns:
+        Config loaded from the written file
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({k.upper(): str(v) for k, v in overrides.items()})
+    path = os.path.join(directory, ".env")
+    with open(path, "w", encoding="utf-8") as f:
+        for key, value in settings.items():
+            f.write(f"{key} = {value}\n")
+    return Config(path)
@@ -0,0 +1,135 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+
+from openai import APIStatusError
+
+from bench.stub_openai import StubOpenAIServer, StubSettings
+from config_helper import make_config
+from LLM.client_pool import ClientPool
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class Cancelled(Exception):
+    pass
+
+
+def _complete(endpoint, on_segment, cancel):
+    response = endpoint.client.chat.completions.create(model=endpoint.model, messages=MESSAGES)
+    return response.choices[0].message.content
+
+
+def _stream(endpoint, on_segment, cancel):
+    stream = endpoint.client.chat.completions.create(model=endpoint.model, messages=MESSAGES, stream=True)
+    parts = []
+    try:
+        for chunk in stream:
+            if cancel.is_set():
+                raise Cancelled()
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not parts:
+                    on_segment(chunk.choices[0].delta.content)
+                parts.append(chunk.choices[0].delta.content)
+    finally:
+        stream.close()
+    return "".join(parts)
+
+
+class TestClientPool(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        # "slow" is preferred by weight, "fast" is the alternative
+        self.slow = StubOpenAIServer(StubSettings(latency=0.05, token_delay=0, reply_tokens=5)).start()
+        self.fast = StubOpenAIServer(StubSettings(latency=0.05, token_delay=0, reply_tokens=5)).start()
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        self.slow.stop()
+        self.fast.stop()
+        shutil.rmtree(self.test_dir)
+
+    def _pool(self, inflight_limit=None, **overrides):
+        endpoints = f"{self.slow.base_url}|slow-model|1000, {self.fast.base_url}|fast-model|0.001"
+        config = make_config(self.test_dir, LLM_ENDPOINTS=endpoints, LLM_HEDGE_MIN_SAMPLES="5", **overrides)
+        pool = ClientPool(config, Cancelled, inflight_limit)
+        self.pools.append(pool)
+        return pool
+
+    def test_slow_endpoint_is_hedged(self):
+        pool = self._pool()
+        for _ in range(5):
+            self.assertTrue(pool.request(_complete))
+        self.assertLess(pool.endpoints[0].quantile(0.95, 5), 0.5)
+        # The preferred endpoint becomes slow; after its p95 the request is duplicated
+        self.slow.settings.latency = 2.0
+        for call in (_complete, _stream):
+            start = time.monotonic()
+            self.assertTrue(pool.request(call, on_segment=lambda segment: None))
+            self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(self.fast.settings.requests, 2)
+        # The losers' waiting time raised the slow endpoint's latency estimate
+        self.assertGreater(pool.endpoints[0].ewma, pool.endpoints[0].samples[0])
+
+    def test_failover_and_circuit_breaker(self):
+        pool = self._pool(LLM_BREAKER_FAILURES="2", LLM_BREAKER_COOLDOWN="60")
+        self.slow.settings.fail_status = 503
+        for _ in range(3):
+            self.assertTrue(pool.request(_complete))
+        # Two failures opened the breaker, the third request went straight to the other endpoint
+        self.assertEqual(self.slow.settings.requests, 2)
+        self.assertEqual(self.fast.settings.requests, 3)
+        self.assertEqual([endpoint["circuit"] for endpoint in pool.stats()], ["open", "closed"])
+
+    def test_rejected_request_is_not_retried(self):
+        pool = self._pool()
+        self.slow.settings.fail_status = 400
+        with self.assertRaises(APIStatusError):
+            pool.request(_complete)
+        self.assertEqual(self.fast.settings.requests, 0)
+        self.assertEqual(pool.endpoints[0].consecutive_failures, 0)
+
+    def test_only_transport_and_server_errors_are_retried(self):
+        pool = self._pool(LLM_HEDGE="false", LLM_REQUEST_TIMEOUT="1")
+        self.slow.settings.latency = 2.0
+        start = time.monotonic()
+        # The slow endpoint times out and the request fails over
+        self.assertTrue(pool.request(_complete))
+        self.assertLess(time.monotonic() - start, 1.8)
+        self.assertEqual(self.fast.settings.requests, 1)
+
+        def broken(endpoint, on_segment, cancel):
+            raise ValueError("unexpected answer")
+
+        with self.assertRaises(ValueError):
+            pool.request(broken)
+        self.assertEqual(self.fast.settings.requests, 1)
+
+    def test_hedges_count_against_the_inflight_limit(self):
+        for free_slot in (False, True):
+            with self.subTest(free_slot=free_slot):
+                self.fast.settings.requests = 0
+                # The caller holds one slot while its request runs, like Responsor does
+                inflight_limit = threading.BoundedSemaphore(2 if free_slot else 1)
+                pool = self._pool(inflight_limit)
+                for _ in range(5):
+                    pool.request(_complete)
+                self.slow.settings.latency = 0.6
+                with inflight_limit:
+                    self.assertTrue(pool.request(_complete))
+                self.assertEqual(self.fast.settings.requests, 1 if free_slot else 0)
+                self.assertTrue(inflight_limit.acquire(blocking=False))
+                if free_slot:
+                    # The hedge won; its slot is kept until the losing request has ended too
+                    self.assertFalse(inflight_limit.acquire(blocking=False))
+                    time.sleep(1.0)
+                    self.assertTrue(inflight_limit.acquire(blocking=False))
+                self.slow.settings.latency = 0.05
+
+
+if __name__ == '__main__':
+    unittest.main()
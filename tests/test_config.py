@@ -0,0 +1,117 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+
+from config_helper import make_config
+from LLM.debounce_pool import DebouncePool
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _rewrite(self, **overrides):
+        """Rewrite the .env file with a newer modification time"""
+        path = os.path.join(self.test_dir, ".env")
+        mtime = os.path.getmtime(path)
+        try:
+            make_config(self.test_dir, **overrides)
+        except ValueError:
+            # The file is written before it is validated
+            pass
+        os.utime(path, (mtime + 1, mtime + 1))
+
+    def test_values_are_typed_once(self):
+        config = make_config(self.test_dir, STREAM_RESPONSE="yes", TOOL_TIMEOUTS="send_a_file=120, other=5",
+                             CONTEXT_FSYNC_POLICY="Always", TRACE_FILE="")
+        self.assertEqual(config.max_wait_duration, 5.0)
+        self.assertEqual(config.debounce_threshold, 10)
+        self.assertIs(config.stream_response, True)
+        self.assertEqual(config.tool_timeouts, {"send_a_file": 120.0, "other": 5.0})
+        self.assertEqual(config.context_fsync_policy, "always")
+        # Missing and empty items get their schema default
+        self.assertEqual(config.outbound_rate, 2.0)
+        self.assertEqual(config.trace_file, "")
+        self.assertEqual(config.get("not_in_schema", "fallback"), "fallback")
+        with self.assertRaises(AttributeError):
+            config.not_in_schema
+
+    def test_invalid_values_are_reported_together(self):
+        with self.assertRaises(ValueError) as raised:
+            make_config(self.test_dir, DEBOUNCE_THRESHOLD="ten", CONTEXT_STORAGE_BACKEND="mongo", OUTBOUND_BURST="0")
+        message = str(raised.exception)
+        for name in ("DEBOUNCE_THRESHOLD", "CONTEXT_STORAGE_BACKEND", "OUTBOUND_BURST"):
+            self.assertIn(name, message)
+
+    def test_snapshot_is_immutable(self):
+        snapshot = make_config(self.test_dir).snapshot()
+        with self.assertRaises(AttributeError):
+            snapshot.max_wait_duration = 1
+
+    def test_reload_swaps_reloadable_items_only(self):
+        config = make_config(self.test_dir)
+        old_snapshot = config.snapshot()
+        changes = []
+        config.on_change(lambda snapshot, changed: changes.append(changed))
+        self._rewrite(MODEL_TEMPERATURE="0.2", DISPATCH_WORKERS="2")
+        self.assertEqual(config.reload(), {"model_temperature"})
+        self.assertEqual(config.model_temperature, 0.2)
+        # Worker pools are sized at startup, so the old value stays until a restart
+        self.assertEqual(config.dispatch_workers, 8)
+        self.assertEqual(changes, [{"model_temperature"}])
+        # Earlier snapshots are unaffected
+        self.assertEqual(old_snapshot.model_temperature, 1.0)
+
+    def test_invalid_file_keeps_current_values(self):
+        config = make_config(self.test_dir)
+        self._rewrite(MAX_WAIT_DURATION="soon")
+        self.assertEqual(config.reload(), frozenset())
+        self.assertEqual(config.max_wait_duration, 5.0)
+
+    def test_watcher_applies_debounce_changes(self):
+        config = make_config(self.test_dir, MAX_WAIT_DURATION="10", CONFIG_RELOAD_INTERVAL="0.05")
+        fired = []
+        pool = DebouncePool(config, lambda user_id, message: fired.append(message["content"]))
+        config.start_watching()
+        try:
+            self._rewrite(MAX_WAIT_DURATION="0.1", DEBOUNCE_THRESHOLD="2", CONFIG_RELOAD_INTERVAL="0.05")
+            deadline = time.monotonic() + 2
+            while config.max_wait_duration != 0.1 and time.monotonic() < deadline:
+                time.sleep(0.02)
+            self.assertEqual(pool.policy.wait_duration('user1'), 0.1)
+            # The new threshold flushes on the second message
+            pool.submit_message('user1', {'role': 'user', 'content': 'a'})
+            pool.submit_message('user1', {'role': 'user', 'content': 'b'})
+            self.assertEqual(fired, ['ab'])
+        finally:
+            config.stop_watching()
+            pool.stop()
+
+    def test_watched_files_are_reported_when_changed(self):
+        config = make_config(self.test_dir, CONFIG_RELOAD_INTERVAL="0.05")
+        path = os.path.join(self.test_dir, "listen.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("alice\n")
+        changed = []
+        config.watch_file(path, changed.append)
+        config.start_watching()
+        try:
+            time.sleep(0.15)
+            self.assertEqual(changed, [])
+            mtime = os.path.getmtime(path)
+            os.utime(path, (mtime + 1, mtime + 1))
+            deadline = time.monotonic() + 2
+            while not changed and time.monotonic() < deadline:
+                time.sleep(0.02)
+            self.assertEqual(changed, [path])
+        finally:
+            config.stop_watching()
+
+
+if __name__ == '__main__':
+    unittest.main()
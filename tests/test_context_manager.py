@@ -2,14 +2,15 @@ import unittest
 import tempfile
 import shutil
 
-from config import Config
+from config_helper import make_config
 from context.context_manager import ContextManager
 
 
 class TestContextManager(unittest.TestCase):
     def setUp(self):
         self.test_dir = tempfile.mkdtemp()
-        self.config = Config()
+        # Messages are persisted as soon as they are added, so every test gets its own storage directory
+        self.config = make_config(self.test_dir, CONTEXT_STORAGE_DIR=self.test_dir)
 
     def tearDown(self):
         shutil.rmtree(self.test_dir)
@@ -35,6 +36,20 @@ class TestContextManager(unittest.TestCase):
         self.assertEqual(len(context), 10) 
         #self.assertEqual(context[0]['content'], 'A8')
 
+    def test_token_budget_trimming(self):
+        config = make_config(self.test_dir, CONTEXT_STORAGE_DIR=self.test_dir,
+                             CONTEXT_TRIM_MODE="tokens", CONTEXT_TOKEN_BUDGET="100")
+        manager = ContextManager(config)
+        # Each message costs 4 + 10 tokens with the heuristic counter
+        for i in range(20):
+            manager.append('user1', {'role': 'user', 'content': 'x' * 40})
+        self.assertEqual(len(manager.get('user1')), 7)
+        # Tokens reserved for the system prompt, tools and new message shrink the window
+        self.assertEqual(len(manager.get('user1', reserved_tokens=30)), 5)
+        # One oversized message is dropped rather than blowing the budget
+        manager.append('user1', {'role': 'user', 'content': '文' * 200})
+        self.assertEqual(len(manager.get('user1')), 0)
+
     def test_disk_persistence(self):
         manager = ContextManager(self.config)
         # Simulating no context loaded
@@ -45,7 +60,10 @@ class TestContextManager(unittest.TestCase):
         context = manager.get('user2')
         self.assertEqual(len(context), 1)
         # Simulating saving context
-        # manager.savefile('user2')
+        manager.savefile('user2')
+        reloaded = ContextManager(self.config)
+        context = reloaded.get('user2')
+        self.assertEqual(list(context), [{'role': 'user', 'content': 'Test'}])
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import unittest
+import tempfile
+import shutil
+
+from config_helper import make_config
+from LLM.debounce_policy import AdaptiveDebouncePolicy, FixedDebouncePolicy, create_debounce_policy
+
+
+class TestDebouncePolicy(unittest.TestCase):
+    def test_fixed_policy(self):
+        policy = FixedDebouncePolicy(5)
+        policy.observe('user1', 0)
+        self.assertEqual(policy.wait_duration('user1'), 5)
+
+    def test_unknown_user_waits_max(self):
+        policy = AdaptiveDebouncePolicy(5)
+        self.assertEqual(policy.wait_duration('user1'), 5)
+
+    def test_single_message_sender_gets_short_wait(self):
+        policy = AdaptiveDebouncePolicy(5, min_wait=0.5)
+        for index in range(10):
+            policy.observe('user1', index * 60.0)
+        self.assertEqual(policy.wait_duration('user1'), 0.5)
+
+    def test_multipart_sender_gets_cadence_wait(self):
+        policy = AdaptiveDebouncePolicy(5, min_wait=0.5)
+        now = 0.0
+        for _ in range(10):
+            now += 60
+            for part in range(4):
+                policy.observe('user1', now + part * 2.0)
+            now += 6.0
+        # Regular 2 second gaps: wait about 2 seconds, well below the maximum
+        self.assertAlmostEqual(policy.wait_duration('user1'), 2.0, delta=0.2)
+
+    def test_wait_is_bounded(self):
+        policy = AdaptiveDebouncePolicy(5, min_wait=1, min_samples=1)
+        for index in range(10):
+            policy.observe('fast', index * 0.1)
+            policy.observe('slow', index * 4.9)
+        self.assertEqual(policy.wait_duration('fast'), 1)
+        self.assertLessEqual(policy.wait_duration('slow'), 5)
+
+    def test_user_statistics_are_bounded(self):
+        policy = AdaptiveDebouncePolicy(5, max_users=2)
+        for user_id in ('a', 'b', 'c'):
+            policy.observe(user_id, 0)
+        self.assertIsNone(policy.snapshot('a'))
+        self.assertIsNotNone(policy.snapshot('c'))
+
+    def test_create_from_config(self):
+        test_dir = tempfile.mkdtemp()
+        try:
+            policy = create_debounce_policy(make_config(test_dir, MAX_WAIT_DURATION="4", DEBOUNCE_POLICY="adaptive",
+                                                        DEBOUNCE_MIN_WAIT="0.2"))
+            self.assertIsInstance(policy, AdaptiveDebouncePolicy)
+            self.assertEqual((policy.max_wait, policy.min_wait), (4, 0.2))
+            self.assertIsInstance(create_debounce_policy(make_config(test_dir)), FixedDebouncePolicy)
+        finally:
+            shutil.rmtree(test_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+
+from config_helper import make_config
+from LLM.debounce_pool import DebouncePool
+
+
+class TestDebouncePool(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.config = make_config(self.test_dir, MAX_WAIT_DURATION="0.3", DEBOUNCE_THRESHOLD="3")
+        self.fired = []
+        self.fired_event = threading.Event()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _callback(self, user_id, message):
+        self.fired.append((user_id, message["content"], time.monotonic()))
+        self.fired_event.set()
+
+    def test_flush_at_deadline(self):
+        pool = DebouncePool(self.config, self._callback)
+        start = time.monotonic()
+        pool.submit_message('user1', {'role': 'user', 'content': 'Hello'})
+        self.assertTrue(self.fired_event.wait(2))
+        pool.stop()
+        user_id, content, fired_at = self.fired[0]
+        self.assertEqual((user_id, content), ('user1', 'Hello'))
+        # The flush must happen close to the deadline, not up to a second later
+        self.assertAlmostEqual(fired_at - start, 0.3, delta=0.1)
+
+    def test_submit_reschedules_deadline(self):
+        pool = DebouncePool(self.config, self._callback)
+        pool.submit_message('user1', {'role': 'user', 'content': 'a'})
+        time.sleep(0.2)
+        last_submit = time.monotonic()
+        pool.submit_message('user1', {'role': 'user', 'content': 'b'})
+        self.assertTrue(self.fired_event.wait(2))
+        pool.stop()
+        self.assertEqual(len(self.fired), 1)
+        self.assertEqual(self.fired[0][1], 'ab')
+        self.assertGreaterEqual(self.fired[0][2] - last_submit, 0.29)
+
+    def test_threshold_triggers_immediately(self):
+        pool = DebouncePool(self.config, self._callback)
+        for content in ('a', 'b', 'c'):
+            pool.submit_message('user1', {'role': 'user', 'content': content})
+        self.assertEqual([item[1] for item in self.fired], ['abc'])
+        # The superseded deadline must not fire a second, empty flush
+        time.sleep(0.5)
+        pool.stop()
+        self.assertEqual(len(self.fired), 1)
+
+    def test_many_users_single_scheduler(self):
+        threads_before = threading.active_count()
+        pool = DebouncePool(self.config, self._callback)
+        for i in range(200):
+            pool.submit_message(f'user{i}', {'role': 'user', 'content': str(i)})
+        self.assertLessEqual(threading.active_count(), threads_before + 1)
+        deadline = time.monotonic() + 3
+        while len(self.fired) < 200 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        pool.stop()
+        self.assertEqual(len(self.fired), 200)
+
+    def test_policy_sets_per_user_wait(self):
+        class _Policy:
+            def observe(self, user_id, now):
+                pass
+
+            def wait_duration(self, user_id):
+                return 0.05 if user_id == 'fast' else 0.3
+
+        pool = DebouncePool(self.config, self._callback, policy=_Policy())
+        start = time.monotonic()
+        pool.submit_message('slow', {'role': 'user', 'content': 'slow'})
+        pool.submit_message('fast', {'role': 'user', 'content': 'fast'})
+        time.sleep(0.5)
+        pool.stop()
+        self.assertEqual([item[1] for item in self.fired], ['fast', 'slow'])
+        self.assertLess(self.fired[0][2] - start, 0.2)
+
+    def test_flush_waits_for_pending_media(self):
+        pool = DebouncePool(self.config, self._callback)
+        media = Future()
+        pool.submit_message('user1', {'role': 'user', 'content': 'look: '})
+        pool.submit_message('user1', {'role': 'user', 'content': '[image]'}, media)
+        # The deadline passes while the image is still downloading
+        time.sleep(0.5)
+        self.assertEqual(self.fired, [])
+        media.set_result('an image at /tmp/a.jpg')
+        self.assertTrue(self.fired_event.wait(1))
+        pool.stop()
+        self.assertEqual(self.fired[0][1], 'look: an image at /tmp/a.jpg')
+
+    def test_media_timeout_flushes_placeholder(self):
+        config = make_config(self.test_dir, MAX_WAIT_DURATION="0.1", DEBOUNCE_THRESHOLD="3", MEDIA_TIMEOUT="0.3")
+        pool = DebouncePool(config, self._callback)
+        media = Future()
+        start = time.monotonic()
+        pool.submit_message('user1', {'role': 'user', 'content': '[image]'}, media)
+        self.assertTrue(self.fired_event.wait(2))
+        self.assertEqual(self.fired[0][1], '[image]')
+        self.assertGreaterEqual(self.fired[0][2] - start, 0.29)
+        # The late result is delivered as a message of its own
+        self.fired_event.clear()
+        media.set_result('late image')
+        self.assertTrue(self.fired_event.wait(1))
+        pool.stop()
+        self.assertEqual(self.fired[1][1], 'late image')
+
+    def test_drain_flushes_everything_now(self):
+        config = make_config(self.test_dir, MAX_WAIT_DURATION="10", DEBOUNCE_THRESHOLD="10")
+        pool = DebouncePool(config, self._callback)
+        pool.submit_message('user1', {'role': 'user', 'content': 'a'})
+        pool.submit_message('user2', {'role': 'user', 'content': '[image]'}, Future())
+        pool.drain()
+        pool.stop()
+        # Neither the debounce window nor the pending media holds the flush back
+        self.assertEqual(sorted((user_id, content) for user_id, content, _ in self.fired),
+                         [('user1', 'a'), ('user2', '[image]')])
+
+
+if __name__ == '__main__':
+    unittest.main()
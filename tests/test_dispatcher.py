@@ -0,0 +1,124 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+
+from config_helper import make_config
+from LLM.dispatcher import RequestDispatcher
+
+
+class TestRequestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.config = make_config(self.test_dir, DISPATCH_WORKERS="4")
+        self.lock = threading.Lock()
+        self.processed = []
+        self.active_users = set()
+        self.max_active = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _handler(self, user_id, message):
+        with self.lock:
+            # The same user must never be processed by two workers at once
+            self.assertNotIn(user_id, self.active_users)
+            self.active_users.add(user_id)
+            self.max_active = max(self.max_active, len(self.active_users))
+        time.sleep(0.02)
+        with self.lock:
+            self.active_users.remove(user_id)
+            self.processed.append((user_id, message["content"]))
+
+    def test_per_user_order(self):
+        dispatcher = RequestDispatcher(self.config, self._handler)
+        for i in range(5):
+            for user in ('user1', 'user2', 'user3'):
+                dispatcher.submit(user, {'role': 'user', 'content': str(i)})
+        self.assertTrue(dispatcher.join(5))
+        dispatcher.stop()
+        for user in ('user1', 'user2', 'user3'):
+            contents = [content for uid, content in self.processed if uid == user]
+            self.assertEqual(contents, ['0', '1', '2', '3', '4'])
+
+    def test_users_run_in_parallel_within_bound(self):
+        dispatcher = RequestDispatcher(self.config, self._handler)
+        for i in range(10):
+            dispatcher.submit(f'user{i}', {'role': 'user', 'content': 'hi'})
+        self.assertTrue(dispatcher.join(5))
+        dispatcher.stop()
+        self.assertEqual(len(self.processed), 10)
+        self.assertGreater(self.max_active, 1)
+        self.assertLessEqual(self.max_active, 4)
+
+    def test_failing_turn_does_not_block_user(self):
+        def handler(user_id, message):
+            if message["content"] == "boom":
+                raise RuntimeError("boom")
+            self.processed.append((user_id, message["content"]))
+
+        dispatcher = RequestDispatcher(self.config, handler)
+        dispatcher.submit('user1', {'role': 'user', 'content': 'boom'})
+        dispatcher.submit('user1', {'role': 'user', 'content': 'ok'})
+        self.assertTrue(dispatcher.join(5))
+        dispatcher.stop()
+        self.assertEqual(self.processed, [('user1', 'ok')])
+
+    def _blocked_dispatcher(self, **overrides):
+        """A single worker held busy by user0's first turn, so the next turns queue up"""
+        config = make_config(self.test_dir, DISPATCH_WORKERS="1", **overrides)
+        release = threading.Event()
+
+        def handler(user_id, message):
+            if message["content"] == "block":
+                release.wait(5)
+            self.processed.append((user_id, message["content"]))
+        dispatcher = RequestDispatcher(config, handler, lambda user_id, message: self.processed.append((user_id, "busy")))
+        dispatcher.submit('user0', {'role': 'user', 'content': 'block'})
+        deadline = time.monotonic() + 2
+        while dispatcher.stats()["in_progress"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return dispatcher, release
+
+    def test_chatty_user_does_not_starve_others(self):
+        dispatcher, release = self._blocked_dispatcher(DISPATCH_QUANTUM="2")
+        for i in range(6):
+            dispatcher.submit('chatty', {'role': 'user', 'content': f'c{i}'})
+        dispatcher.submit('quiet', {'role': 'user', 'content': 'q'})
+        release.set()
+        self.assertTrue(dispatcher.join(5))
+        dispatcher.stop()
+        order = [content for uid, content in self.processed[1:]]
+        # Deficit round robin alternates users instead of serving the whole backlog first
+        self.assertLess(order.index('q'), 3)
+
+    def test_priorities_share_the_workers(self):
+        dispatcher, release = self._blocked_dispatcher(DISPATCH_QUANTUM="2")
+        dispatcher.set_priorities({'vip': 2})
+        for i in range(4):
+            dispatcher.submit('vip', {'role': 'user', 'content': f'v{i}'})
+            dispatcher.submit('normal', {'role': 'user', 'content': f'n{i}'})
+        release.set()
+        self.assertTrue(dispatcher.join(5))
+        dispatcher.stop()
+        first_half = [uid for uid, content in self.processed[1:5]]
+        self.assertGreater(first_half.count('vip'), first_half.count('normal'))
+
+    def test_overload_merges_and_sheds(self):
+        dispatcher, release = self._blocked_dispatcher(DISPATCH_MAX_QUEUED="2")
+        dispatcher.submit('user1', {'role': 'user', 'content': 'a'})
+        dispatcher.submit('user2', {'role': 'user', 'content': 'b'})
+        # The queue is full: user1's new turn is merged, user3 gets the busy reply
+        dispatcher.submit('user1', {'role': 'user', 'content': 'c'})
+        dispatcher.submit('user3', {'role': 'user', 'content': 'd'})
+        self.assertEqual(self.processed, [('user3', 'busy')])
+        release.set()
+        self.assertTrue(dispatcher.join(5))
+        dispatcher.stop()
+        self.assertIn(('user1', 'a\nc'), self.processed)
+        self.assertEqual(dispatcher.stats(), {"queued": 0, "in_progress": 0, "merged": 1, "shed": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
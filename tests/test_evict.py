@@ -1,15 +1,35 @@
+import unittest
+import tempfile
+import shutil
+import os
 import time
 
-from config import Config
+from config_helper import make_config
 from context.context_manager import ContextManager
-def test_eviction():
-    manager = ContextManager(Config())
-    manager.append('user3', {'role': 'user', 'content': 'Keep'})
-        
-    time.sleep(0.2)
-    print(f"latest cache: {manager.storage._cache}")
-        
-    time.sleep(10)
-    print(f"latest cache: {manager.storage._cache}")
-
-test_eviction()
\ No newline at end of file
+
+
+class TestEviction(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        config = make_config(self.test_dir, CONTEXT_STAY_DURATION="0.2",
+                             CONTEXT_STORAGE_DIR=os.path.join(self.test_dir, "chat_history"))
+        self.manager = ContextManager(config)
+
+    def tearDown(self):
+        # Persist the history and retire the write-ahead log
+        self.manager.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_expired_context_is_evicted_and_reloaded(self):
+        self.manager.append('user3', {'role': 'user', 'content': 'Keep'})
+        self.assertIn('user3', self.manager.storage._cache)
+        deadline = time.monotonic() + 3
+        while 'user3' in self.manager.storage._cache and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertNotIn('user3', self.manager.storage._cache)
+        # Eviction only drops the cached copy
+        self.assertEqual([message["content"] for message in self.manager.get('user3')], ['Keep'])
+
+
+if __name__ == '__main__':
+    unittest.main()
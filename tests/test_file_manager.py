@@ -0,0 +1,85 @@
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from config_helper import make_config
+from context.file_manager import FileManager
+from context.write_behind import WriteBehindWriter
+
+
+def _records(start, count):
+    return [{"seq": seq, "ts": 0, "message": {"role": "user", "content": f"m{seq}"}}
+            for seq in range(start, start + count)]
+
+
+class TestFileManager(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.config = make_config(self.test_dir, CONTEXT_STORAGE_DIR=self.test_dir, CONTEXT_FLUSH_INTERVAL="0.05")
+        self.file_manager = FileManager(self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_append_only_log(self):
+        self.file_manager.append_records('user1', _records(0, 3))
+        self.file_manager.append_records('user1', _records(3, 2), fsync=True)
+        records = self.file_manager.load_records('user1', 50)
+        self.assertEqual([record["seq"] for record in records], [0, 1, 2, 3, 4])
+        self.assertEqual(self.file_manager.load_context('user1')[-1]["content"], "m4")
+        # No backup copies are created any more
+        self.assertCountEqual(os.listdir(self.test_dir),
+                              ['.env', os.path.basename(self.file_manager._get_log_filepath('user1'))])
+
+    def test_torn_line_is_skipped(self):
+        self.file_manager.append_records('user1', _records(0, 2))
+        with open(self.file_manager._get_log_filepath('user1'), 'a', encoding='utf-8') as f:
+            f.write('{"seq": 2, "ts": 0, "mess')
+        self.assertEqual(len(self.file_manager.load_records('user1', 50)), 2)
+
+    def test_legacy_history_is_migrated(self):
+        with open(self.file_manager._get_filepath('user1'), 'w', encoding='utf-8') as f:
+            json.dump([{"role": "user", "content": "old"}], f)
+        self.assertEqual(self.file_manager.load_context('user1'), [{"role": "user", "content": "old"}])
+        self.file_manager.append_records('user1', _records(1, 1))
+        self.assertEqual([msg["content"] for msg in self.file_manager.load_context('user1')], ["old", "m1"])
+        self.assertFalse(os.path.exists(self.file_manager._get_filepath('user1')))
+
+    def test_tail_read_across_blocks(self):
+        # Small blocks force lines to be split between reads
+        self.file_manager.TAIL_BLOCK_SIZE = 16
+        records = _records(0, 200)
+        records[150]["message"]["content"] = "多字节字符" * 7
+        self.file_manager.append_records('user1', records)
+        self.assertEqual(self.file_manager.load_records('user1', 60), records[-60:])
+        self.assertEqual(self.file_manager.load_records('user1', 500), records)
+
+    def test_compaction_keeps_latest_messages(self):
+        self.file_manager.append_records('user1', _records(0, 10))
+        # A duplicated record, e.g. written twice after a crash
+        self.file_manager.append_records('user1', _records(9, 1))
+        self.file_manager.compact('user1', max_messages=4)
+        records = self.file_manager.load_records('user1', 50)
+        self.assertEqual([record["seq"] for record in records], [6, 7, 8, 9])
+
+    def test_retention_prunes_old_records(self):
+        self.file_manager.append_records('user1', _records(0, 3))
+        self.file_manager.append_records('user1', [{"seq": 3, "ts": 500, "message": {"role": "user", "content": "new"}}])
+        self.file_manager.append_records('user2', _records(0, 2))
+        self.assertEqual(self.file_manager.user_ids(), ['user1', 'user2'])
+        self.assertEqual(self.file_manager.prune(100), 5)
+        self.assertEqual([record["seq"] for record in self.file_manager.load_records('user1', 50)], [3])
+        self.assertEqual(self.file_manager.load_records('user2', 50), [])
+
+    def test_write_behind_batches_appends(self):
+        writer = WriteBehindWriter(self.config, self.file_manager)
+        for record in _records(0, 20):
+            writer.enqueue('user1', record)
+        writer.stop()
+        self.assertEqual(len(self.file_manager.load_records('user1', 50)), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import unittest
+import tempfile
+import shutil
+
+from config_helper import make_config
+from media_ingestor import MediaIngestor, MediaStore
+
+
+class TestMediaStore(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _download(self, directory, name, data):
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_duplicate_content_is_stored_once(self):
+        store = MediaStore(os.path.join(self.test_dir, "media"))
+        first = store.add(self._download(store.new_incoming_dir(), "a.JPG", b"picture"))
+        second = store.add(self._download(store.new_incoming_dir(), "forwarded.jpg", b"picture"))
+        other = store.add(self._download(store.new_incoming_dir(), "b.jpg", b"another picture"))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertTrue(first.endswith(".jpg"))
+        with open(first, 'rb') as f:
+            self.assertEqual(f.read(), b"picture")
+
+    def test_ingestor_describes_each_file_once(self):
+        config = make_config(self.test_dir, FILE_DOWNLOAD_DIR=os.path.join(self.test_dir, "media"))
+        ingestor = MediaIngestor(config)
+        described = []
+
+        def describe(path):
+            described.append(path)
+            return f"file at {path}"
+
+        results = [ingestor.submit_download(lambda directory: self._download(directory, "f.bin", b"same"), describe)
+                   for _ in range(3)]
+        texts = {future.result(5) for future in results}
+        ingestor.stop()
+        self.assertEqual(len(texts), 1)
+        self.assertEqual(len(described), 1)
+        # Nothing is left behind in the staging area
+        self.assertEqual(os.listdir(ingestor.store.incoming_dir), [])
+
+    def test_processed_texts_are_bounded(self):
+        config = make_config(self.test_dir, FILE_DOWNLOAD_DIR=os.path.join(self.test_dir, "media"),
+                             MEDIA_CACHE_MAX_ENTRIES="2")
+        ingestor = MediaIngestor(config)
+        described = []
+
+        def ingest(data):
+            return ingestor.submit_download(lambda directory: self._download(directory, "f.bin", data),
+                                            lambda path: described.append(data) or data.decode()).result(5)
+
+        for data in (b"a", b"b", b"a", b"c", b"a", b"b"):
+            ingest(data)
+        ingestor.stop()
+        # "a" stays cached as the most recently used; "b" was evicted by "c" and described again
+        self.assertEqual(described, [b"a", b"b", b"c", b"b"])
+        self.assertEqual(list(ingestor._processed.values()), ["a", "b"])
+
+    def test_failed_download_raises(self):
+        config = make_config(self.test_dir, FILE_DOWNLOAD_DIR=os.path.join(self.test_dir, "media"))
+        ingestor = MediaIngestor(config)
+        future = ingestor.submit_download(lambda directory: None, lambda path: path)
+        with self.assertRaises(RuntimeError):
+            future.result(5)
+        ingestor.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
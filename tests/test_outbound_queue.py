@@ -0,0 +1,147 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+
+from config_helper import make_config
+from outbound_queue import OutboundQueue, PRIORITY_HIGH, PRIORITY_LOW
+
+
+class FakeChat:
+    """Records what would have been sent through the WeChat UI"""
+    def __init__(self, name, sent, delay=0.0, fail=False):
+        self.who = name
+        self.sent = sent
+        self.delay = delay
+        self.fail = fail
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def _record(self, kind, payload):
+        with self.lock:
+            self.active += 1
+            # Sends must never overlap, the UI automation is not thread-safe
+            assert self.active == 1
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if self.fail:
+            raise RuntimeError("window closed")
+        self.sent.append((self.who, kind, payload, time.monotonic()))
+
+    def SendMsg(self, msg):
+        self._record("text", msg)
+
+    def SendFiles(self, filepath):
+        self._record("file", filepath)
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.sent = []
+        self.chats = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _queue(self, **overrides):
+        config = make_config(self.test_dir, **overrides)
+        return OutboundQueue(config, self.chats.get)
+
+    def _add_chat(self, name, **kwargs):
+        self.chats[name] = FakeChat(name, self.sent, **kwargs)
+
+    def test_send_result(self):
+        self._add_chat("alice")
+        queue = self._queue()
+        result = queue.send_text("alice", "hello").result(2)
+        file_result = queue.send_file("alice", "/tmp/a.pdf").result(2)
+        missing = queue.send_text("bob", "hello").result(2)
+        queue.stop()
+        self.assertTrue(result.status)
+        self.assertGreaterEqual(result.latency, 0)
+        self.assertTrue(file_result.status)
+        self.assertFalse(missing.status)
+        self.assertEqual([(who, kind, payload) for who, kind, payload, _ in self.sent],
+                         [("alice", "text", "hello"), ("alice", "file", "/tmp/a.pdf")])
+
+    def test_failed_send(self):
+        self._add_chat("alice", fail=True)
+        queue = self._queue()
+        self.assertFalse(queue.send_text("alice", "hello").result(2).status)
+        queue.stop()
+
+    def test_rate_limit(self):
+        self._add_chat("alice")
+        queue = self._queue(OUTBOUND_RATE="20", OUTBOUND_BURST="1")
+        start = time.monotonic()
+        futures = [queue.send_file("alice", f"/tmp/{index}") for index in range(5)]
+        for future in futures:
+            self.assertTrue(future.result(2).status)
+        queue.stop()
+        # The first send uses the burst, the other four wait 1/20 s each
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_coalesce_adjacent_text(self):
+        self._add_chat("alice", delay=0.1)
+        self._add_chat("bob")
+        queue = self._queue(OUTBOUND_COALESCE_MAX_CHARS="12")
+        first = queue.send_text("alice", "busy")
+        time.sleep(0.02)
+        # Queued while the first send is in progress
+        futures = [queue.send_text("alice", part) for part in ("one", "two", "three")]
+        futures.append(queue.send_file("alice", "/tmp/a.pdf"))
+        futures.append(queue.send_text("alice", "four"))
+        for future in [first] + futures:
+            self.assertTrue(future.result(2).status)
+        queue.stop()
+        self.assertEqual([payload for _, _, payload, _ in self.sent],
+                         ["busy", "one\ntwo", "three", "/tmp/a.pdf", "four"])
+
+    def test_per_chat_fifo_and_priority(self):
+        self._add_chat("alice", delay=0.1)
+        self._add_chat("bob")
+        self._add_chat("carol")
+        queue = self._queue()
+        blocker = queue.send_file("alice", "/tmp/blocker")
+        time.sleep(0.02)
+        futures = [queue.send_file("bob", "/tmp/b1", PRIORITY_LOW),
+                   queue.send_file("carol", "/tmp/c1", PRIORITY_HIGH),
+                   # Behind a low priority message of the same chat, so it waits for it
+                   queue.send_file("bob", "/tmp/b2", PRIORITY_HIGH),
+                   queue.send_file("alice", "/tmp/a2")]
+        for future in [blocker] + futures:
+            self.assertTrue(future.result(2).status)
+        queue.stop()
+        self.assertEqual([payload for _, _, payload, _ in self.sent],
+                         ["/tmp/blocker", "/tmp/c1", "/tmp/a2", "/tmp/b1", "/tmp/b2"])
+
+    def test_concurrent_senders_never_overlap(self):
+        for index in range(4):
+            self._add_chat(f"user{index}", delay=0.002)
+        queue = self._queue(OUTBOUND_RATE="1000", OUTBOUND_BURST="1000")
+        futures = []
+        lock = threading.Lock()
+
+        def worker(name):
+            for index in range(10):
+                future = queue.send_file(name, f"{name}/{index}")
+                with lock:
+                    futures.append(future)
+
+        threads = [threading.Thread(target=worker, args=(name,)) for name in self.chats]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        queue.stop()
+        self.assertTrue(all(future.result(0).status for future in futures))
+        for name in self.chats:
+            self.assertEqual([payload for who, _, payload, _ in self.sent if who == name],
+                             [f"{name}/{index}" for index in range(10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
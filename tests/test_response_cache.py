@@ -0,0 +1,118 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+
+from config_helper import make_config
+from LLM.response_cache import ResponseCache
+
+SYSTEM = {"role": "system", "content": "Be brief."}
+REPLY = {"role": "assistant", "content": "I have movies.txt and songs.txt"}
+
+
+def _user(content):
+    return {"role": "user", "content": content}
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.files_dir = os.path.join(self.test_dir, "files")
+        os.makedirs(self.files_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _cache(self, **overrides):
+        self.config = make_config(self.test_dir, RESPONSE_CACHE="true", INFO_FILES_DIRECTORY=self.files_dir,
+                                  **overrides)
+        return ResponseCache(self.config)
+
+    def test_exact_tier_normalizes_the_message(self):
+        cache = self._cache()
+        cache.put(cache.key(SYSTEM, [], _user("What files do you have?")), REPLY, ["I have", "movies.txt"])
+        entry = cache.get(cache.key(SYSTEM, [], _user("  what  FILES do you have ")))
+        self.assertEqual(entry.response, REPLY)
+        self.assertEqual(entry.segments, ["I have", "movies.txt"])
+        # A different context tail or system prompt is another request
+        self.assertIsNone(cache.get(cache.key(SYSTEM, [_user("hi"), REPLY], _user("What files do you have?"))))
+        self.assertIsNone(cache.get(cache.key({"role": "system", "content": "Be rude."}, [],
+                                              _user("What files do you have?"))))
+        stats = cache.stats()
+        self.assertEqual((stats["exact_hits"], stats["misses"]), (1, 2))
+
+    def test_only_the_context_tail_is_part_of_the_key(self):
+        cache = self._cache(RESPONSE_CACHE_CONTEXT_MESSAGES="1")
+        cache.put(cache.key(SYSTEM, [_user("old"), REPLY], _user("send me the video list")), REPLY)
+        self.assertIsNotNone(cache.get(cache.key(SYSTEM, [_user("other"), REPLY], _user("send me the video list"))))
+
+    def test_similarity_tier(self):
+        cache = self._cache(RESPONSE_CACHE_SIMILARITY="0.8")
+        cache.put(cache.key(SYSTEM, [], _user("what files do you have")), REPLY)
+        self.assertIsNotNone(cache.get(cache.key(SYSTEM, [], _user("what files do you have now"))))
+        self.assertIsNone(cache.get(cache.key(SYSTEM, [], _user("tell me a joke about cats"))))
+        self.assertEqual(cache.stats()["similar_hits"], 1)
+
+    def test_ttl_and_lru_eviction(self):
+        cache = self._cache(RESPONSE_CACHE_MAX_ENTRIES="2", RESPONSE_CACHE_TTL="0.1")
+        for question in ("a", "b"):
+            cache.put(cache.key(SYSTEM, [], _user(question)), REPLY)
+        # "a" is used, so "b" is the least recently used one
+        cache.get(cache.key(SYSTEM, [], _user("a")))
+        cache.put(cache.key(SYSTEM, [], _user("c")), REPLY)
+        self.assertIsNone(cache.get(cache.key(SYSTEM, [], _user("b"))))
+        self.assertIsNotNone(cache.get(cache.key(SYSTEM, [], _user("a"))))
+        time.sleep(0.15)
+        self.assertIsNone(cache.get(cache.key(SYSTEM, [], _user("a"))))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_opt_out_and_side_effect_tools(self):
+        cache = self._cache(RESPONSE_CACHE_OPT_OUT="alice, bob")
+        self.assertFalse(cache.enabled_for("alice"))
+        self.assertTrue(cache.enabled_for("carol"))
+        self.assertTrue(cache.cacheable([]))
+        self.assertTrue(cache.cacheable(["list_files_in_directory"]))
+        self.assertFalse(cache.cacheable(["list_files_in_directory", "send_a_file"]))
+
+    def test_files_change_clears_the_cache(self):
+        cache = self._cache(CONFIG_RELOAD_INTERVAL="0.05")
+        cache.put(cache.key(SYSTEM, [], _user("what files do you have")), REPLY)
+        self.config.start_watching()
+        try:
+            mtime = os.path.getmtime(self.files_dir)
+            with open(os.path.join(self.files_dir, "new.txt"), "w", encoding="utf-8") as f:
+                f.write("new")
+            os.utime(self.files_dir, (mtime + 1, mtime + 1))
+            deadline = time.monotonic() + 2
+            while cache.stats()["entries"] and time.monotonic() < deadline:
+                time.sleep(0.02)
+            self.assertEqual(cache.stats()["entries"], 0)
+        finally:
+            self.config.stop_watching()
+
+    def test_file_edited_in_place_clears_the_cache(self):
+        path = os.path.join(self.files_dir, "file_descriptions.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("movies.txt: films\n")
+        cache = self._cache(CONFIG_RELOAD_INTERVAL="0.05")
+        cache.put(cache.key(SYSTEM, [], _user("what files do you have")), REPLY)
+        self.config.start_watching()
+        try:
+            time.sleep(0.15)
+            self.assertEqual(cache.stats()["entries"], 1)
+            directory_mtime = os.path.getmtime(self.files_dir)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("songs.txt: music\n")
+            # Only the file changed, not the directory
+            self.assertEqual(os.path.getmtime(self.files_dir), directory_mtime)
+            deadline = time.monotonic() + 2
+            while cache.stats()["entries"] and time.monotonic() < deadline:
+                time.sleep(0.02)
+            self.assertEqual(cache.stats()["entries"], 0)
+        finally:
+            self.config.stop_watching()
+
+
+if __name__ == '__main__':
+    unittest.main()
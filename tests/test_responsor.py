@@ -0,0 +1,355 @@
+import unittest
+import tempfile
+import shutil
+import os
+import copy
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from bench import fake_wechat
+# The default tools import wechat_client, which needs wxauto
+fake_wechat.install()
+
+from config_helper import make_config
+from LLM.responsor import Responsor, RequestCancelled
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOOLS_MODULE = '''
+import time
+
+calls = []
+
+
+def slow(seconds, user_id):
+    time.sleep(float(seconds))
+    return f"slept {seconds}"
+
+
+def echo(text, user_id):
+    return f"echo {text}"
+
+
+def send_a_file(file_name, user_id):
+    calls.append(file_name)
+    return f"File {file_name} sent successfully!"
+'''
+
+
+def token_usage(prompt_tokens, completion_tokens):
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def completion(content=None, tool_calls=(), usage=None):
+    """A non-streamed chat completion as returned by the OpenAI client"""
+    calls = [SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+             for call_id, name, arguments in tool_calls]
+    message = SimpleNamespace(role="assistant", content=content, tool_calls=calls or None)
+    return SimpleNamespace(usage=usage, choices=[SimpleNamespace(message=message)])
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached in time")
+        time.sleep(0.01)
+
+
+class FakeStream:
+    """A streamed chat completion: one chunk per part, then close(); waits for gate after the first part"""
+
+    def __init__(self, parts, gate=None, usage=None):
+        self.parts = parts
+        self.gate = gate
+        self.usage = usage
+
+    def __iter__(self):
+        for i, part in enumerate(self.parts):
+            if i == 1 and self.gate != None:
+                self.gate.wait(5)
+            delta = SimpleNamespace(content=part, tool_calls=None)
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+        if self.usage != None:
+            yield SimpleNamespace(usage=self.usage, choices=[])
+
+    def close(self):
+        pass
+
+
+class FakeCompletions:
+    """Stands in for client.chat.completions; replies are completions, or functions of the request"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        with self.lock:
+            # The message list is extended in place by later tool rounds
+            self.requests.append(copy.deepcopy(kwargs))
+            reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        return reply(kwargs) if callable(reply) else reply
+
+
+class ResponsorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.files_dir = os.path.join(self.test_dir, "files")
+        os.makedirs(self.files_dir)
+        tools_path = os.path.join(self.test_dir, "tools.py")
+        with open(tools_path, "w", encoding="utf-8") as f:
+            f.write(TOOLS_MODULE)
+        descriptions_path = os.path.join(self.test_dir, "tools.json")
+        with open(descriptions_path, "w", encoding="utf-8") as f:
+            json.dump([{"type": "function", "function": {"name": name, "parameters": {"type": "object"}}}
+                       for name in ("slow", "echo")], f)
+        self.settings = {"SYSTEM_PROMPT_PATH": os.path.join(REPO_DIR, "system_prompt.json"),
+                         "TOOLS_DESCRIPTION_PATH": descriptions_path, "TOOLS_IMPLEMENTATION_PATH": tools_path,
+                         "INFO_FILES_DIRECTORY": self.files_dir}
+        self.responsors = []
+
+    def tearDown(self):
+        for responsor in self.responsors:
+            responsor.client_pool.close()
+        shutil.rmtree(self.test_dir)
+
+    def make_responsor(self, replies, *endpoint_replies, **overrides):
+        """A Responsor whose endpoints answer with replies, or each with its own list of endpoint_replies"""
+        config = make_config(self.test_dir, **dict(self.settings, **overrides))
+        responsor = Responsor(config)
+        completions = [FakeCompletions(replies) for replies in (replies,) + endpoint_replies]
+        for endpoint, endpoint_completions in zip(responsor.client_pool.endpoints, completions * 2):
+            endpoint.client = SimpleNamespace(chat=SimpleNamespace(completions=endpoint_completions),
+                                              close=lambda: None)
+        self.responsors.append(responsor)
+        return (responsor,) + tuple(completions)
+
+
+class TestToolLoop(ResponsorTestCase):
+    def test_tools_run_concurrently_and_results_follow_their_call_ids(self):
+        responsor, completions = self.make_responsor([
+            completion(tool_calls=[("call-slow", "slow", {"seconds": 0.3}), ("call-echo", "echo", {"text": "hi"}),
+                                   ("call-other", "slow", {"seconds": 0.3})]),
+            completion("done")])
+        start = time.monotonic()
+        response = responsor.send_request("user1", {"role": "user", "content": "go"})
+        self.assertLess(time.monotonic() - start, 0.55)
+        self.assertEqual(response, {"role": "assistant", "content": "done"})
+        tool_messages = {message["tool_call_id"]: message["content"]
+                         for message in completions.requests[1]["messages"] if message["role"] == "tool"}
+        self.assertEqual(tool_messages, {"call-slow": "slept 0.3", "call-echo": "echo hi", "call-other": "slept 0.3"})
+
+    def test_slow_tool_times_out_on_its_own_limit(self):
+        responsor, completions = self.make_responsor([
+            completion(tool_calls=[("call-slow", "slow", {"seconds": 1}), ("call-echo", "echo", {"text": "hi"})]),
+            completion("done")], TOOL_TIMEOUTS="slow=0.1")
+        start = time.monotonic()
+        responsor.send_request("user1", {"role": "user", "content": "go"})
+        self.assertLess(time.monotonic() - start, 0.8)
+        tools = [message for message in completions.requests[1]["messages"] if message["role"] == "tool"]
+        self.assertIn("timed out after 0.1 seconds", tools[0]["content"])
+        self.assertEqual(tools[1]["content"], "echo hi")
+
+    def test_round_limit_forces_an_answer_and_empty_content_is_a_string(self):
+        # The model keeps asking for tools and never writes an answer
+        responsor, completions = self.make_responsor(
+            [completion(tool_calls=[("call-echo", "echo", {"text": "again"})])], MAX_TOOL_ROUNDS="2")
+        response = responsor.send_request("user1", {"role": "user", "content": "go"})
+        self.assertEqual([request["tool_choice"] for request in completions.requests], ["auto", "auto", "none"])
+        self.assertEqual(response, {"role": "assistant", "content": ""})
+
+
+class TestSystemPrompts(ResponsorTestCase):
+    def write_prompts(self, prompts):
+        path = os.path.join(self.test_dir, "system_prompt.json")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(prompts if isinstance(prompts, str) else json.dumps(prompts))
+        return path
+
+    def test_reload_swaps_the_prompt_table(self):
+        path = self.write_prompts({"default": "Be brief.", "alice": "Speak French."})
+        responsor, completions = self.make_responsor([completion("ok")], SYSTEM_PROMPT_PATH=path)
+        responsor.send_request("alice", {"role": "user", "content": "hi"})
+        responsor.send_request("bob", {"role": "user", "content": "hi"})
+        self.assertEqual([request["messages"][0]["content"] for request in completions.requests],
+                         ["Speak French.", "Be brief."])
+        old_reserved = responsor.count_reserved_tokens("alice", {"role": "user", "content": "hi"})
+
+        self.write_prompts({"default": "Answer in one long and very detailed paragraph, always."})
+        self.assertTrue(responsor.reload_system_prompt())
+        responsor.send_request("alice", {"role": "user", "content": "hi"})
+        # alice has no prompt of her own any more, and the token counts follow the new table
+        self.assertEqual(completions.requests[-1]["messages"][0]["content"],
+                         "Answer in one long and very detailed paragraph, always.")
+        self.assertGreater(responsor.count_reserved_tokens("alice", {"role": "user", "content": "hi"}), old_reserved)
+
+    def test_invalid_file_keeps_the_current_prompts(self):
+        path = self.write_prompts({"default": "Be brief."})
+        responsor, _ = self.make_responsor([completion("ok")], SYSTEM_PROMPT_PATH=path)
+        self.write_prompts("[not a prompt table")
+        self.assertFalse(responsor.reload_system_prompt())
+        self.assertEqual(responsor._get_system_message("anyone")["content"], "Be brief.")
+
+
+class TestResponseCache(ResponsorTestCase):
+    QUESTION = {"role": "user", "content": "What should I eat tonight?"}
+
+    def test_different_summaries_miss_the_cache(self):
+        responsor, completions = self.make_responsor([completion("Try the walnut salad."), completion("Try the bistro.")],
+                                                     RESPONSE_CACHE="true")
+        first = responsor.send_request("alice", self.QUESTION, summary="Alice loves walnuts.")
+        # Same recent history and question, different earlier conversation: alice's reply must not leak
+        second = responsor.send_request("bob", self.QUESTION, summary="Bob lives next to a bistro.")
+        self.assertEqual((first["content"], second["content"]), ("Try the walnut salad.", "Try the bistro."))
+        self.assertEqual(len(completions.requests), 2)
+        again = responsor.send_request("carol", self.QUESTION, summary="Alice loves walnuts.")
+        self.assertEqual(again["content"], "Try the walnut salad.")
+        self.assertEqual(len(completions.requests), 2)
+
+    def test_hit_delivers_the_stored_segments(self):
+        responsor, completions = self.make_responsor(
+            [FakeStream(["Here is the list of files. ", "It has movies.txt and ", "notes.txt in it."])],
+            RESPONSE_CACHE="true", STREAM_RESPONSE="true", STREAM_MIN_SEGMENT_LENGTH="1")
+        streamed, replayed = [], []
+        first = responsor.send_request("alice", {"role": "user", "content": "what files do you have"},
+                                       on_segment=streamed.append)
+        second = responsor.send_request("bob", {"role": "user", "content": "What files do you have?"},
+                                        on_segment=replayed.append)
+        self.assertEqual(len(completions.requests), 1)
+        self.assertGreater(len(streamed), 1)
+        self.assertEqual(replayed, streamed)
+        self.assertEqual(second, first)
+
+    def test_turns_calling_unsafe_tools_are_not_cached(self):
+        send_file = completion(tool_calls=[("call-file", "send_a_file", {"file_name": "a.txt"})])
+        responsor, completions = self.make_responsor([send_file, completion("Sent."), send_file, completion("Sent.")],
+                                                     RESPONSE_CACHE="true")
+        for user_id in ("alice", "bob"):
+            self.assertEqual(responsor.send_request(user_id, {"role": "user", "content": "send a.txt"})["content"],
+                             "Sent.")
+        # The file is sent to both friends, the second turn is not answered from the cache
+        calls = responsor.tool_manager.tool_implementations["send_a_file"].__globals__["calls"]
+        self.assertEqual(calls, ["a.txt", "a.txt"])
+        self.assertEqual(len(completions.requests), 4)
+        self.assertEqual(responsor.response_cache.stats()["stores"], 0)
+
+    def test_turns_calling_safe_tools_are_cached(self):
+        responsor, completions = self.make_responsor(
+            [completion(tool_calls=[("call-echo", "echo", {"text": "files"})]), completion("I have a.txt.")],
+            RESPONSE_CACHE="true", RESPONSE_CACHE_SAFE_TOOLS="echo")
+        for user_id in ("alice", "bob"):
+            self.assertEqual(responsor.send_request(user_id, {"role": "user", "content": "files?"})["content"],
+                             "I have a.txt.")
+        self.assertEqual(len(completions.requests), 2)
+
+
+class TestCoalescing(ResponsorTestCase):
+    def start(self, target, *args, **kwargs):
+        results = {}
+
+        def run():
+            try:
+                results["response"] = target(*args, **kwargs)
+            except Exception as e:
+                results["error"] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread, results
+
+    def test_key_covers_model_stream_mode_tools_and_messages(self):
+        gate = threading.Event()
+
+        def reply(kwargs):
+            gate.wait(5)
+            return FakeStream(["streamed"]) if kwargs["stream"] else completion("answer")
+
+        responsor, completions = self.make_responsor([reply], LLM_MAX_INFLIGHT="8")
+        messages = [{"role": "user", "content": "hi"}]
+        threads = []
+        expected_requests = 0
+
+        def in_flight(upstream, *args, **kwargs):
+            nonlocal expected_requests
+            coalesced = responsor.single_flight.stats()["coalesced_calls"]
+            threads.append(self.start(responsor._send_single_request, *args, **kwargs)[0])
+            if upstream:
+                expected_requests += 1
+                wait_until(lambda: len(completions.requests) == expected_requests)
+            else:
+                wait_until(lambda: responsor.single_flight.stats()["coalesced_calls"] == coalesced + 1)
+
+        in_flight(True, list(messages))
+        in_flight(False, list(messages))
+        in_flight(True, list(messages), allow_tools=False)
+        in_flight(True, [{"role": "user", "content": "hello"}])
+        make_config(self.test_dir, **dict(self.settings, MODEL_NAME="other-model", LLM_MAX_INFLIGHT="8"))
+        responsor.config.reload()
+        in_flight(True, list(messages))
+        responsor.stream_response = True
+        in_flight(True, list(messages))
+        gate.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([(request["model"], request["stream"], request["tool_choice"], request["messages"][-1]["content"])
+                          for request in completions.requests],
+                         [("test-model", False, "auto", "hi"), ("test-model", False, "none", "hi"),
+                          ("test-model", False, "auto", "hello"), ("other-model", False, "auto", "hi"),
+                          ("other-model", True, "auto", "hi")])
+
+    def test_cancelled_follower_does_not_cancel_the_leader(self):
+        gate = threading.Event()
+        responsor, completions = self.make_responsor(
+            [FakeStream(["First part here. ", "Second part here."], gate)],
+            STREAM_RESPONSE="true", STREAM_MIN_SEGMENT_LENGTH="1")
+        messages = [{"role": "user", "content": "hi"}]
+        leader_segments, follower_segments = [], []
+        leader, leader_result = self.start(responsor._send_single_request, list(messages),
+                                           leader_segments.append, cancel_event=threading.Event())
+        wait_until(lambda: leader_segments)
+        follower_cancel = threading.Event()
+        follower, follower_result = self.start(responsor._send_single_request, list(messages),
+                                               follower_segments.append, cancel_event=follower_cancel)
+        wait_until(lambda: follower_segments)
+        follower_cancel.set()
+        follower.join(5)
+        self.assertIsInstance(follower_result.get("error"), RequestCancelled)
+        gate.set()
+        leader.join(5)
+        self.assertEqual(leader_result["response"]["content"], "First part here. Second part here.")
+        self.assertEqual(leader_segments, ["First part here.", "Second part here."])
+        self.assertEqual(len(completions.requests), 1)
+
+
+class TestHedging(ResponsorTestCase):
+    def test_only_the_winning_attempt_is_accounted(self):
+        for stream in (False, True):
+            with self.subTest(stream=stream):
+                def slow_reply(kwargs):
+                    time.sleep(0.3)
+                    if kwargs["stream"]:
+                        return FakeStream(["Slow answer."], usage=token_usage(100, 100))
+                    return completion("Slow answer.", usage=token_usage(100, 100))
+
+                fast_reply = FakeStream(["Fast answer."], usage=token_usage(10, 5)) if stream else \
+                    completion("Fast answer.", usage=token_usage(10, 5))
+                responsor, slow, fast = self.make_responsor(
+                    [slow_reply], [fast_reply], STREAM_RESPONSE=str(stream).lower(), LLM_HEDGE_MIN_SAMPLES="1",
+                    LLM_ENDPOINTS="http://127.0.0.1:9/v1|slow-model|1000, http://127.0.0.1:9/v1|fast-model|0.001")
+                responsor.client_pool.endpoints[0].observe(0.05, 1.0)
+                usage = {}
+                response = responsor._request_completion([{"role": "user", "content": "hi"}], usage=usage)
+                self.assertEqual(response["content"], "Fast answer.")
+                # Let the losing attempt finish
+                time.sleep(0.4)
+                self.assertEqual((len(slow.requests), len(fast.requests)), (1, 1))
+                self.assertEqual(usage, {"prompt_tokens": 10, "completion_tokens": 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
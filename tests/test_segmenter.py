@@ -0,0 +1,41 @@
+import unittest
+
+from LLM.segmenter import SegmentSplitter
+
+
+class TestSegmentSplitter(unittest.TestCase):
+    def _split(self, deltas, min_length=5):
+        splitter = SegmentSplitter(min_length)
+        segments = []
+        for delta in deltas:
+            segments.extend(splitter.feed(delta))
+        return segments, splitter.flush()
+
+    def test_sentence_boundaries_across_deltas(self):
+        segments, rest = self._split(["Hello there", ". How are", " you? I am", " fine"])
+        self.assertEqual(segments, ["Hello there.", "How are you?"])
+        self.assertEqual(rest, ["I am fine"])
+
+    def test_cjk_punctuation(self):
+        segments, rest = self._split(["你好，我是助手。", "有什么可以帮你的吗？", "好"])
+        self.assertEqual(segments, ["你好，我是助手。", "有什么可以帮你的吗？"])
+        self.assertEqual(rest, ["好"])
+
+    def test_short_sentences_are_merged(self):
+        segments, rest = self._split(["Hi. Ok. This is longer. "], min_length=10)
+        self.assertEqual(segments, ["Hi. Ok. This is longer."])
+        self.assertEqual(rest, [])
+
+    def test_paragraph_break_always_flushes(self):
+        segments, rest = self._split(["Hi\n", "\nNext paragraph"], min_length=10)
+        self.assertEqual(segments, ["Hi"])
+        self.assertEqual(rest, ["Next paragraph"])
+
+    def test_decimal_point_is_not_a_boundary(self):
+        segments, rest = self._split(["Pi is 3", ".14 roughly"])
+        self.assertEqual(segments, [])
+        self.assertEqual(rest, ["Pi is 3.14 roughly"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import threading
+import time
+
+from LLM.single_flight import SingleFlight
+
+
+class Cancelled(Exception):
+    pass
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.flights = SingleFlight(Cancelled)
+        self.release = threading.Event()
+        self.calls = 0
+
+    def _call(self, publish, cancel):
+        self.calls += 1
+        publish("first")
+        while not self.release.wait(0.01):
+            if cancel.is_set():
+                raise Cancelled()
+        publish("second")
+        return {"role": "assistant", "content": "first second"}
+
+    def _start(self, key, results, segments, cancel_event=None):
+        def run():
+            try:
+                results.append(self.flights.run(key, self._call, segments.append, cancel_event))
+            except Exception as e:
+                results.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_identical_calls_share_one_upstream_call(self):
+        results, segments = [], [[], [], []]
+        threads = [self._start("same", results, segments[index]) for index in range(3)]
+        self._wait_for(lambda: self.flights.stats()["coalesced_calls"] == 2)
+        other = self._start("other", [], [])
+        self.release.set()
+        for thread in threads + [other]:
+            thread.join()
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(results, [{"role": "assistant", "content": "first second"}] * 3)
+        # Every waiter got its own copy and every streamed segment
+        self.assertIsNot(results[0], results[1])
+        self.assertEqual(segments, [["first", "second"]] * 3)
+        stats = self.flights.stats()
+        self.assertEqual((stats["upstream_calls"], stats["coalesced_calls"], stats["in_flight"]), (2, 2, 0))
+
+    def test_call_continues_until_every_caller_is_cancelled(self):
+        leader_cancel, waiter_cancel = threading.Event(), threading.Event()
+        leader_results, waiter_results = [], []
+        leader = self._start("key", leader_results, [], leader_cancel)
+        self._wait_for(lambda: self.calls == 1)
+        waiter = self._start("key", waiter_results, [], waiter_cancel)
+        self._wait_for(lambda: self.flights.stats()["coalesced_calls"] == 1)
+        # The leader's cancellation alone does not abandon the call the waiter needs
+        leader_cancel.set()
+        time.sleep(0.05)
+        self.assertTrue(leader.is_alive())
+        waiter_cancel.set()
+        leader.join()
+        waiter.join()
+        self.assertIsInstance(leader_results[0], Cancelled)
+        self.assertIsInstance(waiter_results[0], Cancelled)
+
+    def test_errors_reach_every_waiter(self):
+        started = threading.Event()
+
+        def failing(publish, cancel):
+            started.set()
+            self.release.wait()
+            raise RuntimeError("upstream down")
+
+        results = []
+
+        def run():
+            try:
+                self.flights.run("key", failing)
+            except RuntimeError as e:
+                results.append(str(e))
+        threads = [threading.Thread(target=run) for _ in range(2)]
+        threads[0].start()
+        started.wait()
+        threads[1].start()
+        self._wait_for(lambda: self.flights.stats()["coalesced_calls"] == 1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["upstream down"] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
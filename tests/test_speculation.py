@@ -0,0 +1,153 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+
+from config_helper import make_config
+from LLM.debounce_pool import DebouncePool
+from LLM.dispatcher import RequestDispatcher
+from LLM.speculation import SpeculationManager
+
+
+class TestSpeculation(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.config = make_config(self.test_dir, MAX_WAIT_DURATION="0.4", DEBOUNCE_THRESHOLD="10",
+                                  SPECULATIVE_IDLE_THRESHOLD="0.1")
+        self.runs = []
+        self.cancelled = []
+        self.taken = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _run(self, user_id, message, cancel_event, segments, usage):
+        self.runs.append(message["content"])
+        usage["completion_tokens"] = 5
+        segments.append("reply to " + message["content"])
+        # Simulate generation time; a cancelled run stops early
+        if cancel_event.wait(0.15):
+            self.cancelled.append(message["content"])
+            return None
+        return {"role": "assistant", "content": "reply to " + message["content"]}
+
+    def _callback(self, user_id, message):
+        self.taken.append((message["content"], self.speculation.take(user_id)))
+        self.done.set()
+
+    def test_hit_reuses_speculative_reply(self):
+        self.speculation = SpeculationManager(self.config, self._run)
+        pool = DebouncePool(self.config, self._callback, self.speculation)
+        pool.submit_message('user1', {'role': 'user', 'content': 'Hello'})
+        self.assertTrue(self.done.wait(2))
+        pool.stop()
+        content, speculated = self.taken[0]
+        self.assertEqual(content, 'Hello')
+        reply, segments = speculated
+        self.assertEqual(reply["content"], "reply to Hello")
+        self.assertEqual(segments, ["reply to Hello"])
+        stats = self.speculation.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 0))
+        self.assertGreater(stats["latency_saved"], 0)
+
+    def test_new_message_cancels_speculation(self):
+        self.speculation = SpeculationManager(self.config, self._run)
+        pool = DebouncePool(self.config, self._callback, self.speculation)
+        pool.submit_message('user1', {'role': 'user', 'content': 'a'})
+        # Let the speculation on 'a' start, then send another message
+        threading.Event().wait(0.15)
+        pool.submit_message('user1', {'role': 'user', 'content': 'b'})
+        self.assertTrue(self.done.wait(2))
+        pool.stop()
+        self.assertEqual(self.cancelled, ['a'])
+        content, speculated = self.taken[0]
+        self.assertEqual(content, 'ab')
+        # The second speculation was made on the flushed messages and is used
+        self.assertEqual(speculated[0]["content"], "reply to ab")
+        stats = self.speculation.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["wasted_tokens"], 5)
+
+    def test_no_speculation_while_turn_pending(self):
+        self.speculation = SpeculationManager(self.config, self._run, can_speculate=lambda user_id: False)
+        pool = DebouncePool(self.config, self._callback, self.speculation)
+        pool.submit_message('user1', {'role': 'user', 'content': 'Hello'})
+        self.assertTrue(self.done.wait(2))
+        pool.stop()
+        self.assertEqual(self.runs, [])
+        self.assertIsNone(self.taken[0][1])
+
+    def test_failed_run_is_aborted(self):
+        self.speculation = SpeculationManager(self.config, lambda *args: None)
+        pool = DebouncePool(self.config, self._callback, self.speculation)
+        pool.submit_message('user1', {'role': 'user', 'content': 'Hello'})
+        self.assertTrue(self.done.wait(2))
+        pool.stop()
+        self.assertIsNone(self.taken[0][1])
+        self.assertEqual(self.speculation.stats()["aborted"], 1)
+
+
+class TestDroppedTurns(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.config = make_config(self.test_dir, DISPATCH_WORKERS="1", DISPATCH_MAX_QUEUED="1",
+                                  SPECULATIVE_IDLE_THRESHOLD="0.1")
+        self.taken = []
+        self.gate = threading.Event()
+        self.speculation = SpeculationManager(self.config, self._run)
+        self.dispatcher = RequestDispatcher(self.config, self._handler, on_dropped=self.speculation.discard)
+
+    def tearDown(self):
+        self.gate.set()
+        self.dispatcher.stop()
+        shutil.rmtree(self.test_dir)
+
+    def _run(self, user_id, message, cancel_event, segments, usage):
+        return {"role": "assistant", "content": "reply to " + message["content"]}
+
+    def _handler(self, user_id, message):
+        if user_id != "user1":
+            self.gate.wait(2)
+        else:
+            self.taken.append((message["content"], self.speculation.take(user_id)))
+
+    def _flush(self, user_id, content, speculate=True):
+        # What DebouncePool does when the messages are flushed
+        message = {"role": "user", "content": content}
+        if speculate:
+            self.speculation.start(user_id, message)
+        self.speculation.seal(user_id, message)
+        self.dispatcher.submit(user_id, message)
+
+    def _occupy_worker(self):
+        self.dispatcher.submit("busy", {"role": "user", "content": "1"})
+        while self.dispatcher.stats()["in_progress"] == 0:
+            time.sleep(0.01)
+
+    def test_next_turn_after_a_shed_turn_is_not_answered_with_its_reply(self):
+        # One turn in progress and one waiting: DISPATCH_MAX_QUEUED is reached
+        self._occupy_worker()
+        self.dispatcher.submit("other", {"role": "user", "content": "2"})
+        self._flush("user1", "first question")
+        self.gate.set()
+        self.assertTrue(self.dispatcher.join(2))
+        # The next flush has no speculation of its own (e.g. the threshold was reached)
+        self._flush("user1", "second question", speculate=False)
+        self.assertTrue(self.dispatcher.join(2))
+        self.assertEqual(self.taken, [("second question", None)])
+        self.assertEqual(self.dispatcher.stats()["shed"], 1)
+
+    def test_merged_turn_is_not_answered_with_the_first_reply(self):
+        self._occupy_worker()
+        self._flush("user1", "A")
+        self._flush("user1", "B", speculate=False)
+        self.gate.set()
+        self.assertTrue(self.dispatcher.join(2))
+        self.assertEqual(self.taken, [("A\nB", None)])
+        self.assertEqual(self.dispatcher.stats()["merged"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+from config_helper import make_config
+from context.file_manager import FileManager
+from context.migrate_storage import migrate
+from context.sqlite_storage import SQLiteStorage
+from context.storage_backend import StorageBackend, create_storage_backend
+from context.storage_manager import StorageManager
+
+
+def _records(start, count, ts=0):
+    return [{"seq": seq, "ts": ts, "message": {"role": "user", "content": f"m{seq}"}}
+            for seq in range(start, start + count)]
+
+
+class TestSQLiteStorage(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.storage = SQLiteStorage(os.path.join(self.test_dir, "history.db"))
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_tail_reads_and_duplicates(self):
+        self.storage.append_records('user1', _records(0, 100))
+        self.storage.append_records('user2', _records(0, 3))
+        # A record replayed twice replaces itself
+        self.storage.append_records('user1', _records(99, 1), fsync=True)
+        self.assertEqual(self.storage.load_records('user1', 5), _records(95, 5))
+        self.assertEqual(self.storage.load_context('user2'), [record["message"] for record in _records(0, 3)])
+        self.assertEqual(self.storage.load_records('nobody', 5), [])
+        self.assertEqual(self.storage.user_ids(), ['user1', 'user2'])
+
+    def test_sync_batch_checkpoints_once(self):
+        self.storage.append_batch({'user1': _records(0, 2), 'user2': _records(0, 2), 'user3': _records(0, 2)})
+        synced = []
+        self.storage.sync = synced.append
+        self.assertEqual(self.storage.sync_batch(['user1', 'user2', 'user3']), {})
+        self.assertEqual(len(synced), 1)
+        self.assertEqual(self.storage.sync_batch([]), {})
+        self.assertEqual(len(synced), 1)
+
+    def test_incomplete_backend_cannot_be_created(self):
+        class AppendOnly(StorageBackend):
+            def append_records(self, user_id, records, fsync=False):
+                pass
+
+        with self.assertRaises(TypeError):
+            AppendOnly()
+
+    def test_batch_compaction_and_retention(self):
+        failures = self.storage.append_batch({'user1': _records(0, 10, ts=100), 'user2': _records(0, 4, ts=200)})
+        self.assertEqual(failures, {})
+        self.storage.compact('user1', max_messages=4)
+        self.assertEqual([record["seq"] for record in self.storage.load_records('user1', 50)], [6, 7, 8, 9])
+        self.assertEqual(self.storage.prune(150), 4)
+        self.assertEqual(self.storage.user_ids(), ['user2'])
+
+    def test_summaries(self):
+        self.assertEqual(self.storage.load_summary('user1'), {"summary": "", "upto_seq": 0})
+        self.storage.save_summary('user1', {"summary": "likes tea", "upto_seq": 12})
+        self.assertEqual(self.storage.load_summary('user1'), {"summary": "likes tea", "upto_seq": 12})
+
+    def test_storage_manager_on_sqlite(self):
+        config = make_config(self.test_dir, CONTEXT_STORAGE_DIR=self.test_dir, CONTEXT_STORAGE_BACKEND="sqlite",
+                             CONTEXT_FLUSH_INTERVAL="0.05")
+        backend = create_storage_backend(config)
+        self.assertIsInstance(backend, SQLiteStorage)
+        manager = StorageManager(config, backend)
+        manager.add_contexts('user1', [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}])
+        manager.close()
+        self.assertEqual([record["seq"] for record in backend.load_records('user1', 10)], [0, 1])
+        backend.close()
+
+    def test_migration_from_files(self):
+        source_dir = os.path.join(self.test_dir, "files")
+        os.makedirs(source_dir)
+        source = FileManager(make_config(self.test_dir, CONTEXT_STORAGE_DIR=source_dir))
+        source.append_records('user1', _records(0, 5))
+        # Written twice after a crash
+        source.append_records('user1', _records(4, 1))
+        source.save_summary('user1', {"summary": "old news", "upto_seq": 2})
+        # A legacy history that was never loaded, and a backup that is ignored
+        with open(source._get_filepath('user2'), 'w', encoding='utf-8') as f:
+            json.dump([{"role": "user", "content": "legacy"}], f)
+        with open(source._get_filepath('user3') + '.20250805_221522.bak', 'w', encoding='utf-8') as f:
+            json.dump([{"role": "user", "content": "backup"}], f)
+
+        self.assertEqual(migrate(source, self.storage), (2, 6))
+        # Running it again changes nothing
+        self.assertEqual(migrate(source, self.storage), (2, 6))
+        self.assertEqual([record["seq"] for record in self.storage.load_records('user1', 50)], [0, 1, 2, 3, 4])
+        self.assertEqual(self.storage.load_context('user2'), [{"role": "user", "content": "legacy"}])
+        self.assertEqual(self.storage.load_summary('user1'), {"summary": "old news", "upto_seq": 2})
+        # The source is left untouched
+        self.assertTrue(os.path.exists(source._get_filepath('user2')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import tempfile
+import shutil
+
+from config_helper import make_config
+from context.file_manager import FileManager
+from context.storage_manager import StorageManager
+
+
+class TestStorageManager(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _make_storage(self, **overrides):
+        config = make_config(self.test_dir, CONTEXT_STORAGE_DIR=self.test_dir, **overrides)
+        return StorageManager(config, FileManager(config))
+
+    def test_lru_entry_limit_and_counters(self):
+        storage = self._make_storage(CONTEXT_CACHE_MAX_ENTRIES="2")
+        storage.add_context('user1', {'role': 'user', 'content': 'a'})
+        storage.add_context('user2', {'role': 'user', 'content': 'b'})
+        # user1 becomes the most recently used, so user2 is evicted by user3
+        storage.get_context('user1')
+        storage.add_context('user3', {'role': 'user', 'content': 'c'})
+        stats = storage.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 3))
+        self.assertNotIn('user2', storage._cache)
+        # The evicted history is reloaded, including messages that were still queued for writing
+        self.assertEqual(list(storage.get_context('user2')), [{'role': 'user', 'content': 'b'}])
+
+    def test_byte_limit(self):
+        storage = self._make_storage(CONTEXT_CACHE_MAX_BYTES="5000")
+        for i in range(10):
+            storage.add_context(f'user{i}', {'role': 'user', 'content': 'x' * 1000})
+        stats = storage.stats()
+        self.assertLessEqual(stats["bytes"], 5000)
+        self.assertEqual(stats["entries"] + stats["evictions"], 10)
+
+    def test_only_working_window_is_cached(self):
+        storage = self._make_storage(CONTEXT_CACHE_WINDOW="5")
+        for i in range(12):
+            storage.add_context('user1', {'role': 'user', 'content': str(i)})
+        self.assertEqual([msg['content'] for msg in storage.get_context('user1')], ['7', '8', '9', '10', '11'])
+        storage.flush()
+        self.assertEqual(len(storage.backend.load_records('user1', 100)), 12)
+
+    def test_reads_are_shared_and_read_only(self):
+        storage = self._make_storage()
+        storage.add_context('user1', {'role': 'user', 'content': 'a'})
+        context = storage.get_context('user1')
+        self.assertIs(storage.get_context('user1'), context)
+        with self.assertRaises(TypeError):
+            context[0]['content'] = 'changed'
+        # Appending does not change a context that was already handed out
+        storage.add_context('user1', {'role': 'assistant', 'content': 'b'})
+        self.assertEqual(len(context), 1)
+        self.assertEqual(len(storage.get_context('user1')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import tempfile
+import shutil
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config_helper import make_config
+from context.context_manager import ContextManager
+from context.file_manager import FileManager
+from context.summarizer import ContextSummarizer
+from LLM.client_pool import ClientPool
+
+
+class _StubCompletionHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible /chat/completions endpoint answering with a fixed summary"""
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        _StubCompletionHandler.requests.append(body)
+        payload = json.dumps({
+            "id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": f"summary {len(_StubCompletionHandler.requests)}"}}],
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestContextSummarizer(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        _StubCompletionHandler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubCompletionHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.config = make_config(self.test_dir, CONTEXT_STORAGE_DIR=self.test_dir,
+                                  OPENAI_ENDPOINT=f"http://127.0.0.1:{self.server.server_port}/v1",
+                                  CONTEXT_SUMMARY="true", SUMMARY_BATCH_SIZE="4")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir)
+
+    def test_trimmed_messages_are_folded_once(self):
+        manager = ContextManager(self.config)
+        for i in range(14):
+            manager.append('user1', {'role': 'user', 'content': f'Q{i}'})
+        # 4 messages fall out of the 10-message window: exactly one batch
+        self.assertEqual(len(manager.get('user1')), 10)
+        manager.summarizer.join()
+        self.assertEqual(manager.get_summary('user1'), 'summary 1')
+        self.assertIn('user: Q3', _StubCompletionHandler.requests[0]["messages"][1]["content"])
+
+        # Already summarized messages are not sent again
+        manager.get('user1')
+        manager.summarizer.join()
+        self.assertEqual(len(_StubCompletionHandler.requests), 1)
+
+        for i in range(14, 18):
+            manager.append('user1', {'role': 'user', 'content': f'Q{i}'})
+        manager.get('user1')
+        manager.summarizer.join()
+        second_request = _StubCompletionHandler.requests[1]["messages"][1]["content"]
+        self.assertIn('summary 1', second_request)
+        self.assertIn('user: Q4', second_request)
+        self.assertNotIn('user: Q3', second_request)
+
+        # The summary is stored with the history
+        reloaded = ContextManager(self.config)
+        self.assertEqual(reloaded.get_summary('user1'), 'summary 2')
+
+    def test_summary_advances_only_over_consecutive_messages(self):
+        summarizer = ContextSummarizer(self.config, FileManager(self.config))
+        messages = [{"role": "user", "content": f"Q{seq}"} for seq in range(9)]
+        summarizer.submit('user1', messages[4:6], 4)
+        # Q6 has not been reported yet
+        summarizer.submit('user1', messages[7:9], 7)
+        summarizer.join()
+        request = _StubCompletionHandler.requests[0]["messages"][1]["content"]
+        self.assertIn('user: Q5', request)
+        self.assertNotIn('user: Q7', request)
+        self.assertEqual(summarizer.backend.load_summary('user1'), {"summary": "summary 1", "upto_seq": 6})
+
+        # Once the gap is filled, the rest is folded
+        summarizer.submit('user1', messages[6:7] + messages[7:9] + [{"role": "user", "content": "Q9"}], 6)
+        summarizer.join()
+        self.assertIn('user: Q7', _StubCompletionHandler.requests[1]["messages"][1]["content"])
+        self.assertEqual(summarizer.backend.load_summary('user1')["upto_seq"], 10)
+
+    def test_requests_share_the_client_pool_and_inflight_limit(self):
+        pool = ClientPool(self.config)
+        inflight_limit = threading.BoundedSemaphore(1)
+        manager = ContextManager(self.config, pool, inflight_limit)
+        self.assertIs(manager.summarizer.client_pool, pool)
+        # Every slot is taken by replies: the summary waits
+        inflight_limit.acquire()
+        for i in range(14):
+            manager.append('user1', {'role': 'user', 'content': f'Q{i}'})
+        manager.get('user1')
+        threading.Event().wait(0.2)
+        self.assertEqual(_StubCompletionHandler.requests, [])
+        inflight_limit.release()
+        manager.summarizer.join()
+        self.assertEqual(manager.get_summary('user1'), 'summary 1')
+        self.assertIsNotNone(pool.endpoints[0].ewma)
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import json
+import os
+import unittest
+import tempfile
+import shutil
+import time
+import urllib.request
+
+from config_helper import make_config
+from tracing import Histogram, MetricsServer, Tracer
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.tracer = Tracer()
+
+    def tearDown(self):
+        self.tracer.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_turn_collects_spans_and_usage(self):
+        trace_path = os.path.join(self.test_dir, "traces", "trace.jsonl")
+        self.tracer.configure(make_config(self.test_dir, TRACE_FILE=trace_path))
+        self.tracer.flushed('user1', 0.2)
+        with self.tracer.turn('user1') as turn:
+            self.assertIs(self.tracer.current(), turn)
+            with self.tracer.span("llm"):
+                time.sleep(0.01)
+            self.tracer.add_usage(100, 20)
+            self.tracer.add_usage(150, 30)
+        self.assertIsNone(self.tracer.current())
+
+        with open(trace_path, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record["turn_id"], turn.turn_id)
+        self.assertEqual(record["usage"], {"prompt_tokens": 250, "completion_tokens": 50})
+        stages = {span["stage"]: span for span in record["spans"]}
+        self.assertEqual(set(stages), {"debounce", "queue", "llm"})
+        self.assertAlmostEqual(stages["debounce"]["duration"], 0.2)
+        self.assertGreaterEqual(stages["llm"]["duration"], 0.01)
+
+    def test_turn_ids_are_unique(self):
+        ids = set()
+        for _ in range(100):
+            with self.tracer.turn('user1') as turn:
+                ids.add(turn.turn_id)
+        self.assertEqual(len(ids), 100)
+
+    def test_failed_turn(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.turn('user1'):
+                raise ValueError()
+        self.assertIn('wechat_bot_turns_total{status="error"} 1', self.tracer.render())
+
+    def test_render_prometheus_text(self):
+        for duration in (0.003, 0.003, 0.2):
+            self.tracer.record("llm", duration)
+        self.tracer.record("tool", 0.5, tool="add")
+        self.tracer.count("messages_received", 3)
+        text = self.tracer.render()
+        self.assertIn('wechat_bot_stage_seconds_bucket{stage="llm",le="0.0025"} 0', text)
+        self.assertIn('wechat_bot_stage_seconds_bucket{stage="llm",le="0.005"} 2', text)
+        self.assertIn('wechat_bot_stage_seconds_bucket{stage="llm",le="+Inf"} 3', text)
+        self.assertIn('wechat_bot_stage_seconds_count{stage="llm"} 3', text)
+        self.assertIn('wechat_bot_stage_seconds_count{stage="tool",tool="add"} 1', text)
+        self.assertIn('wechat_bot_stage_window_seconds{stage="llm",quantile="0.5"} 0.005', text)
+        self.assertIn('wechat_bot_messages_received_total 3', text)
+
+    def test_gauges_and_discarded_flushes(self):
+        self.tracer.gauge("dispatch_queue_depth", 7)
+        self.tracer.gauge("dispatch_queue_depth", 4)
+        self.assertIn('wechat_bot_dispatch_queue_depth 4', self.tracer.render())
+        # A flush merged into an earlier turn does not give the next turn a debounce span
+        self.tracer.flushed('user1', 0.2)
+        self.tracer.discard_flush('user1')
+        with self.tracer.turn('user1') as turn:
+            pass
+        self.assertEqual(turn.spans, [])
+
+    def test_rolling_window_forgets_old_values(self):
+        histogram = Histogram(window=60)
+        histogram.observe(0.003, now=0)
+        histogram.observe(2, now=100)
+        self.assertEqual(histogram.window_quantiles(now=100)[0.5], 2.5)
+        self.assertIsNone(histogram.window_quantiles(now=200))
+        # The cumulative counts keep everything
+        self.assertEqual(histogram.count, 2)
+
+    def test_metrics_endpoint(self):
+        self.tracer.record("llm", 0.1)
+        server = MetricsServer(make_config(self.test_dir, METRICS_PORT="0"), self.tracer)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics", timeout=5) as response:
+                body = response.read().decode()
+                self.assertIn("text/plain", response.headers["Content-Type"])
+            self.assertIn('wechat_bot_stage_seconds_count{stage="llm"} 1', body)
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import os
+
+from config_helper import make_config
+from context.file_manager import FileManager
+from context.storage_manager import StorageManager
+from context.wal import WriteAheadLog
+
+
+def _record(seq):
+    return {"seq": seq, "ts": 0, "message": {"role": "user", "content": f"m{seq}"}}
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _make_config(self, **overrides):
+        return make_config(self.test_dir, CONTEXT_STORAGE_DIR=self.test_dir, **overrides)
+
+    def test_group_commit_shares_fsyncs(self):
+        config = self._make_config()
+        wal = WriteAheadLog(config, FileManager(config))
+        wal.start()
+
+        def append(user_id):
+            for seq in range(50):
+                wal.wait(wal.append(user_id, _record(seq)))
+
+        threads = [threading.Thread(target=append, args=(f"user{index}",)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = wal.stats()
+        self.assertEqual(stats["records"], 400)
+        # Concurrent appenders waiting on the same commit are batched together
+        self.assertLess(stats["commits"], 400)
+        wal.stop()
+
+    def test_replay_after_crash(self):
+        config = self._make_config()
+        file_manager = FileManager(config)
+        # The user log only got the first record before the crash
+        file_manager.append_records("user1", [_record(0)])
+        wal = WriteAheadLog(config, file_manager)
+        wal.start()
+        for seq in range(3):
+            wal.wait(wal.append("user1", _record(seq)))
+        wal.wait(wal.append("user2", _record(0)))
+        # A torn line from the crash is ignored
+        wal._file.write(b'{"lsn": 5, "user_id": "user2", "rec')
+        wal._file.flush()
+        wal.stop()
+
+        recovered = WriteAheadLog(config, file_manager)
+        self.assertEqual(recovered.replay(), 3)
+        self.assertEqual([record["seq"] for record in file_manager.load_records("user1", 50)], [0, 1, 2])
+        self.assertEqual(file_manager.load_context("user2"), [{"role": "user", "content": "m0"}])
+        self.assertEqual(os.listdir(recovered.directory), [])
+
+    def test_checkpoint_removes_applied_segments(self):
+        config = self._make_config(CONTEXT_WAL_SEGMENT_BYTES="200")
+        wal = WriteAheadLog(config, FileManager(config))
+        wal.start()
+        for seq in range(6):
+            wal.wait(wal.append("user1", _record(seq)))
+        segments = sorted(os.listdir(wal.directory))
+        self.assertGreater(len(segments), 2)
+        wal.checkpoint(2)
+        # Only segments whose records are all applied are removed
+        remaining = sorted(os.listdir(wal.directory))
+        self.assertLess(len(remaining), len(segments))
+        self.assertEqual(remaining, segments[-len(remaining):])
+        wal.stop(applied_lsn=wal.last_lsn)
+        self.assertEqual(os.listdir(wal.directory), [])
+
+    def test_storage_manager_recovers_unwritten_messages(self):
+        config = self._make_config(CONTEXT_FLUSH_INTERVAL="0.05")
+        storage = StorageManager(config, FileManager(config))
+        # The process dies before the write-behind writer gets to the user logs
+        storage.writer._stop_event.set()
+        storage.writer._thread.join()
+        storage.add_contexts("user1", [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}])
+        storage.wal.stop()
+
+        restarted = StorageManager(config, FileManager(config))
+        self.assertEqual(list(restarted.get_context("user1")),
+                         [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}])
+        restarted.close()
+        self.assertEqual(os.listdir(restarted.wal.directory), [])
+
+    def test_failed_append_is_retried_before_newer_records(self):
+        config = self._make_config(CONTEXT_FLUSH_INTERVAL="0.05")
+        file_manager = FileManager(config)
+        append_batch = file_manager.append_batch
+        failed = []
+
+        def flaky_append_batch(batch, fsync=False):
+            if not failed and any(record["message"]["content"] == "m1" for records in batch.values() for record in records):
+                failed.append(True)
+                raise OSError("disk full")
+            return append_batch(batch, fsync)
+
+        file_manager.append_batch = flaky_append_batch
+        storage = StorageManager(config, file_manager)
+        for seq in range(3):
+            storage.add_context("user1", {"role": "user", "content": f"m{seq}"})
+            storage.flush()
+        self.assertTrue(failed)
+        storage.close()
+        self.assertEqual(os.listdir(storage.wal.directory), [])
+
+        restarted = StorageManager(config, FileManager(config))
+        self.assertEqual([message["content"] for message in restarted.get_context("user1")], ["m0", "m1", "m2"])
+        restarted.close()
+
+    def test_replay_fills_a_gap_below_the_tail(self):
+        config = self._make_config()
+        file_manager = FileManager(config)
+        # m1 failed to append while m2, written later, succeeded
+        file_manager.append_records("user1", [_record(0), _record(2)])
+        wal = WriteAheadLog(config, file_manager)
+        wal.start()
+        for seq in range(3):
+            wal.wait(wal.append("user1", _record(seq)))
+        wal.stop()
+
+        recovered = WriteAheadLog(config, file_manager)
+        self.assertEqual(recovered.replay(), 1)
+        self.assertEqual([record["seq"] for record in file_manager.load_records("user1", 50)], [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
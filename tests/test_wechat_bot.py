@@ -0,0 +1,113 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from bench import fake_wechat
+# wxauto must be replaced before wechat_client is imported
+fake_wechat.install()
+
+from config_helper import make_config
+from wechat_client import WechatClient
+from wechat_bot import WechatBot
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class WechatBotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.listen_file = os.path.join(self.test_dir, "listen_friendname.txt")
+        self.write_listen_file("alice\nbob\n")
+        self.sent = []
+        WechatClient.wechat = fake_wechat.FakeWeChat(self.on_send)
+        self.bot = None
+
+    def tearDown(self):
+        if self.bot != None:
+            self.bot.stop_event_loop()
+        shutil.rmtree(self.test_dir)
+
+    def on_send(self, who, kind, payload):
+        self.sent.append((who, payload))
+
+    def write_listen_file(self, text):
+        with open(self.listen_file, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def start_bot(self, **overrides):
+        settings = {"SYSTEM_PROMPT_PATH": os.path.join(REPO_DIR, "system_prompt.json"),
+                    "TOOLS_DESCRIPTION_PATH": os.path.join(REPO_DIR, "tools_descriptions.json"),
+                    "TOOLS_IMPLEMENTATION_PATH": os.path.join(REPO_DIR, "tools_implementations.py"),
+                    "CONTEXT_STORAGE_DIR": os.path.join(self.test_dir, "chat_history"),
+                    "FILE_DOWNLOAD_DIR": os.path.join(self.test_dir, "downloads"),
+                    "INFO_FILES_DIRECTORY": os.path.join(self.test_dir, "files"),
+                    "LISTEN_FRIENDNAME_FILE": self.listen_file}
+        settings.update(overrides)
+        os.makedirs(settings["INFO_FILES_DIRECTORY"], exist_ok=True)
+        self.bot = WechatBot(config=make_config(self.test_dir, **settings))
+        self.bot.start_event_loop()
+        return self.bot
+
+
+class TestListenList(WechatBotTestCase):
+    def test_reload_applies_only_the_changes(self):
+        failing = {"dave", "erin"}
+        calls = []
+        wechat = WechatClient.wechat
+        add_listen_chat, remove_listen_chat = wechat.AddListenChat, wechat.RemoveListenChat
+
+        def add(name, callback):
+            calls.append(("add", name))
+            return None if name in failing else add_listen_chat(name, callback)
+
+        def remove(name):
+            calls.append(("remove", name))
+            remove_listen_chat(name)
+
+        wechat.AddListenChat, wechat.RemoveListenChat = add, remove
+        self.write_listen_file("alice\nbob\ndave\nerin\n")
+        bot = self.start_bot()
+        self.assertEqual(sorted(WechatClient.chatWindowList), ["alice", "bob"])
+
+        calls.clear()
+        failing.discard("dave")
+        self.write_listen_file("bob | priority=3\ncarol\ndave\n")
+        bot.reload_listen_list()
+        # bob keeps his window; dave failed before and is retried; erin was never listened, so not stopped
+        self.assertEqual(calls, [("remove", "alice"), ("add", "carol"), ("add", "dave")])
+        self.assertEqual(sorted(WechatClient.chatWindowList), ["bob", "carol", "dave"])
+        self.assertEqual(bot.dispatcher._priorities, {"bob": 3.0})
+
+        calls.clear()
+        self.write_listen_file("bob\n\nbob\n")
+        bot.reload_listen_list()
+        self.assertEqual(calls, [("remove", "carol"), ("remove", "dave")])
+        self.assertEqual(bot.friendname_list, ["bob"])
+        self.assertEqual(bot.dispatcher._priorities, {})
+
+
+class TestDurability(WechatBotTestCase):
+    def test_streamed_segments_go_out_after_the_message_is_durable(self):
+        bot = self.start_bot(STREAM_RESPONSE="true")
+        history_at_segment = []
+        bot.context_manager.extend("alice", [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hey"}])
+
+        def send_request(user_id, message, history=(), on_segment=None, *args, **kwargs):
+            # The new message is sent once, after the history
+            self.assertEqual([item["content"] for item in history], ["hi", "hey"])
+            history_at_segment.append([message["content"] for message in bot.context_manager.get(user_id)])
+            on_segment("first part")
+            return {"role": "assistant", "content": "first part"}
+
+        bot.responsor.send_request = send_request
+        bot._debounce_handler("alice", {"role": "user", "content": "hello"})
+        # When the segment was queued for sending, the friend's message was already stored, the reply not yet
+        self.assertEqual(history_at_segment, [["hi", "hey", "hello"]])
+        self.assertEqual(self.sent, [("alice", "first part")])
+        self.assertEqual([message["content"] for message in bot.context_manager.get("alice")],
+                         ["hi", "hey", "hello", "first part"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,12 @@ from config import Config
 import os
 from wechat_client import WechatClient
 
+# The bot's live configuration, set by ToolManager before it loads this module
+config: Config
+
 
 def list_files_in_directory(user_id: str) -> str:
     """List the files in the directory"""
-    config = Config()
     files_dir = config.info_files_directory
     files = os.listdir(files_dir)
     # Filter out files (excluding directories)
@@ -20,7 +22,6 @@ def list_files_in_directory(user_id: str) -> str:
 
 def send_a_file(file_name: str, user_id:str) -> str:
     """Send files to users"""
-    config = Config()
     files_dir = config.info_files_directory
     file_path = os.path.join(files_dir, file_name)
     if not os.path.exists(file_path):
@@ -1,8 +1,14 @@
 import json
+import asyncio
+import inspect
 import importlib.util
 import os
-from typing import Any, Dict, List, Union, Callable, Optional
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Any, Dict, List, Tuple, Union, Callable, Optional
 from config import Config
+from tracing import tracer
 
 class ToolManager:
     """
@@ -21,13 +27,20 @@ class ToolManager:
         self.config = config
         
         # Loading Tool Description
-        self.tools_description = self._load_tools_description(r".\tools\default_descriptions.json")
+        self.tools_description = self._load_tools_description(os.path.join(os.path.dirname(os.path.abspath(__file__)), "default_descriptions.json"))
         self.tools_description.extend(self._load_tools_description(self.config.tools_description_path))
         
         # Loading tool implementation
-        self.tool_implementations = self._load_tool_implementations(r".\tools\default_implementations.py")
+        self.tool_implementations = self._load_tool_implementations(os.path.join(os.path.dirname(os.path.abspath(__file__)), "default_implementations.py"))
         self.tool_implementations.update(self._load_tool_implementations(self.config.tools_implementation_path))
-    
+
+        # Synchronous tools run on a shared thread pool, native coroutines on one persistent event loop
+        self._executor = ThreadPoolExecutor(max_workers=self.config.tool_workers,
+                                            thread_name_prefix="tool-worker")
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="tool-event-loop", daemon=True)
+        self._loop_thread.start()
+
     def _load_tools_description(self, path: str) -> List[Dict]:
         """
         Load tool description JSON file
@@ -75,6 +88,8 @@ class ToolManager:
         # Dynamic Module Loading
         spec = importlib.util.spec_from_file_location(module_name, module_path)
         module = importlib.util.module_from_spec(spec)
+        # Tools read the bot's live configuration through the module global "config"
+        module.config = self.config
         spec.loader.exec_module(module)
         
         # Extract all callable tool implementation functions
@@ -99,6 +114,30 @@ class ToolManager:
         """
         return self.tools_description
     
+    def get_timeout(self, tool_name: str) -> float:
+        """Timeout in seconds for a tool: TOOL_TIMEOUTS ("name=seconds,...") overrides TOOL_TIMEOUT"""
+        settings = self.config.snapshot()
+        return settings.tool_timeouts.get(tool_name, settings.tool_timeout)
+
+    def _submit_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Future:
+        """Start a tool without waiting for it"""
+        tool_func = self.tool_implementations[tool_name]
+        if inspect.iscoroutinefunction(tool_func):
+            return asyncio.run_coroutine_threadsafe(tool_func(**arguments), self._loop)
+
+        def run():
+            result = tool_func(**arguments)
+            # Handling possible asynchronous results of synchronous functions
+            if hasattr(result, '__await__'):
+                result = asyncio.run_coroutine_threadsafe(self._await(result), self._loop).result()
+            return result
+
+        return self._executor.submit(run)
+
+    @staticmethod
+    async def _await(awaitable):
+        return await awaitable
+
     def execute_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
         """
         Execute the specified tool
@@ -110,24 +149,59 @@ class ToolManager:
         Returns:
             Tool execution result
         """
-        # Check if the tool exists
-        if tool_name not in self.tool_implementations:
-            return {
-                "name": tool_name,
-                "content": f"Tool '{tool_name}' not found",
-                "status": "error"
-            }
-        
-        try:
-            # Execution Tool
-            tool_func = self.tool_implementations[tool_name]
-            result = tool_func(**arguments)
-            
-            # Handling possible asynchronous functions
-            if hasattr(result, '__await__'):
-                import asyncio
-                result = asyncio.get_event_loop().run_until_complete(result)
-            
-            return result
-        except Exception as e:
-            return  f"Error executing tool: {str(e)}"
+        return self.execute_tools([(tool_name, arguments)])[0]
+
+    def execute_tools(self, calls: List[Tuple[str, Dict[str, Any]]]) -> List[Any]:
+        """
+        Execute several tools concurrently, each bounded by its own timeout
+
+        Args:
+            calls: (tool name, arguments) pairs
+
+        Returns:
+            Tool execution results in the same order as calls
+        """
+        futures: List[Future | None] = []
+        results: List[Any] = [None] * len(calls)
+        for index, (tool_name, arguments) in enumerate(calls):
+            # Check if the tool exists
+            if tool_name not in self.tool_implementations:
+                futures.append(None)
+                results[index] = {
+                    "name": tool_name,
+                    "content": f"Tool '{tool_name}' not found",
+                    "status": "error"
+                }
+                continue
+            try:
+                futures.append(self._submit_tool(tool_name, arguments))
+            except Exception as e:
+                futures.append(None)
+                results[index] = f"Error executing tool: {str(e)}"
+
+        # All tools were started at the same time, so each deadline counts from now
+        start_time = time.monotonic()
+        # Tools finish on other threads; their spans belong to the turn of the calling thread
+        turn = tracer.current()
+        for index, future in enumerate(futures):
+            if future != None:
+                future.add_done_callback(
+                    lambda _, tool_name=calls[index][0]: tracer.record("tool", time.monotonic() - start_time,
+                                                                       turn, tool=tool_name))
+        for index, future in enumerate(futures):
+            if future == None:
+                continue
+            tool_name = calls[index][0]
+            timeout = self.get_timeout(tool_name)
+            try:
+                results[index] = future.result(timeout=max(0, start_time + timeout - time.monotonic()))
+                tracer.count("tool_calls", tool=tool_name, status="ok")
+            except TimeoutError:
+                # A running thread cannot be interrupted; its late result is discarded
+                future.cancel()
+                results[index] = f"Error executing tool: '{tool_name}' timed out after {timeout:g} seconds"
+                tracer.count("tool_calls", tool=tool_name, status="timeout")
+            except Exception as e:
+                results[index] = f"Error executing tool: {str(e)}"
+                tracer.count("tool_calls", tool=tool_name, status="error")
+        return results
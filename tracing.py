@@ -0,0 +1,342 @@
+import bisect
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, Iterator, List, Tuple
+
+from config import Config
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Quantiles of the rolling window exposed next to the cumulative histograms
+WINDOW_QUANTILES = (0.5, 0.95, 0.99)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+
+    Besides the cumulative counts exposed to Prometheus, the counts of the last
+    window seconds are kept in SLOTS rotating sub-windows, so recent quantiles can
+    be read without storing individual samples.
+    """
+
+    SLOTS = 6
+
+    def __init__(self, window: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.slot_duration = window / self.SLOTS
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # Rolling window: (slot number, bucket counts) of the most recent slots
+        self._slots: Deque[Tuple[int, List[int]]] = deque()
+
+    def observe(self, value: float, now: float) -> None:
+        """Must hold the registry lock"""
+        index = bisect.bisect_left(self.buckets, value)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        slot = int(now / self.slot_duration)
+        if not self._slots or self._slots[-1][0] != slot:
+            self._slots.append((slot, [0] * (len(self.buckets) + 1)))
+        self._slots[-1][1][index] += 1
+        while self._slots[0][0] <= slot - self.SLOTS:
+            self._slots.popleft()
+
+    def window_quantiles(self, now: float) -> Dict[float, float] | None:
+        """Approximate quantiles (bucket upper bounds) of the values observed in the rolling window"""
+        slot = int(now / self.slot_duration)
+        totals = [0] * (len(self.buckets) + 1)
+        for number, counts in self._slots:
+            if number > slot - self.SLOTS:
+                for index, count in enumerate(counts):
+                    totals[index] += count
+        observed = sum(totals)
+        if observed == 0:
+            return None
+        quantiles = {}
+        for quantile in WINDOW_QUANTILES:
+            rank = quantile * observed
+            cumulative = 0
+            for index, count in enumerate(totals):
+                cumulative += count
+                if cumulative >= rank:
+                    quantiles[quantile] = self.buckets[index] if index < len(self.buckets) else float("inf")
+                    break
+        return quantiles
+
+
+class Turn:
+    """One debounced turn of a user: its id, timing spans and token usage"""
+
+    def __init__(self, turn_id: str, user_id: str) -> None:
+        self.turn_id = turn_id
+        self.user_id = user_id
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.status = "ok"
+        self.usage: Dict[str, int] = {}
+        # (stage, offset from the turn start, duration, labels)
+        self.spans: List[Tuple[str, float, float, Dict[str, str]]] = []
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, start: float, duration: float, labels: Dict[str, str]) -> None:
+        with self._lock:
+            self.spans.append((stage, start - self.start, duration, labels))
+
+    def add_usage(self, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.usage["prompt_tokens"] = self.usage.get("prompt_tokens", 0) + prompt_tokens
+            self.usage["completion_tokens"] = self.usage.get("completion_tokens", 0) + completion_tokens
+
+    def to_record(self, duration: float) -> Dict:
+        with self._lock:
+            return {"turn_id": self.turn_id, "user_id": self.user_id, "ts": self.start_time,
+                    "duration": round(duration, 6), "status": self.status, "usage": dict(self.usage),
+                    "spans": [dict({"stage": stage, "offset": round(offset, 6), "duration": round(span, 6)}, **labels)
+                              for stage, offset, span, labels in self.spans]}
+
+
+class Tracer:
+    """
+    Lightweight tracing of the reply path.
+
+    Every debounced turn gets an id and collects timing spans of its stages
+    (debounce, dispatch queue, context, LLM, tools, sending) and the token usage
+    reported by the API. Spans feed latency histograms per stage and counters
+    track requests, tokens and failures; tracer.render() returns them in the
+    Prometheus text format, served on METRICS_PORT by MetricsServer. Finished
+    turns are appended to TRACE_FILE as JSON lines if it is set.
+
+    Code on the reply path uses the module-level tracer; the turn being processed
+    by the current thread is found through a context variable, so it does not
+    have to be passed around.
+    """
+
+    def __init__(self, window: float = 60) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        self._current: contextvars.ContextVar = contextvars.ContextVar("turn", default=None)
+        self._ids = itertools.count(1)
+        self._id_prefix = f"{os.getpid():x}-{int(time.time()):x}"
+        # (flush time, debounce wait) of flushed turns not started yet, per user
+        self._flushes: Dict[str, Deque[Tuple[float, float]]] = {}
+        self._trace_file = None
+        self._trace_lock = threading.Lock()
+
+    def configure(self, config: Config) -> None:
+        """Apply METRICS_WINDOW and TRACE_FILE"""
+        self.window = config.metrics_window
+        trace_path = config.trace_file
+        with self._trace_lock:
+            if self._trace_file != None:
+                self._trace_file.close()
+                self._trace_file = None
+            if trace_path:
+                os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+                # Line buffered, so every finished turn reaches the file right away
+                self._trace_file = open(trace_path, 'a', encoding='utf-8', buffering=1)
+
+    def close(self) -> None:
+        with self._trace_lock:
+            if self._trace_file != None:
+                self._trace_file.close()
+                self._trace_file = None
+
+    @staticmethod
+    def _labels(labels: Dict[str, str]) -> Labels:
+        return tuple(sorted(labels.items()))
+
+    def record(self, stage: str, duration: float, turn: Turn | None = None, **labels: str) -> None:
+        """Record a stage duration in seconds, attached to turn or else to the current thread's turn"""
+        key = (stage, self._labels(labels))
+        now = time.monotonic()
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram == None:
+                histogram = self._histograms[key] = Histogram(self.window)
+            histogram.observe(duration, now)
+        turn = turn if turn != None else self._current.get()
+        if turn != None:
+            turn.add_span(stage, time.perf_counter() - duration, duration, labels)
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels: str) -> None:
+        """Set a value that goes up and down, e.g. a queue depth"""
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    @contextmanager
+    def span(self, stage: str, **labels: str) -> Iterator[None]:
+        """Time the enclosed block as a stage of the current turn"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, **labels)
+
+    def current(self) -> Turn | None:
+        """The turn processed by the current thread, if any"""
+        return self._current.get()
+
+    def add_usage(self, prompt_tokens: int, completion_tokens: int, turn: Turn | None = None) -> None:
+        """Token usage of an API response"""
+        self.count("tokens", prompt_tokens, kind="prompt")
+        self.count("tokens", completion_tokens, kind="completion")
+        turn = turn if turn != None else self._current.get()
+        if turn != None:
+            turn.add_usage(prompt_tokens, completion_tokens)
+
+    def flushed(self, user_id: str, debounce_wait: float) -> None:
+        """Called by DebouncePool when a user's messages are flushed, debounce_wait after the last one"""
+        self.record("debounce", debounce_wait)
+        with self._lock:
+            self._flushes.setdefault(user_id, deque()).append((time.monotonic(), debounce_wait))
+
+    def discard_flush(self, user_id: str) -> None:
+        """Forget the user's latest flush, whose messages will not get a turn of their own (merged or rejected)"""
+        with self._lock:
+            flushes = self._flushes.get(user_id)
+            if flushes:
+                flushes.pop()
+                if not flushes:
+                    del self._flushes[user_id]
+
+    @contextmanager
+    def turn(self, user_id: str) -> Iterator[Turn]:
+        """Process a debounced turn of user_id in the enclosed block"""
+        turn = Turn(f"{self._id_prefix}-{next(self._ids)}", user_id)
+        with self._lock:
+            flushes = self._flushes.get(user_id)
+            flush = flushes.popleft() if flushes else None
+            if flushes != None and not flushes:
+                del self._flushes[user_id]
+        token = self._current.set(turn)
+        try:
+            if flush != None:
+                flush_time, debounce_wait = flush
+                turn.add_span("debounce", turn.start - (time.monotonic() - flush_time) - debounce_wait,
+                              debounce_wait, {})
+                self.record("queue", time.monotonic() - flush_time)
+            yield turn
+        except BaseException:
+            turn.status = "error"
+            raise
+        finally:
+            self._current.reset(token)
+            duration = time.perf_counter() - turn.start
+            self.record("turn", duration)
+            self.count("turns", status=turn.status)
+            self._write_trace(turn.to_record(duration))
+
+    def _write_trace(self, record: Dict) -> None:
+        if self._trace_file == None:
+            return
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._trace_lock:
+            if self._trace_file != None:
+                self._trace_file.write(line)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        now = time.monotonic()
+        lines = ["# HELP wechat_bot_stage_seconds Duration of the stages of a turn",
+                 "# TYPE wechat_bot_stage_seconds histogram"]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            window_lines = []
+            for (stage, labels), histogram in histograms:
+                label_text = ",".join([f'stage="{stage}"'] + [f'{key}="{value}"' for key, value in labels])
+                cumulative = 0
+                for bound, count in zip(self._bucket_bounds(histogram), histogram.counts):
+                    cumulative += count
+                    lines.append(f'wechat_bot_stage_seconds_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f"wechat_bot_stage_seconds_sum{{{label_text}}} {histogram.sum:.6f}")
+                lines.append(f"wechat_bot_stage_seconds_count{{{label_text}}} {histogram.count}")
+                quantiles = histogram.window_quantiles(now)
+                for quantile, value in (quantiles or {}).items():
+                    window_lines.append(f'wechat_bot_stage_window_seconds{{{label_text},quantile="{quantile}"}} {value}')
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+        lines.append(f"# HELP wechat_bot_stage_window_seconds Approximate quantiles of the last {self.window:g} seconds")
+        lines.append("# TYPE wechat_bot_stage_window_seconds gauge")
+        lines.extend(window_lines)
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append(f"# TYPE wechat_bot_{name}_total counter")
+                last_name = name
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"wechat_bot_{name}_total{{{label_text}}} {value:g}" if labels
+                         else f"wechat_bot_{name}_total {value:g}")
+        last_name = None
+        for (name, labels), value in gauges:
+            if name != last_name:
+                lines.append(f"# TYPE wechat_bot_{name} gauge")
+                last_name = name
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"wechat_bot_{name}{{{label_text}}} {value:g}" if labels else f"wechat_bot_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _bucket_bounds(histogram: Histogram) -> List[str]:
+        return [f"{bound:g}" for bound in histogram.buckets] + ["+Inf"]
+
+
+tracer = Tracer()
+
+
+class MetricsServer:
+    """Serves tracer.render() at http://METRICS_HOST:METRICS_PORT/metrics"""
+
+    def __init__(self, config: Config, source: Tracer = tracer) -> None:
+        self.source = source
+        host = config.metrics_host
+        port = config.metrics_port
+        source_tracer = source
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = source_tracer.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.server.server_port
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
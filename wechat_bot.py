@@ -2,22 +2,45 @@ from multiprocessing import context
 from config import Config
 from wechat_client import WechatClient
 from LLM.responsor import Responsor
+from LLM.speculation import SpeculationManager
 from LLM.debounce_pool import DebouncePool
+from LLM.dispatcher import RequestDispatcher
 from context.context_manager import ContextManager
+from tracing import tracer, MetricsServer
+from outbound_queue import PRIORITY_HIGH
 
-from typing import Any, Dict, Callable
+from typing import Any, Dict, Callable, List
 import threading
 import time
 
 class WechatBot:
-    def __init__(self, frontend_handler: Callable[[str, Dict[str, Any]], None] = None):
-        self.config = Config()
+    def __init__(self, frontend_handler: Callable[[str, Dict[str, Any]], None] = None, config: Config = None):
+        # The .env next to config.py is used unless a configuration is passed in (e.g. by the benchmarks)
+        self.config = config if config != None else Config()
+        tracer.configure(self.config)
+        # Prometheus metrics of the reply path on METRICS_PORT, if set
+        self.metrics_server = MetricsServer(self.config) if self.config.metrics_port > 0 else None
         self.wechatclient = WechatClient(self.config, self._message_handler)
         self.responsor = Responsor(self.config)
-        self.context_manager = ContextManager(self.config)
-        self.debounce_pool = DebouncePool(self.config, self._debounce_handler)
+        # Summaries go through the same endpoints and LLM_MAX_INFLIGHT cap as the replies
+        self.context_manager = ContextManager(self.config, self.responsor.client_pool, self.responsor.inflight_limit)
+        # Debounced turns are handed to the dispatcher, which runs them on its worker pool
+        # Turns beyond DISPATCH_MAX_QUEUED are merged or answered with a busy reply
+        self.dispatcher = RequestDispatcher(self.config, self._debounce_handler, self._shed_handler,
+                                            self._dropped_handler)
+        # Optional speculative replies, started while the debounce window is still open
+        self.speculation = None
+        if self.config.speculative_idle_threshold > 0:
+            # A user with a turn in progress has no final history to speculate on yet
+            self.speculation = SpeculationManager(self.config, self._speculative_reply,
+                                                  can_speculate=lambda user_id: not self.dispatcher.has_pending(user_id))
+        self.debounce_pool = DebouncePool(self.config, self.dispatcher.submit, self.speculation)
         self.frontend_handler = frontend_handler
         self.friendname_list = self._load_listen_friendname_list(self.config.listen_friendname_file)
+        self.dispatcher.set_priorities(self._load_priorities(self.config.listen_friendname_file))
+        # Edits of the listen list and of the system prompts apply without a restart (checked by the config watcher)
+        self.config.watch_file(self.config.listen_friendname_file, self.reload_listen_list)
+        self.config.watch_file(self.config.system_prompt_path, self.responsor.reload_system_prompt)
         self.stop_flag = 0
         self.stop_flag_lock = threading.Lock()
         self.loop_thread: threading.Thread = None
@@ -25,20 +48,101 @@ class WechatBot:
     def _message_handler(self, message: Dict[str, Any]) -> None:
         """message: {
                 "user_id": user_id,
-                "message": {"role":"user","content":msg}
+                "message": {"role":"user","content":msg},
+                "media": Future of the text of a media message still being processed, or None
             }"""
+        with self.stop_flag_lock:
+            if self.stop_flag == 1:
+                # Shutting down: buffered turns are being drained and no new turn is started
+                print(f"Shutting down, message from {message['user_id']} ignored")
+                return
+        tracer.count("messages_received")
         # First submit the message to the debounce pool upon receiving it
-        self.debounce_pool.submit_message(message["user_id"], message["message"])        
+        self.debounce_pool.submit_message(message["user_id"], message["message"], message.get("media"))        
     
+    def _speculative_reply(self, user_id: str, message: Dict, cancel_event: threading.Event,
+                           segments: List[str], usage: Dict[str, int]) -> Dict | None:
+        """Generate a reply before the debounce window closes; nothing is sent or stored here"""
+        summary = self.context_manager.get_summary(user_id)
+        history = self.context_manager.get(user_id, self.responsor.count_reserved_tokens(user_id, message, summary))
+        # Tools may have side effects, so a turn that needs them is left to the normal path
+        return self.responsor.send_request(user_id, message, history, segments.append, summary,
+                                           cancel_event=cancel_event, usage=usage, stop_at_tools=True)
+
+    def _shed_handler(self, user_id: str, message: Dict) -> None:
+        """A turn rejected because too many are waiting: tell the friend instead of answering"""
+        WechatClient.queueTextMessage(user_id, self.config.dispatch_busy_reply, PRIORITY_HIGH)
+        if self.frontend_handler != None:
+            self.frontend_handler(user_id, message)
+            self.frontend_handler(user_id, {"role": "bot", "content": "busy, message not answered"})
+
+    def _dropped_handler(self, user_id: str) -> None:
+        """A turn shed or merged by the dispatcher: its speculative reply must not answer the next turn"""
+        if self.speculation != None:
+            self.speculation.discard(user_id)
+
     def _debounce_handler(self, user_id: str, message: Dict):
-        # Retrieve historical messages from the context manager, then send them along with new messages to the LLM
-        history = self.context_manager.get(user_id)
-        response = self.responsor.send_request(user_id, message, history)
+        # Every debounced turn is traced under its own turn id
+        with tracer.turn(user_id):
+            self._process_turn(user_id, message)
+
+    def _process_turn(self, user_id: str, message: Dict):
+        start_time = time.monotonic()
+        delivery = {"first_message_time": None, "first_queued_time": None}
+        sends = []
+
+        def on_segment(segment: str) -> None:
+            # In streaming mode every finished segment is queued for sending as soon as it is complete.
+            # Only queued, never waited for: the LLM_MAX_INFLIGHT slot of the request is held meanwhile,
+            # and the outbound rate limit must not keep other friends' requests waiting for it.
+            if delivery["first_queued_time"] == None:
+                delivery["first_queued_time"] = time.monotonic()
+            sends.append(WechatClient.queueTextMessage(user_id, segment))
+
+        streamed = self.responsor.stream_response
+
+        def store_message_first() -> None:
+            # Segments are sent while the reply is generated, so the friend's message is made durable
+            # (write-ahead log) before the first one goes out. The reply is stored once it is complete:
+            # segments sent just before a crash may be missing from the history, the message never is.
+            if streamed:
+                self.context_manager.append(user_id, message)
+
+        speculated = self.speculation.take(user_id) if self.speculation != None else None
+        if speculated != None:
+            store_message_first()
+            tracer.count("speculative_replies_used")
+            # The reply was generated while waiting for more messages; deliver the segments held back
+            response, segments = speculated
+            for segment in segments:
+                on_segment(segment)
+        else:
+            # Retrieve historical messages from the context manager, then send them along with new messages to the LLM
+            with tracer.span("context"):
+                summary = self.context_manager.get_summary(user_id)
+                history = self.context_manager.get(user_id, self.responsor.count_reserved_tokens(user_id, message, summary))
+            # The history was read before, so it does not contain the new message twice
+            store_message_first()
+            response = self.responsor.send_request(user_id, message, history, on_segment, summary)
         # After receiving the LLM response, first add the user's message to the context manager, then add the response to the context manager
-        self.context_manager.append(user_id, message)
-        self.context_manager.append(user_id, response)
-        # send response to user
-        status = WechatClient.sendTextMessage(user_id, response["content"])
+        # Both are durable (write-ahead log) before a non-streamed reply is sent
+        self.context_manager.extend(user_id, [response] if streamed else [message, response])
+        # send response to user, unless it has already been delivered segment by segment
+        with tracer.span("deliver"):
+            if streamed:
+                results = [future.result() for future in sends]
+                status = all(result.status for result in results)
+                if results:
+                    delivery["first_message_time"] = delivery["first_queued_time"] + results[0].latency
+            elif response["content"]:
+                status = WechatClient.sendTextMessage(user_id, response["content"])
+                delivery["first_message_time"] = time.monotonic()
+            else:
+                # Nothing to send, e.g. the tool rounds were used up without an answer
+                status = True
+        if delivery["first_message_time"] != None:
+            tracer.record("first_message", delivery["first_message_time"] - start_time)
+            print(f"Time to first message for {user_id}: {delivery['first_message_time'] - start_time:.2f}s")
         # send response to frontend if frontend_handler is not None
         if self.frontend_handler != None:
             """frontend_handler(userid, Dict_message)
@@ -56,10 +160,76 @@ class WechatBot:
                     break
             time.sleep(0.1)
 
-    def _load_listen_friendname_list(self, filename: str):
+    @staticmethod
+    def _parse_listen_line(line: str) -> tuple:
+        """
+        Split a line of the listen list into the chat name and its annotations
+
+        A name may be followed by "|" and key=value annotations, e.g. "Family group | priority=3".
+
+        Returns:
+            (name, {annotation: value})
+        """
+        name, _, annotation_text = line.partition("|")
+        annotations = {}
+        for item in annotation_text.replace(",", " ").split():
+            key, _, value = item.partition("=")
+            annotations[key.strip().lower()] = value.strip()
+        return name.strip(), annotations
+
+    def _read_listen_file(self, filename: str) -> List[tuple]:
         with open(filename, 'r', encoding='utf-8') as file:
-            lines = [line.strip() for line in file]
-        return lines
+            entries = [self._parse_listen_line(line) for line in file]
+        return [(name, annotations) for name, annotations in entries if name]
+
+    def _load_listen_friendname_list(self, filename: str):
+        # Blank lines are skipped and a name listed twice is listened once
+        return list(dict.fromkeys(name for name, _ in self._read_listen_file(filename)))
+
+    def _load_priorities(self, filename: str) -> Dict[str, float]:
+        """Dispatch priorities from the "priority" annotations of the listen list"""
+        priorities = {}
+        for name, annotations in self._read_listen_file(filename):
+            if "priority" not in annotations:
+                continue
+            try:
+                priority = float(annotations["priority"])
+                if priority <= 0:
+                    raise ValueError()
+            except ValueError:
+                print(f"Invalid priority '{annotations['priority']}' of {name} in {filename}, using 1")
+                continue
+            priorities[name] = priority
+        return priorities
+
+    def reload_listen_list(self, filename: str | None = None) -> None:
+        """
+        Re-read the listen list and start or stop listening only to the chats that changed
+
+        Chats that stay in the list keep their window, context and debounce buffer.
+        A listed chat whose listener could not be started is retried.
+        """
+        filename = filename or self.config.listen_friendname_file
+        try:
+            names = self._load_listen_friendname_list(filename)
+            self.dispatcher.set_priorities(self._load_priorities(filename))
+        except OSError as e:
+            print(f"Listen list not reloaded from {filename}: {e}")
+            return
+        # A name whose listener never started has nothing to stop
+        removed = [name for name in self.friendname_list if name not in names and name in WechatClient.chatWindowList]
+        added = [name for name in names if name not in WechatClient.chatWindowList]
+        for name in removed:
+            if self.wechatclient.stopListen(name):
+                print(f"Stop listen {name} succeed!")
+            else:
+                print(f"Stop listen {name} failed!")
+        for name in added:
+            if self.wechatclient.startListen(name):
+                print(f"Listen {name} succeed!")
+            else:
+                print(f"Listen {name} failed!")
+        self.friendname_list = names
 
     def start_event_loop(self):
         # First, perform logical configuration
@@ -70,14 +240,33 @@ class WechatBot:
                 print(f"Listen {name} succeed!")
             else:
                 print(f"Listen {name} failed!")
+        # Tuning changed in .env, the listen list and the system prompts apply without a restart
+        self.config.start_watching()
         # Then start an event loop
         self.loop_thread = threading.Thread(target=self._event_loop, daemon=False)
         self.loop_thread.start()
 
     def stop_event_loop(self):
+        """
+        Graceful shutdown: stop taking new messages, flush the debounce buffers, wait for the
+        replies in flight and persist every context before stopping the listeners
+        """
         with self.stop_flag_lock:
                 self.stop_flag = 1
+        self.config.stop_watching()
+        # Media still being processed is resolved before the buffers are flushed
+        self.wechatclient.media_ingestor.stop()
+        self.debounce_pool.drain()
+        self.debounce_pool.stop()
+        self.dispatcher.join()
+        self.dispatcher.stop()
+        # Send the queued replies while the chat windows are still open
+        WechatClient.outbound.stop()
+        WechatClient.outbound = None
+        self.context_manager.close()
         for name in self.friendname_list:
+            if name not in WechatClient.chatWindowList:
+                continue
             res = self.wechatclient.stopListen(name)
             if res:
                 print(f"Stop listen {name} succeed!")
@@ -85,6 +274,17 @@ class WechatBot:
                 print(f"Stop listen {name} failed!")
         # Then join the event loop thread
         self.loop_thread.join()
+        if self.speculation != None:
+            print(f"Speculation stats: {self.speculation.stats()}")
+        print(f"Dispatcher stats: {self.dispatcher.stats()}")
+        print(f"LLM coalescing stats: {self.responsor.single_flight.stats()}")
+        print(f"LLM endpoint stats: {self.responsor.client_pool.stats()}")
+        self.responsor.client_pool.close()
+        if self.responsor.response_cache != None:
+            print(f"Response cache stats: {self.responsor.response_cache.stats()}")
+        if self.metrics_server != None:
+            self.metrics_server.stop()
+        tracer.close()
 
 if __name__ == "__main__":
     bot = WechatBot()
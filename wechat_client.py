@@ -1,40 +1,64 @@
 from config import Config
+from media_ingestor import MediaIngestor
+from outbound_queue import OutboundQueue, PRIORITY_NORMAL
 from wxauto import WeChat, Chat
 from wxauto.msgs import BaseMessage
 from typing import Any, Dict, Callable
+from concurrent.futures import Future
 
 
 class WechatClient:
     ''' A thread-unsafe unsafe unsafe WeChat client class '''
     wechat = WeChat()
     chatWindowList: Dict[str,Chat] = {}
+    # Every outgoing message goes through this queue's single dispatcher thread
+    outbound: OutboundQueue = None
     def __init__(self, config: Config, handler: Callable[[Dict[str, Any]], None]):
         self.config = config
         self.handler = handler
+        self.media_ingestor = MediaIngestor(config)
+        if WechatClient.outbound == None:
+            WechatClient.outbound = OutboundQueue(config, WechatClient.chatWindowList.get)
     
     def _on_message_(self, message: BaseMessage, chat: Chat) -> None:
         user_id = chat.who
         if message.sender != "self":
+            # Media is converted on the ingestor's workers; the listener only submits a placeholder
+            # and its future, so one large video does not stall the messages of other chats
+            media = None
             # 使用字典实现switch-case的效果
+            media_switcher = {
+                "voice": lambda: self.media_ingestor.submit(message.to_text),
+                "image": lambda: self.media_ingestor.submit_download(
+                    message.download,
+                    lambda path: f"Here is an image message. You can see it if you have a image viewer. The image is at {path}."),
+                "video": lambda: self.media_ingestor.submit_download(
+                    message.download,
+                    lambda path: f"Here is a video message. You can see it if you have a video viewer. The video is at {path}."),
+                "file": lambda: self.media_ingestor.submit_download(
+                    message.download,
+                    lambda path: f"Here is a file message. You can see it if you have a file viewer. The file is at {path}.")
+            }
             message_switcher = {
                 "text": lambda: message.content,
-                "voice": lambda: message.to_text(),
                 "emotion": lambda: "Here is an emotion message to describe my emotion.",
-                "image": lambda: f"Here is an image message. You can see it if you have a image viewer. The image is at {message.download(self.config.file_download_dir)}.",
-                "video": lambda: f"Here is a video message. You can see it if you have a video viewer. The video is at {message.download(self.config.file_download_dir)}.",
-                "file": lambda: f"Here is a file message. You can see it if you have a file viewer. The file is at {message.download(self.config.file_download_dir)}."
             }
 
-            # 获取消息内容，如果消息类型不在handlers中则返回默认消息
-            msg = message_switcher.get(
-                message.type,
-                lambda: "[Between this square brackets is a invisiable non-text message. Please ignore it.]"
-            )()
+            if message.type in media_switcher:
+                media = media_switcher[message.type]()
+                msg = f"[A {message.type} message that could not be processed.]"
+            else:
+                # 获取消息内容，如果消息类型不在handlers中则返回默认消息
+                msg = message_switcher.get(
+                    message.type,
+                    lambda: "[Between this square brackets is a invisiable non-text message. Please ignore it.]"
+                )()
 
             # 调用处理函数
             self.handler({
                 "user_id": user_id,
-                "message": {"role": "user", "content": msg}
+                "message": {"role": "user", "content": msg},
+                "media": media
             })
 
     def startListen(self, friendName: str) -> bool:
@@ -60,18 +84,23 @@ class WechatClient:
     
     @classmethod
     def sendTextMessage(cls, friendName: str, message: str) -> bool:
+        """Send a text message through the outbound queue and wait until it is sent"""
         if friendName in WechatClient.chatWindowList:
-            WechatClient.chatWindowList[friendName].SendMsg(message)
-            return True
+            return cls.queueTextMessage(friendName, message).result().status
         else:
             print(f"Friend {friendName} is not in listen list!")
             return False
-    
+
+    @classmethod
+    def queueTextMessage(cls, friendName: str, message: str, priority: int = PRIORITY_NORMAL) -> Future:
+        """Queue a text message without waiting; the future resolves to a SendResult (status, latency)"""
+        return WechatClient.outbound.send_text(friendName, message, priority)
+
     @classmethod
     def sendFileMessage(cls, friendName: str, filePath: str) -> bool:
+        """Send a file through the outbound queue and wait until it is sent"""
         if friendName in WechatClient.chatWindowList:
-            WechatClient.chatWindowList[friendName].SendFiles(filePath)
-            return True
+            return WechatClient.outbound.send_file(friendName, filePath).result().status
         else:
             print(f"Friend {friendName} is not in listen list!")
             return False